@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+
+# Contains asyncio versions of the sensor and control entry points.
+# Conversion delays are awaited instead of slept, and the short bus
+#   transactions run on a dedicated single thread executor, so one event
+#   loop can poll every plant and still serve control requests while
+#   conversions are in flight.
+# Basic usage (Python 3.5+):
+#   values = await aio.sensor_values(plant1)
+#   await aio.update_all_sensors(opt="all")
+#   await aio.control(plant1Control, on="fan")
+# Every bus job selects its mux channel and switches the mux off again
+#   before returning, so jobs for different plants can be interleaved.
+# Failed bus jobs are retried and reported to the cluster breakers just
+#   like the blocking versions, but the backoff waits are awaited.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from weakref import WeakKeyDictionary
+
+from sense import SensorCluster, SensorError, LuxRangeError, I2CBusError
+from control import ControlCluster
+from i2c_utility import TCA_select
+from faults import backoff
+from instrument import count_event
+
+_executors = {}  # {bus: executor}
+_analog = {}  # {bus: [users, ready time, powered]} of each analog rail
+_analog_locks = WeakKeyDictionary()  # {event loop: lock on _analog}
+_flights = {}  # {cluster: refresh in progress}
+
+
+def bus_executor(bus=None):
+    """ Returns the executor that runs every transaction on bus
+            (SensorCluster.bus by default).
+        A single worker per bus keeps transactions from different
+            coroutines from overlapping on that bus, while separate
+            buses run in parallel.
+    """
+    if bus is None:
+        bus = SensorCluster.bus
+    if bus not in _executors:
+        _executors[bus] = ThreadPoolExecutor(max_workers=1)
+    return _executors[bus]
+
+
+async def run_on_bus(fn, *args, bus=None):
+    """ Runs fn(*args) on the executor of bus and returns its result.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(bus_executor(bus), lambda: fn(*args))
+
+
+async def _retry(sensorobj, fn, *args):
+    # Runs fn(*args) on the bus of sensorobj, retrying IOErrors with the
+    #   backoff of SensorCluster (see faults.retry)
+    for wait in backoff(SensorCluster.retry_attempts,
+                        SensorCluster.retry_delay,
+                        SensorCluster.retry_limit):
+        try:
+            return await run_on_bus(fn, *args, bus=sensorobj.bus)
+        except IOError:
+            count_event("retry")
+        await asyncio.sleep(wait)
+    return await run_on_bus(fn, *args, bus=sensorobj.bus)
+
+
+def _released(sensorobj, fn, *args):
+    # Runs one phase of a sensor read, leaving the mux switched off
+    try:
+        return fn(*args)
+    finally:
+        TCA_select(sensorobj.bus, sensorobj.mux_addr, "off")
+
+
+async def update_lux(sensorobj, extend=None):
+    """ Async version of SensorCluster.update_lux.
+        Returns the new lux value.
+    """
+    for attempt in range(2):
+        delay = await _retry(sensorobj, _released, sensorobj,
+                             sensorobj.start_lux, extend)
+        await asyncio.sleep(delay)
+        try:
+            return await _retry(sensorobj, _released, sensorobj,
+                                sensorobj.read_lux, extend)
+        except LuxRangeError:
+            # The sensor switched mode; repeat the conversion once
+            if attempt:
+                raise
+
+
+async def update_humidity_temp(sensorobj):
+    """ Async version of SensorCluster.update_humidity_temp.
+    """
+    delay = await _retry(sensorobj, _released, sensorobj,
+                         sensorobj.start_humidity_temp)
+    await asyncio.sleep(delay)
+    await _retry(sensorobj, _released, sensorobj,
+                 sensorobj.read_humidity_temp)
+
+
+async def _analog_power(bus, operation):
+    # Reference counts the analog rail of bus so concurrent moisture reads
+    #   turn it on once and off after the last reader is done.
+    # Every "on" must be matched by an "off", even if the "on" raised:
+    #   the count is taken before the rail is switched, and a rail that
+    #   failed to switch on is switched on again by the next reader.
+    # Returns the time the rail is settled.
+    # A lock is bound to the loop it is first used on, so each loop
+    #   that runs these coroutines gets its own.
+    loop = asyncio.get_event_loop()
+    lock = _analog_locks.get(loop)
+    if lock is None:
+        lock = _analog_locks[loop] = asyncio.Lock()
+    async with lock:
+        rail = _analog.setdefault(bus, [0, 0, False])
+        if operation == "on":
+            rail[0] += 1
+            if not rail[2]:
+                await run_on_bus(SensorCluster.analog_sensor_power,
+                                 bus, "on", bus=bus)
+                rail[1] = time() + SensorCluster.analog_settle
+                rail[2] = True
+        else:
+            rail[0] -= 1
+            if rail[0] == 0:
+                rail[2] = False
+                await run_on_bus(SensorCluster.analog_sensor_power,
+                                 bus, "off", bus=bus)
+        return rail[1]
+
+
+async def update_soil_moisture(sensorobj):
+    """ Async version of SensorCluster.update_soil_moisture.
+        Concurrent calls share a single power window on the analog rail.
+    """
+    try:
+        ready = await _analog_power(sensorobj.bus, "on")
+        await asyncio.sleep(max(ready - time(), 0))
+        await _retry(sensorobj, sensorobj.read_soil_moisture)
+    finally:
+        await _analog_power(sensorobj.bus, "off")
+
+
+async def update_instance_sensors(sensorobj, opt=None):
+    """ Async version of SensorCluster.update_instance_sensors.
+        The lux and humidity conversions run concurrently.
+        The last error is raised, soil moisture errors included, and the
+            outcome is reported to the cluster's breaker.
+    """
+    sensorobj.update_count += 1
+    try:
+        # Let both conversions finish before raising either error
+        for result in await asyncio.gather(update_lux(sensorobj),
+                                           update_humidity_temp(sensorobj),
+                                           return_exceptions=True):
+            if isinstance(result, BaseException):
+                raise result
+        if opt == "all":
+            await update_soil_moisture(sensorobj)
+    except (IOError, SensorError, I2CBusError) as error:
+        sensorobj.breaker.failure(error)
+        raise
+    sensorobj.breaker.success()
+    sensorobj.timestamp = time()
+    sensorobj.record()
+
+
+async def update_all_sensors(opt=None):
+    """ Async version of SensorCluster.update_all_sensors.
+        Every cluster is polled concurrently. Clusters whose breaker is
+            open are skipped and a failing cluster does not stop the
+            others. Returns {cluster: error} for the clusters that failed.
+    """
+    clusters = [sensorobj for sensorobj in SensorCluster
+                if sensorobj.breaker.allow()]
+    results = await asyncio.gather(*[update_instance_sensors(sensorobj, opt)
+                                     for sensorobj in clusters],
+                                   return_exceptions=True)
+    failed = {}
+    for sensorobj, result in zip(clusters, results):
+        if isinstance(result, (IOError, SensorError, I2CBusError)):
+            failed[sensorobj] = result
+        elif isinstance(result, BaseException):
+            raise result
+    return failed
+
+
+async def sensor_values(sensorobj, max_age=None):
+    """ Async version of SensorCluster.sensor_values.
+        Returns the values along with the time each was read
+            ("timestamps"); with max_age, fresh values are returned
+            without touching the bus.
+    """
+    if max_age is None or not sensorobj.fresh(max_age):
+        await refresh(sensorobj)
+    return sensorobj.current_values()
+
+
+async def refresh(sensorobj):
+    """ Async version of SensorCluster.refresh.
+        Coroutines that ask while a refresh of the cluster is running
+            await that refresh and share its result or error.
+    """
+    flight = _flights.get(sensorobj)
+    if flight is None:
+        flight = asyncio.ensure_future(
+            update_instance_sensors(sensorobj, opt="all"))
+        _flights[sensorobj] = flight
+        flight.add_done_callback(lambda done: _flights.pop(sensorobj, None))
+    # A cancelled caller must not cancel the refresh the others await
+    await asyncio.shield(flight)
+
+
+async def control(ctrlobj, on=[], off=[]):
+    """ Async version of ControlCluster.control.
+        The request throttle is awaited rather than slept.
+    """
+    ctrlobj.stage(on, off)
+    wait = ControlCluster.command_delay()
+    if wait > 0:
+        await asyncio.sleep(wait)
+    return await run_on_bus(ControlCluster.commit, bus=ControlCluster.bus)
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# Contains the bus broker shared by SensorCluster and ControlCluster.
+# The broker owns the SMBus and serializes access to it. It can be used
+#   anywhere an SMBus is expected:
+#      broker = BusBroker(smbus.SMBus(1))
+#      SensorCluster.bus = broker
+#      ControlCluster.bus = broker
+# Each SMBus call made through the broker is atomic. Multi-step
+#   transactions (mux select -> read -> mux off, or an expander
+#   read-modify-write) are grouped with i2c_utility.atomic, which takes the
+#   broker for the whole block. Waiting threads are served in priority
+#   order, so control writes get ahead of queued sensor work.
+# Jobs queued with submit hold the broker between their waits only: a
+#   job that sleeps through i2c_utility.bus_sleep (outside any atomic
+#   block) lets other threads use the bus until the wait is over.
+import threading
+from heapq import heappush, heappop
+from itertools import count
+try:
+    from queue import PriorityQueue
+except ImportError:
+    from Queue import PriorityQueue
+from i2c_utility import PRIORITY_CONTROL, PRIORITY_NORMAL, PRIORITY_SENSOR
+from i2c_utility import bus_sleep
+
+
+class BusBroker(object):
+    """ Owns an SMBus and hands out exclusive, prioritized access to it.
+
+        Lower priority values are served first:
+            PRIORITY_CONTROL - control writes
+            PRIORITY_NORMAL - single calls made through the broker
+            PRIORITY_SENSOR - sensor reads and sweeps
+        Threads waiting at the same priority are served in arrival order.
+        The lock is reentrant, so atomic blocks may be nested.
+
+        Usage:
+            with broker.atomic(PRIORITY_CONTROL):
+                reg = broker.read_byte_data(0x20, 0x14)
+                broker.write_byte_data(0x20, 0x14, reg | 0x04)
+
+            job = broker.submit(plant1.update_instance_sensors,
+                                priority=PRIORITY_SENSOR)
+            job.result()
+    """
+    CONTROL = PRIORITY_CONTROL
+    NORMAL = PRIORITY_NORMAL
+    SENSOR = PRIORITY_SENSOR
+
+    def __init__(self, bus):
+        self.bus = bus
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._waiting = []
+        self._order = count()
+        self._jobs = PriorityQueue()
+        self._worker = None
+        self._job_priority = None  # priority of the running job
+        self._lock = threading.Lock()
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """ Blocks until the calling thread owns the bus.
+        """
+        me = threading.current_thread()
+        with self._cond:
+            if self._owner is me:
+                self._depth += 1
+                return
+            ticket = (priority, next(self._order))
+            heappush(self._waiting, ticket)
+            while self._owner is not None or self._waiting[0] != ticket:
+                self._cond.wait()
+            heappop(self._waiting)
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            if self._owner is not threading.current_thread():
+                raise RuntimeError("Bus released by a thread that does not own it")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    def atomic(self, priority=PRIORITY_NORMAL):
+        """ Returns a context manager holding the bus for its block.
+        """
+        return _Hold(self, priority)
+
+    def submit(self, fn, *args, **kwargs):
+        """ Queues fn(*args, **kwargs) to run on the broker's worker thread
+                while holding the bus, apart from its waits (see sleep).
+                The priority keyword (default PRIORITY_NORMAL) orders
+                queued jobs.
+            Returns a BusJob whose result() waits for completion.
+        """
+        priority = kwargs.pop("priority", PRIORITY_NORMAL)
+        job = BusJob(fn, args, kwargs)
+        self._jobs.put((priority, next(self._order), job))
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run_jobs)
+                self._worker.daemon = True
+                self._worker.start()
+        return job
+
+    def _run_jobs(self):
+        while True:
+            priority, order, job = self._jobs.get()
+            self._job_priority = priority
+            with self.atomic(priority):
+                job.run()
+
+    def sleep(self, seconds):
+        # Waits are passed to the owned bus without taking the lock.
+        # A job holding the bus only through submit gives it up for the
+        #   wait; inside an atomic block of its own the bus stays held.
+        me = threading.current_thread()
+        with self._cond:
+            yielded = seconds > 0 and me is self._worker and \
+                self._owner is me and self._depth == 1
+            if yielded:
+                self._owner = None
+                self._depth = 0
+                self._cond.notify_all()
+        try:
+            bus_sleep(self.bus, seconds)
+        finally:
+            if yielded:
+                self.acquire(self._job_priority)
+
+    def __getattr__(self, name):
+        # Forward any other SMBus call, holding the bus for its duration
+        attr = getattr(self.bus, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args):
+            with self.atomic():
+                return attr(*args)
+        return call
+
+
+class _Hold(object):
+    def __init__(self, broker, priority):
+        self.broker = broker
+        self.priority = priority
+
+    def __enter__(self):
+        self.broker.acquire(self.priority)
+        return self.broker
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.broker.release()
+        return False
+
+
+class BusJob(object):
+    """ Handle for work queued with BusBroker.submit.
+    """
+    def __init__(self, fn, args, kwargs):
+        self._call = (fn, args, kwargs)
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        fn, args, kwargs = self._call
+        try:
+            self._result = fn(*args, **kwargs)
+        except Exception as error:
+            self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Waits for the job and returns its result,
+                re-raising any exception it raised.
+        """
+        if not self._done.wait(timeout):
+            raise BusTimeout("Bus job did not complete in time")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class BusTimeout(Exception):
+    pass
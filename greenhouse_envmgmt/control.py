@@ -1,8 +1,38 @@
 #!/usr/bin/python
-from i2c_utility import IO_expander_output, get_ADC_value, get_IO_reg
-from operator import itemgetter
-from math import pi
-from time import sleep
+from i2c_utility import get_IO_reg
+from i2c_utility import IOExpander, atomic, bus_sleep, PRIORITY_CONTROL
+from time import time
+from array import array
+import json
+import threading
+
+# Control bits of a cluster's state
+FAN = 0b0001
+LIGHT = 0b0010
+VALVE = 0b0100
+PUMP = 0b1000
+PINS = FAN | LIGHT | VALVE  # controls with a pin of their own
+
+
+def default_gpio_map():
+    """ Returns the standard pin map: {ID: pin assignment}.
+        IDs 1-4 use expander 0x20 (A0 and A1 are reserved for the analog
+            sensor power and the pump). Each of the expanders 0x21-0x27
+            carries four more plants, using pins 0-2 and 3-5 of each bank.
+    """
+    table = {}
+    for ID, (bank, fan, light, valve) in enumerate(
+            [(0, 2, 3, 4), (0, 5, 6, 7), (1, 0, 1, 2), (1, 3, 5, 6)], 1):
+        table[ID] = {"expander": 0x20, "bank": bank,
+                     "fan": fan, "light": light, "valve": valve}
+    ID = 5
+    for addr in range(0x21, 0x28):
+        for bank in (0, 1):
+            for first in (0, 3):
+                table[ID] = {"expander": addr, "bank": bank, "fan": first,
+                             "light": first + 1, "valve": first + 2}
+                ID += 1
+    return table
 
 
 class IterList(type):
@@ -11,8 +41,26 @@ class IterList(type):
     def __iter__(cls):
         return iter(cls._list)
 
+    # ControlCluster.bus is kept here so that instances can expose their
+    #   own bus (bound or default) through a property of the same name
+    @property
+    def bus(cls):
+        return cls._default_bus
+
+    @bus.setter
+    def bus(cls, bus):
+        cls._default_bus = bus
+
+    @property
+    def GPIOdict(cls):
+        return [ctrlobj.GPIO_dict for ctrlobj in cls._list]
+
 
-class ControlCluster(object):
+# Applies IterList under both Python 2 and Python 3
+IterBase = IterList("IterBase", (object,), {"__slots__": ()})
+
+
+class ControlCluster(IterBase):
     """ This class serves as a control module for each plant's
             fan, light, and pump valve.
 
@@ -20,8 +68,10 @@ class ControlCluster(object):
             generate a GPIO mapping corresponding to the pins on the MCP
             IO expander.
 
-        Currently, only four plant control sets can be supported. IDs
-            must be greater than 1 and no higher than 4.
+        Pins are assigned from the gpio_map table, keyed by ID. The
+            default table covers IDs 1-32 on expanders 0x20-0x27; another
+            table can be loaded with load_gpio_map before creating
+            clusters.
 
         Usage: plant1Control = ControlCluster(1)
             This will create the first plant control unit.
@@ -31,33 +81,213 @@ class ControlCluster(object):
                 plant1Control.manage("light", "off")
                 plant1Control.update()
 
+            Changing several control units at once:
+                with ControlCluster.transaction() as scene:
+                    scene.control(plant1Control, on="light")
+                    scene.control(plant2Control, off="all")
+
     """
-    __metaclass__ = IterList
+    __slots__ = ("ID", "IOexpander", "bank", "fan", "light", "valve",
+                 "_bus_key", "_key", "_index", "_pin_masks")
     _list = []
-    GPIOdict = []
     pump_pin = 1  # Pin A1 is assigned to the pump
     pump_bank = 0
+    pump_expander = 0x20
+    analog_power_pin = 0  # Pin A0 of the pump expander powers the sensors
+    expander_range = range(0x20, 0x28)
+    gpio_map = default_gpio_map()
     current_volume = 0
-    bus = None
+    min_command_interval = .01  # throttle for expander commits (seconds)
+    _last_command = 0
+    # Aggregated output masks, maintained as controls change.
+    # Keyed by (bus, expander address); bus is None for clusters that
+    #   follow ControlCluster.bus.
+    master_mask = {}  # {(bus, addr): [bank A, bank B]} requested outputs
+    owned_mask = {}  # {(bus, addr): [bank A, bank B]} pins driven
+    _pump_requests = {}  # {bus: number of clusters requesting the pump}
+    _dirty = set()  # (bus, addr) keys changed since the last commit
+    _mask_lock = threading.Lock()
+    _default_bus = None
+    # Control state: one byte of control bits per cluster, indexed by
+    #   the cluster's _index. Slots of removed clusters are reused.
+    control_bits = {"fan": FAN, "light": LIGHT, "valve": VALVE, "pump": PUMP}
+    _states = array("B")
+    _free = []
 
     @classmethod
-    def compile_instance_masks(cls):
-        """ Compiles instance masks into a master mask that is usable by
-                the IO expander. Also determines whether or not the pump
-                should be on. 
-            Method is generalized to support multiple IO expanders
-                for possible future expansion.
+    def load_gpio_map(cls, source):
+        """ Replaces gpio_map with a table loaded from source: a dict or
+                list, or the path of a JSON file holding one.
+            Entries give the expander address (a number or a string such
+                as "0x21"), the bank and the fan, light and valve pins:
+                {"1": {"expander": "0x20", "bank": 0,
+                       "fan": 2, "light": 3, "valve": 4}, ...}
+            A list holds the same entries with an "ID" key each.
+            The table is checked before it replaces the current one.
+            Clusters created earlier keep their pins.
         """
-        # Compute required # of IO expanders needed, clear mask variable.
-        number_IO_expanders = ((len(cls._list) - 1) / 4) + 1
-        cls.master_mask = [0, 0] * number_IO_expanders
+        if not isinstance(source, (dict, list)):
+            with open(source) as config:
+                source = json.load(config)
+        if isinstance(source, dict):
+            entries = [dict(entry, ID=ID) for ID, entry in source.items()]
+        else:
+            entries = source
+        table = {}
+        try:
+            for entry in entries:
+                expander = entry["expander"]
+                if not isinstance(expander, int):
+                    expander = int(expander, 0)
+                table[int(entry["ID"])] = {
+                    "expander": expander, "bank": int(entry["bank"]),
+                    "fan": int(entry["fan"]), "light": int(entry["light"]),
+                    "valve": int(entry["valve"])}
+        except (KeyError, TypeError, ValueError) as error:
+            raise InvalidIOMap("Malformed GPIO map entry: " + str(error))
+        cls.check_gpio_map(table)
+        cls.gpio_map = table
+        return table
 
+    @classmethod
+    def check_gpio_map(cls, table):
+        """ Raises InvalidIOMap if an entry of table uses an unknown
+                expander, bank or pin, a reserved pin, or a pin that
+                is already assigned.
+        """
+        used = {(cls.pump_expander, cls.pump_bank, cls.pump_pin): "pump",
+                (cls.pump_expander, cls.pump_bank,
+                 cls.analog_power_pin): "analog sensor power"}
+        for ID in sorted(table):
+            entry = table[ID]
+            if entry["expander"] not in cls.expander_range:
+                raise InvalidIOMap("Unknown IO expander for ID: " + str(ID))
+            if entry["bank"] not in (0, 1):
+                raise InvalidIOMap("Invalid bank for ID: " + str(ID))
+            for control in ("fan", "light", "valve"):
+                pin = (entry["expander"], entry["bank"], entry[control])
+                if not 0 <= entry[control] < 8:
+                    raise InvalidIOMap(
+                        "Invalid " + control + " pin for ID: " + str(ID))
+                if pin in used:
+                    raise InvalidIOMap(
+                        "Pin of ID " + str(ID) + " " + control +
+                        " is already used by " + str(used[pin]))
+                used[pin] = "ID " + str(ID)
+
+    @classmethod
+    def compile_instance_masks(cls):
+        """ Rebuilds master_mask, owned_mask and the pump request counts
+                from the state of every control cluster, and marks every
+                expander for writing.
+            The masks are normally kept up to date by manage(), so this
+                is only needed to recover from external changes.
+        """
+        with cls._mask_lock:
+            cls.master_mask = {}
+            cls.owned_mask = {}
+            cls._pump_requests = {}
+            cls._dirty = set()
         for ctrlobj in cls:
-            # Or masks together bank-by-banl
-            cls.master_mask[ctrlobj.bank] |= ctrlobj.mask
-            # Handle the pump request seperately
-            if ctrlobj.pump_request == 1:
-                cls.master_mask[cls.pump_bank] |= 1 << cls.pump_pin
+            ctrlobj._register()
+        with cls._mask_lock:
+            for ctrlobj in cls:
+                ctrlobj._apply(0, cls._states[ctrlobj._index])
+
+    def _register(self):
+        # Claims the cluster's pins (and the pump pin of its bus) in
+        #   owned_mask and marks their expanders for writing
+        cls = ControlCluster
+        pump = (self._bus_key, cls.pump_expander)
+        with cls._mask_lock:
+            for entry in (self._key, pump):
+                if entry not in cls.master_mask:
+                    cls.master_mask[entry] = [0, 0]
+                    cls.owned_mask[entry] = [0, 0]
+                cls._dirty.add(entry)
+            cls.owned_mask[self._key][self.bank] |= self._pin_masks[PINS]
+            cls.owned_mask[pump][cls.pump_bank] |= 1 << cls.pump_pin
+            cls._pump_requests.setdefault(self._bus_key, 0)
+
+    def _apply(self, old, new):
+        # Moves the cluster from state old to state new and applies the
+        #   difference to the aggregated masks. Caller holds _mask_lock.
+        cls = ControlCluster
+        cls._states[self._index] = new
+        changed = old ^ new
+        if changed & PINS:
+            masks = cls.master_mask[self._key]
+            pins = self._pin_masks
+            masks[self.bank] = ((masks[self.bank] & ~pins[old & PINS]) |
+                                pins[new & PINS])
+            cls._dirty.add(self._key)
+        if changed & PUMP:
+            on = bool(new & PUMP)
+            requests = cls._pump_requests[self._bus_key] + (1 if on else -1)
+            cls._pump_requests[self._bus_key] = requests
+            if requests == (1 if on else 0):
+                # first request or last release of the pump on this bus
+                key = (self._bus_key, cls.pump_expander)
+                bit = 1 << cls.pump_pin
+                if on:
+                    cls.master_mask[key][cls.pump_bank] |= bit
+                else:
+                    cls.master_mask[key][cls.pump_bank] &= ~bit
+                cls._dirty.add(key)
+
+    def _slot(self):
+        # The cluster's index into _states; a removed cluster has none
+        #   because its slot may already belong to another cluster.
+        if self._index is None:
+            raise ClusterRemoved(
+                "Control cluster " + str(self.ID) + " was removed")
+        return self._index
+
+    def _change(self, on=0, off=0):
+        # Sets the on bits and clears the off bits of the cluster's state.
+        # Returns True if the state changed.
+        with ControlCluster._mask_lock:
+            old = ControlCluster._states[self._slot()]
+            new = (old | on) & ~off
+            if new != old:
+                self._apply(old, new)
+            return new != old
+
+    @classmethod
+    def _bits(cls, controls):
+        # State bits for a control name, "all", or a list of names
+        if type(controls) is str:
+            controls = [controls]
+        bits = 0
+        for control in controls:
+            if control == "all":
+                bits |= PINS | PUMP
+            else:
+                bits |= cls.control_bits.get(control, 0)
+        return bits
+
+    @classmethod
+    def bulk(cls, on=[], off=[], clusters=None):
+        """ Stages changes on many clusters at once (every cluster by
+                default). Accepts the same arguments as control().
+            Each cluster's state byte is updated with one bitwise
+                operation; the changes go out with the next commit().
+
+            Usage:
+                ControlCluster.bulk(off="fan")  # all fans off
+                ControlCluster.commit()
+        """
+        on, off = cls._bits(on), cls._bits(off)
+        if clusters is None:
+            clusters = cls._list
+        with cls._mask_lock:
+            states = cls._states
+            slots = [ctrlobj._slot() for ctrlobj in clusters]
+            for ctrlobj, slot in zip(clusters, slots):
+                old = states[slot]
+                new = (old | on) & ~off
+                if new != old:
+                    ctrlobj._apply(old, new)
 
     def update(self):
         """ This method exposes a more simple interface to the IO module
@@ -66,65 +296,90 @@ class ControlCluster(object):
 
         Usage: plant1Control.update(bus)
         """
-        ControlCluster.compile_instance_masks()
+        return ControlCluster.commit()
+
+    @classmethod
+    def commit(cls):
+        """ Writes the expanders whose masks changed since the last
+                commit. The cost depends on the number of changed
+                expanders, not on the number of control clusters.
+            Both banks of an expander are written with a single sequential
+                block write, and only when one of them has changed.
+                Pins that are not assigned to a control cluster (such as
+                the analog sensor power pin) keep their current state.
+            An expander whose write fails stays marked for the next commit.
+        """
+        with cls._mask_lock:
+            dirty = sorted(cls._dirty, key=lambda key: (id(key[0]), key[1]))
+            cls._dirty = set()
+            writes = [(key, list(cls.master_mask[key]),
+                       list(cls.owned_mask[key])) for key in dirty]
+        done = 0
+        try:
+            for (bus, addr), masks, owned in writes:
+                bus = cls.bus if bus is None else bus
+                with atomic(bus, PRIORITY_CONTROL):
+                    IOExpander.get(bus, addr).output_banks(masks, owned)
+                done += 1
+        finally:
+            if done < len(writes):
+                with cls._mask_lock:
+                    cls._dirty.update(key for key, masks, owned
+                                      in writes[done:])
 
-        IO_expander_output(
-            ControlCluster.bus, self.IOexpander,
-            self.bank,
-            ControlCluster.master_mask[self.bank])
+    @classmethod
+    def transaction(cls):
+        """ Returns a ControlTransaction used to stage changes on any
+                number of control clusters and commit them together.
+        """
+        return ControlTransaction()
+
+    @classmethod
+    def command_delay(cls):
+        """ Reserves the next expander commit slot, at least
+                min_command_interval after the previous one, and
+                returns how long the caller must wait for it.
+        """
+        now = time()
+        slot = max(now, ControlCluster._last_command + cls.min_command_interval)
+        ControlCluster._last_command = slot
+        return slot - now
 
-        if self.bank != ControlCluster.pump_bank:
-            IO_expander_output(
-                ControlCluster.bus, self.IOexpander,
-                ControlCluster.pump_bank,
-                ControlCluster.master_mask[ControlCluster.pump_bank])
+    @classmethod
+    def throttle(cls):
+        """ Enforces min_command_interval between expander commits.
+            Only delays when commands actually arrive too quickly.
+        """
+        bus_sleep(cls.bus, cls.command_delay())
 
     def form_GPIO_map(self):
         """ This method creates a dictionary to map plant IDs to
         GPIO pins are associated in triples.
         Each ID gets a light, a fan, and a mist nozzle.
+        The pins are looked up in ControlCluster.gpio_map.
         """
-        # Compute bank/pins/IOexpander address based on ID
-        if self.ID == 1:
-            self.IOexpander = 0x20
-            self.bank = 0
-            self.fan = 2
-            self.light = 3
-            self.valve = 4
-        elif self.ID == 2:
-            self.IOexpander = 0x20
-            self.bank = 0
-            self.fan = 5
-            self.light = 6
-            self.valve = 7
-        elif self.ID == 3:
-            self.IOexpander = 0x20
-            self.bank = 1
-            self.fan = 0
-            self.light = 1
-            self.valve = 2
-        elif self.ID == 4:
-            self.IOexpander = 0x20
-            self.bank = 1
-            self.fan = 3
-            self.light = 5
-            self.valve = 6
-        else:
+        # Look up bank/pins/IOexpander address based on ID
+        entry = ControlCluster.gpio_map.get(self.ID)
+        if entry is None:
             raise InvalidIOMap(
                 "Mapping not available for ID: " + str(self.ID))
+        self.IOexpander = entry["expander"]
+        self.bank = entry["bank"]
+        self.fan = entry["fan"]
+        self.light = entry["light"]
+        self.valve = entry["valve"]
+        self._key = (self._bus_key, self.IOexpander)
+
+        # Output mask of the bank for each combination of the pin bits
+        shifts = ((FAN, self.fan), (LIGHT, self.light), (VALVE, self.valve))
+        self._pin_masks = tuple(
+            sum(1 << pin for bit, pin in shifts if state & bit)
+            for state in range(PINS + 1))
 
-        # Check to make sure reserved pins are not requested
-        if (self.bank == 0) and (min(self.fan, self.light, self.valve) < 2):
-            raise InvalidIOMap(
-                "Pins A0 and A1 are reserved for other functions")
-
-        self.GPIO_dict = [{'ID': self.ID, 'bank': self.bank,
-                           'fan': self.fan, 'valve': self.valve, 'light': self.light}]
-
-        # Append dictionary to class and resort dictionary by ID # if needed
-        ControlCluster.GPIOdict.append(self.GPIO_dict)
-        # ControlCluster.GPIOdict=sorted(
-        #    ControlCluster.GPIOdict, key=itemgetter('ID'))
+    @property
+    def GPIO_dict(self):
+        return [{'ID': self.ID, 'bank': self.bank,
+                 'fan': self.fan, 'valve': self.valve, 'light': self.light}]
 
     def manage_light(self, operation):
         """ Turns on the lights depending on the operation command
@@ -153,27 +408,29 @@ class ControlCluster(object):
         """
         Updates control module knowledge of pump requests.
         If any sensor module requests water, the pump will turn on.
+        The pump stays on until every requesting cluster releases it.
 
         """
         if operation == "on":
-            self.controls["pump"] = "on"
+            self._change(on=PUMP)
         elif operation == "off":
-            self.controls["pump"] = "off"
+            self._change(off=PUMP)
 
         return True
 
     def manage(self, control, operation):
-        if control not in {"light", "valve", "fan", "pump"}:
+        if control not in ControlCluster.control_bits:
             raise IOExpanderFailure(
                 "Invalid controller")
         if operation not in ["on", "off"]:
             raise IOExpanderFailure(
                 "Invalid operation passed to {} controller".format(control))
-        if control == "pump":
-            return self.manage_pump(operation)
+        bit = ControlCluster.control_bits[control]
+        if operation == "on":
+            self._change(on=bit)
         else:
-            self.controls[control] = operation
-            return True
+            self._change(off=bit)
+        return True
 
     def control(self, on=[], off=[]):
         """
@@ -199,73 +456,173 @@ class ControlCluster(object):
                 ctrolobj.control(on="light", off="fan")
 
         """
-        controls = {"light", "valve", "fan", "pump"}
-
-        def cast_arg(arg):
-            if type(arg) is str:
-                if arg == "all":
-                    return controls
-                else:
-                    return {arg} & controls
-            else:
-                return set(arg) & controls
-
-        # User has requested individual controls.
-        for item in cast_arg(on):
-            self.manage(item, "on")
-        for item in cast_arg(off):
-            self.manage(item, "off")
-        sleep(.01) # Force delay to throttle requests
+        self.stage(on, off)
+        ControlCluster.throttle()  # throttle requests
         return self.update()
 
+    def stage(self, on=[], off=[]):
+        """ Records control changes without sending them to the
+                IO expander. Accepts the same arguments as control().
+            The changes go out with the next update() or commit().
+        """
+        self._change(self._bits(on), self._bits(off))
+        return True
+
+    def stage_bits(self, on=0, off=0):
+        """ Like stage(), with the changes given as state bits (FAN,
+                LIGHT, VALVE, PUMP). The on bits are set and the off bits
+                cleared in one step, so concurrent changes to the other
+                bits are kept.
+            Returns True if the cluster's state changed.
+        """
+        return self._change(on, off)
+
     def restore_state(self):
         """ Method should be called on obj. initialization
             When called, the method will attempt to restore 
             IO expander and RPi coherence and restore
             local knowledge across a possible power failure 
         """
-        current_mask = get_IO_reg(ControlCluster.bus,
+        current_mask = get_IO_reg(self.bus,
                                  self.IOexpander, 
                                  self.bank)
-        if current_mask & (1 << ControlCluster.pump_pin):
-            self.manage_pump("on")
-        if current_mask & (1 << self.fan):
-            self.manage_fan("on")
-        if current_mask & (1 << self.light):
-            self.manage_fan("on")
-
-
+        pump_mask = get_IO_reg(self.bus, ControlCluster.pump_expander,
+                               ControlCluster.pump_bank)
+        state = 0
+        if pump_mask & (1 << ControlCluster.pump_pin):
+            state |= PUMP
+        for bit in (FAN, LIGHT):
+            if current_mask & self._pin_masks[bit]:
+                state |= bit
+        self._change(on=state)
 
     @property
-    def mask(self):
+    def bus(self):
+        """ The bus the cluster is bound to, or ControlCluster.bus.
+        """
+        if self._bus_key is None:
+            return ControlCluster._default_bus
+        return self._bus_key
 
-        def construct_mask(mask, control):
-            if self.controls[control] == "on":
-                return mask | 1 << self.GPIO_dict[0][control]
-            else:
-                return mask
+    @property
+    def state(self):
+        """ The control bits (FAN, LIGHT, VALVE, PUMP) that are on.
+            Assigning a state stages the difference, like stage().
+        """
+        return ControlCluster._states[self._slot()]
 
-        # probably should hold a constant of these somewhere
-        controls = ["fan", "light", "valve"]
+    @state.setter
+    def state(self, state):
+        self._change(on=state, off=~state)
 
-        mask = reduce(construct_mask, controls, 0x0)
+    @property
+    def controls(self):
+        """ The state as {"fan": "on", "light": "off", ...}
+        """
+        state = self.state
+        return dict((control, "on" if state & bit else "off")
+                    for control, bit in ControlCluster.control_bits.items())
 
-        # handle pump separately
-        if self.controls["pump"] == "on":
-            self.pump_request = 1
-        else:
-            self.pump_request = 0
+    @property
+    def mask(self):
+        """ The bank output mask requested by the fan, light and valve.
+        """
+        return self._pin_masks[self.state & PINS]
 
-        return mask
+    @property
+    def pump_request(self):
+        return 1 if self.state & PUMP else 0
 
-    def __init__(self, ID):
+    def __init__(self, ID, bus=None):
+        # The cluster is bound to bus if one is given. Otherwise it uses
+        #   whatever ControlCluster.bus is at the time of each call.
+        self._bus_key = bus
         self.ID = ID
         self.form_GPIO_map()
-        self.controls = {"light": "off",
-                         "valve": "off", "fan": "off", "pump": "off"}
+        cls = ControlCluster
+        with cls._mask_lock:
+            if cls._free:
+                self._index = cls._free.pop()
+                cls._states[self._index] = 0
+            else:
+                self._index = len(cls._states)
+                cls._states.append(0)
+        self._register()
         self.restore_state()
         self._list.append(self)
 
+    def remove(self):
+        """ Turns the cluster's outputs off, releases its pump request
+                and drops it from the cluster list. The change goes out
+                with the next commit.
+            Using the cluster afterwards raises ClusterRemoved.
+        """
+        # The pins stay owned so the commit drives them off
+        self.stage(off="all")
+        self._list.remove(self)
+        with ControlCluster._mask_lock:
+            ControlCluster._free.append(self._index)
+            self._index = None
+
+
+class ControlTransaction(object):
+    """ Stages control changes on any number of control clusters
+            and commits them as one update of the IO expanders.
+        Used as a context manager, the changes are committed when the
+            block exits normally and rolled back if it raises.
+        The changes are kept in the transaction until commit() applies
+            them together, so commits made elsewhere meanwhile (by
+            control(), a ProgramEngine or a LocalController) never
+            publish half of a transaction.
+
+        Usage:
+            scene = ControlCluster.transaction()
+            scene.control(plant1Control, on=["light", "fan"])
+            scene.control(plant2Control, off="all")
+            scene.commit()
+    """
+    def __init__(self):
+        self._staged = {}  # {ctrlobj: [bits to set, bits to clear]}
+
+    def control(self, ctrlobj, on=[], off=[]):
+        """ Stages changes for ctrlobj, see ControlCluster.control
+        """
+        on, off = ControlCluster._bits(on), ControlCluster._bits(off)
+        staged = self._staged.setdefault(ctrlobj, [0, 0])
+        staged[0] = (staged[0] & ~off) | on
+        staged[1] = (staged[1] & ~on) | off
+        return True
+
+    def commit(self):
+        """ Applies the staged changes and writes them in one commit.
+        """
+        ControlCluster.throttle()
+        with ControlCluster._mask_lock:
+            staged = [(ctrlobj._slot(), ctrlobj, on, off)
+                      for ctrlobj, (on, off) in self._staged.items()]
+            for slot, ctrlobj, on, off in staged:
+                old = ControlCluster._states[slot]
+                new = (old | on) & ~off
+                if new != old:
+                    ctrlobj._apply(old, new)
+        self._staged = {}
+        return ControlCluster.commit()
+
+    def rollback(self):
+        """ Discards the staged changes.
+        """
+        self._staged = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
 
 class IOExpanderFailure(Exception):
     pass
@@ -273,3 +630,7 @@ class IOExpanderFailure(Exception):
 
 class InvalidIOMap(Exception):
     pass
+
+
+class ClusterRemoved(Exception):
+    pass
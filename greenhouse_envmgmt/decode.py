@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+# Contains the conversion maths for raw sensor data.
+# Every function is pure and uses only arithmetic and bitwise operators,
+#   so it accepts either plain numbers (as used by the live drivers) or
+#   NumPy integer arrays holding many samples at once.
+# Basic usage:
+#   counts = lux_count(numpy.array(ch0_bytes))
+#   lux = lux_value(lux_count(ch0), lux_count(ch1))
+#   humidity, temp_f = hih_frames(numpy.array(frames))   # frames is N x 4
+#   volts = adc_frames(numpy.array(frames), resolution=12)
+# NumPy is optional. It is only needed to decode arrays.
+from math import e
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LUX_VALID_MASK = 0b10000000
+LUX_CHORD_MASK = 0b01110000
+LUX_STEP_MASK = 0b00001111
+HIH_STATUS_MASK = 0b11000000
+
+
+def _columns(frames, width):
+    # Splits frames into byte columns. A flat sequence is one frame.
+    if numpy is not None and isinstance(frames, numpy.ndarray):
+        frames = frames.astype(numpy.int64)
+        return [frames[..., i] for i in range(width)]
+    return [frames[i] for i in range(width)]
+
+
+def lux_valid(raw):
+    """ True where a TSL2550D ADC byte holds a completed conversion.
+    """
+    return (raw & LUX_VALID_MASK) != 0
+
+
+def lux_count(raw):
+    """ Converts TSL2550D ADC bytes (chord and step) to counts.
+        The valid bit is ignored; check it with lux_valid.
+    """
+    chord = (raw & LUX_CHORD_MASK) >> 4
+    step = raw & LUX_STEP_MASK
+    step_val = 1 << chord
+    # int(16.5 * (step_val - 1)) in integer arithmetic
+    chord_val = (33 * (step_val - 1)) // 2
+    return chord_val + step_val * step
+
+
+def lux_value(count0, count1, scale=1):
+    """ Computes the compensated lux value from the channel 0 and
+            channel 1 counts. scale is 5 for extended mode readings.
+        Equal counts (darkness, when both are 0) give 0 lux. A
+            saturated sensor also gives equal counts; callers tell it
+            apart from the raw bytes.
+    """
+    count0 = count0 * scale
+    count1 = count1 * scale
+    diff = count0 - count1
+    if numpy is not None and isinstance(diff, numpy.ndarray):
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ratio = count1 * 1.0 / diff
+            return numpy.where(diff == 0, 0.0,
+                               diff * .39 * e**(-.181 * (ratio**2)))
+    if diff == 0:
+        return 0.0
+    ratio = count1 * 1.0 / diff
+    return diff * .39 * e**(-.181 * (ratio**2))
+
+
+def lux_frames(ch0, ch1, scale=1):
+    """ Decodes arrays of channel 0 and channel 1 bytes to lux.
+        Returns (lux, valid) where valid marks samples whose bytes were
+            both valid. Samples with equal counts decode to 0 lux.
+    """
+    lux = lux_value(lux_count(ch0), lux_count(ch1), scale)
+    return lux, lux_valid(ch0) & lux_valid(ch1)
+
+
+def hih_status(byte0):
+    """ Status bits of an HIH7xxx result: 0 is a new reading,
+            1 a stale one.
+    """
+    return (byte0 & HIH_STATUS_MASK) >> 6
+
+
+def hih_humidity(byte0, byte1):
+    """ Relative humidity (%) from the first two HIH7xxx result bytes.
+    """
+    return ((byte0 & 0x3f) << 8 | byte1) * 100.0 / (2**14 - 2)
+
+
+def hih_celsius(byte2, byte3):
+    """ Temperature (C) from the last two HIH7xxx result bytes.
+    """
+    return ((byte2 << 6) + ((byte3 & 0xfc) >> 2)) * 165.0 / 16382.0 - 40.0
+
+
+def fahrenheit(celsius):
+    return celsius * 9 / 5.0 + 32
+
+
+def hih_frames(frames):
+    """ Decodes HIH7xxx results (4 bytes each, N x 4 for arrays).
+        Returns (status, humidity, temperature in F).
+    """
+    byte0, byte1, byte2, byte3 = _columns(frames, 4)
+    return (hih_status(byte0), hih_humidity(byte0, byte1),
+            fahrenheit(hih_celsius(byte2, byte3)))
+
+
+def adc_volts(code, resolution=12, gain=1, vref=2.048):
+    """ Converts MCP342x output codes to the voltage at the ADC input.
+        Bits above the resolution are ignored and the rest are treated
+            as two's complement.
+    """
+    code = code & ((1 << resolution) - 1)
+    code = code - ((code >> (resolution - 1)) & 1) * (1 << resolution)
+    return code * (vref / (1 << (resolution - 1))) / gain
+
+
+def adc_frames(frames, resolution=12, gain=1, vref=2.048):
+    """ Decodes MCP342x output bytes (most significant first, without
+            the configuration byte) to volts. 18 bit results use three
+            bytes and the others two; arrays are N x bytes.
+    """
+    width = 3 if resolution == 18 else 2
+    code = 0
+    for byte in _columns(frames, width):
+        code = code * 256 + byte
+    return adc_volts(code, resolution, gain, vref)
+
+
+def tank_depth(volts, vref=4.95, rref=2668, slope=-.0163, offset=28.127):
+    """ Converts the tank sensor divider voltage to a depth in cm
+            using the measured linear fit of the sensor resistance.
+    """
+    return rref * volts / (vref - volts) * slope + offset
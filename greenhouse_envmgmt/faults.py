@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# Contains the retry and circuit breaker helpers for flaky devices.
+# retry() repeats an operation that failed with an IOError, waiting an
+#   exponentially growing (and bounded) delay between attempts.
+# CircuitBreaker counts consecutive failures of a device. Once a threshold
+#   is reached the breaker opens and the device is skipped, apart from an
+#   occasional probe, until it works again.
+# Basic usage:
+#   data = retry(lambda: bus.read_byte(addr), bus, attempts=3, delay=.02)
+#
+#   breaker = CircuitBreaker(threshold=3, probe_interval=300)
+#   if breaker.allow():
+#       try:
+#           update(sensor)
+#       except IOError as error:
+#           breaker.failure(error)
+#       else:
+#           breaker.success()
+from time import time
+from i2c_utility import bus_sleep
+from instrument import count_event
+
+CLOSED = "closed"
+OPEN = "open"
+PROBING = "probing"
+
+
+def backoff(attempts, delay, limit, factor=2):
+    """ Returns the waits between attempts: delay, delay * factor, ...
+            each capped at limit.
+    """
+    return [min(delay * factor**n, limit) for n in range(attempts - 1)]
+
+
+def retry(operation, bus=None, attempts=3, delay=.02, limit=.5, factor=2,
+          errors=(IOError,)):
+    """ Calls operation() until it succeeds, at most attempts times, and
+            returns its result. The error of the last attempt is raised.
+        Waits go through i2c_utility.bus_sleep(bus), so a replayed bus
+            skips them. Each retry is counted as a "retry" event when
+            instrumentation is enabled.
+    """
+    for wait in backoff(attempts, delay, limit, factor):
+        try:
+            return operation()
+        except errors:
+            count_event("retry")
+        bus_sleep(bus, wait)
+    return operation()
+
+
+class CircuitBreaker(object):
+    """ Tracks the health of one device (or sensor cluster).
+
+        closed - calls are allowed; consecutive failures are counted.
+        open - threshold failures in a row opened the breaker; calls are
+            refused until probe_interval seconds have passed.
+        probing - one call was let through to test the device. Success
+            closes the breaker, failure opens it for another interval.
+
+        Callers ask allow() before using the device and report the
+            outcome with success() or failure().
+    """
+    def __init__(self, threshold=3, probe_interval=300.0):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.state = CLOSED
+        self.failures = 0  # consecutive failures
+        self.trips = 0  # times the breaker opened
+        self.last_error = None
+        self._opened = None  # time of opening or of the last probe
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        if time() >= self._opened + self.probe_interval:
+            self.state = PROBING
+            self._opened = time()
+            return True
+        return False
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.last_error = None
+
+    def failure(self, error=None):
+        self.failures += 1
+        self.last_error = error
+        if self.state == PROBING or self.failures >= self.threshold:
+            if self.state == CLOSED:
+                self.trips += 1
+                count_event("breaker_open")
+            self.state = OPEN
+            self._opened = time()
+
+    def reset(self):
+        self.success()
+        self._opened = None
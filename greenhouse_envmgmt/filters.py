@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+# Contains streaming filter stages for noisy analog channels.
+# Each stage takes one sample at a time through update() and returns the
+#   filtered value, or None if the sample was rejected. Stages are chained
+#   with FilterChain and driven from a sample source by FilteredStream,
+#   which keeps the latest filtered value for O(1) reads.
+# Basic usage:
+#   chain = FilterChain(OutlierFilter(9), MedianFilter(5), EMAFilter(.3))
+#   stream = FilteredStream(read_sensor, chain, rate=10)
+#   stream.start()
+#   ...
+#   stream.value     # latest filtered value, no bus traffic
+import threading
+from collections import deque
+from time import time
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+class MedianFilter(object):
+    """ Median of the last window samples.
+    """
+    def __init__(self, window=5):
+        self.samples = deque(maxlen=window)
+
+    def update(self, sample):
+        self.samples.append(sample)
+        return _median(self.samples)
+
+    def reset(self):
+        self.samples.clear()
+
+
+class EMAFilter(object):
+    """ Exponential moving average. alpha is the weight of each new
+            sample (0 < alpha <= 1); smaller values smooth more.
+    """
+    def __init__(self, alpha=.3):
+        if not 0 < alpha <= 1:
+            raise FilterError("EMA alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, sample):
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value += self.alpha * (sample - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+class OutlierFilter(object):
+    """ Rejects samples more than k median absolute deviations from the
+            median of the last window samples (and further than floor).
+        Rejected samples still enter the window, so a genuine step
+            change is accepted once it makes up most of the window.
+    """
+    def __init__(self, window=9, k=3.0, floor=0.0):
+        self.samples = deque(maxlen=window)
+        self.k = k
+        self.floor = floor
+        self.rejected = 0
+
+    def update(self, sample):
+        accept = True
+        if len(self.samples) >= 3:
+            median = _median(self.samples)
+            spread = _median([abs(value - median) for value in self.samples])
+            accept = abs(sample - median) <= max(self.k * spread, self.floor)
+        self.samples.append(sample)
+        if accept:
+            return sample
+        self.rejected += 1
+        return None
+
+    def reset(self):
+        self.samples.clear()
+
+
+class FilterChain(object):
+    """ Passes each sample through the stages in order.
+        The latest output is kept in value.
+    """
+    def __init__(self, *stages):
+        self.stages = list(stages)
+        self.value = None
+
+    def update(self, sample):
+        for stage in self.stages:
+            sample = stage.update(sample)
+            if sample is None:
+                return None
+        self.value = sample
+        return sample
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+        self.value = None
+
+
+class FilteredStream(object):
+    """ Samples a source at a fixed rate on a background thread and
+            feeds the results through a FilterChain.
+
+        sample - callable returning one raw sample
+        chain - FilterChain (or any object with update/value)
+        rate - samples per second
+
+        value and timestamp hold the latest filtered value and the time it
+            was produced; reading them never triggers a conversion.
+        Source errors (IOError) are counted and sampling continues.
+    """
+    def __init__(self, sample, chain, rate=10.0):
+        self.sample = sample
+        self.chain = chain
+        self.rate = rate
+        self.timestamp = None
+        self.samples = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def value(self):
+        return self.chain.value
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def step(self):
+        """ Takes and filters a single sample.
+            Returns the filtered value, or None if it was rejected.
+        """
+        try:
+            raw = self.sample()
+        except IOError:
+            self.errors += 1
+            return None
+        self.samples += 1
+        value = self.chain.update(raw)
+        if value is not None:
+            self.timestamp = time()
+        return value
+
+    def run(self):
+        self._stop.clear()
+        interval = 1.0 / self.rate
+        next_sample = time()
+        while not self._stop.is_set():
+            self.step()
+            next_sample += interval
+            wait = next_sample - time()
+            if wait < 0:
+                next_sample = time()  # fell behind, do not burst
+            elif self._stop.wait(wait):
+                break
+
+    def start(self):
+        """ Starts sampling on a background thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class FilterError(Exception):
+    pass
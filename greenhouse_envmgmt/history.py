@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# Contains the fixed capacity sample history kept by each SensorCluster.
+# Samples are stored column-wise in typed arrays (one for timestamps and
+#   one per quantity) used as a ring buffer, so appending is O(1) and
+#   memory use is fixed at creation.
+# Basic usage:
+#   plant1.history.between(time() - 3600)        # last hour as lists
+#   plant1.history.arrays()                      # NumPy arrays
+#   plant1.history.downsample(900)               # 15 minute min/mean/max
+# NumPy is optional. It is only needed for views() and arrays().
+from array import array
+from bisect import bisect_left, bisect_right
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NaN = float("nan")
+
+
+class _Timeline(object):
+    # Sequence view of the timestamps in logical (oldest first) order
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, n):
+        return self.history.timestamps[self.history._physical(n)]
+
+
+class SensorHistory(object):
+    """ Ring buffer of sensor samples backed by typed arrays.
+
+        Timestamps are stored as doubles and quantities as 32 bit floats.
+            Quantities missing from a sample are stored as NaN.
+            Timestamps are expected to be non-decreasing, which allows
+            time ranges to be found by binary search.
+
+        Once capacity samples are stored, each append overwrites
+            the oldest sample.
+    """
+    fields = ("temp", "humidity", "lux", "soil_moisture")
+
+    def __init__(self, capacity=8640, fields=None):
+        if capacity < 1:
+            raise HistoryError("History capacity must be at least 1")
+        self.capacity = capacity
+        self.fields = tuple(fields or SensorHistory.fields)
+        self.timestamps = array("d", [0.0]) * capacity
+        self.columns = dict((field, array("f", [NaN]) * capacity)
+                            for field in self.fields)
+        self._head = 0  # physical index of the next write
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _physical(self, n):
+        # Maps a logical index (0 = oldest sample) to an array index
+        return (self._head - self._count + n) % self.capacity
+
+    def append(self, timestamp, **values):
+        """ Stores a sample. Keywords name the quantities, for example
+                history.append(time(), temp=72.1, humidity=40.2)
+        """
+        i = self._head
+        self.timestamps[i] = timestamp
+        for field in self.fields:
+            value = values.get(field)
+            self.columns[field][i] = NaN if value is None else value
+        self._head = (i + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+
+    def latest(self):
+        """ Returns the newest sample as a dict, or None if empty.
+        """
+        if not self._count:
+            return None
+        i = self._physical(self._count - 1)
+        sample = dict((field, self.columns[field][i]) for field in self.fields)
+        sample["timestamp"] = self.timestamps[i]
+        return sample
+
+    def _range(self, start=None, end=None):
+        # Logical index range [first, last) of samples within start..end
+        timeline = _Timeline(self)
+        first = 0 if start is None else bisect_left(timeline, start)
+        last = self._count if end is None else bisect_right(timeline, end)
+        return first, max(first, last)
+
+    def _segments(self, first, last):
+        # Splits a logical range into at most two contiguous physical slices
+        if first == last:
+            return []
+        lo = self._physical(first)
+        hi = self._physical(last - 1) + 1
+        if lo < hi:
+            return [(lo, hi)]
+        return [(lo, self.capacity), (0, hi)]
+
+    def between(self, start=None, end=None):
+        """ Returns the samples with start <= timestamp <= end as a dict
+                of lists keyed by "timestamp" and each quantity.
+        """
+        segments = self._segments(*self._range(start, end))
+        result = {"timestamp": []}
+        for field in self.fields:
+            result[field] = []
+        for lo, hi in segments:
+            result["timestamp"].extend(self.timestamps[lo:hi])
+            for field in self.fields:
+                result[field].extend(self.columns[field][lo:hi])
+        return result
+
+    def views(self, start=None, end=None):
+        """ Returns zero-copy NumPy views of the samples within start..end.
+            Since the buffer wraps, this is a list of at most two dicts of
+                arrays (oldest first), each keyed like between().
+            The views share memory with the history and are overwritten
+                as new samples arrive.
+        """
+        if numpy is None:
+            raise HistoryError("NumPy is required for array views")
+        timestamps = numpy.frombuffer(self.timestamps, dtype=numpy.float64)
+        columns = dict((field, numpy.frombuffer(self.columns[field],
+                                                dtype=numpy.float32))
+                       for field in self.fields)
+        segments = []
+        for lo, hi in self._segments(*self._range(start, end)):
+            segment = {"timestamp": timestamps[lo:hi]}
+            for field in self.fields:
+                segment[field] = columns[field][lo:hi]
+            segments.append(segment)
+        return segments
+
+    def arrays(self, start=None, end=None):
+        """ Returns the samples within start..end as one dict of NumPy
+                arrays. These are views when the range does not wrap
+                around the end of the buffer and copies when it does.
+        """
+        segments = self.views(start, end)
+        if len(segments) == 1:
+            return segments[0]
+        keys = ("timestamp",) + self.fields
+        if not segments:
+            return dict((key, numpy.zeros(0)) for key in keys)
+        return dict((key, numpy.concatenate([seg[key] for seg in segments]))
+                    for key in keys)
+
+    def downsample(self, bucket, start=None, end=None):
+        """ Reduces the samples within start..end to buckets of
+                bucket seconds aligned to multiples of bucket.
+            Returns a list of (bucket_start, {quantity: (min, mean, max)})
+                in time order. NaN samples are ignored and a quantity with
+                no samples in a bucket is reported as None.
+        """
+        first, last = self._range(start, end)
+        buckets = []
+        current = None
+        stats = None
+        for n in range(first, last):
+            i = self._physical(n)
+            key = self.timestamps[i] // bucket * bucket
+            if key != current:
+                if current is not None:
+                    buckets.append((current, _summarize(stats)))
+                current = key
+                stats = dict((field, [None, 0.0, None, 0])
+                             for field in self.fields)
+            for field in self.fields:
+                value = self.columns[field][i]
+                if value != value:  # NaN
+                    continue
+                entry = stats[field]
+                entry[0] = value if entry[0] is None else min(entry[0], value)
+                entry[1] += value
+                entry[2] = value if entry[2] is None else max(entry[2], value)
+                entry[3] += 1
+        if current is not None:
+            buckets.append((current, _summarize(stats)))
+        return buckets
+
+
+def _summarize(stats):
+    summary = {}
+    for field, (low, total, high, samples) in stats.items():
+        if samples:
+            summary[field] = (low, total / samples, high)
+        else:
+            summary[field] = None
+    return summary
+
+
+class HistoryError(Exception):
+    pass
@@ -1,9 +1,38 @@
 #!/usr/bin/python
 # This file contains utility functions used to select
 # 	channels via the I2C Multiplexer or the ADC
+from time import sleep, time
+import threading
+from decode import adc_frames
+from instrument import instrumented, count_event
 
+# Bus priorities used when the bus is a broker.BusBroker (lowest first)
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 5
+PRIORITY_SENSOR = 10
 
-def TCA_select(bus, addr, channel):
+
+# Last control byte written to each mux, keyed by (bus_key(bus), address).
+# Muxes listed in _mux_suspect are read back on their next selection.
+_mux_state = {}
+_mux_suspect = set()
+mux_stats = {"writes": 0, "reads": 0, "avoided": 0}
+
+
+def bus_key(bus):
+    """ Returns the bus object that a wrapper such as a broker.BusBroker,
+            recorder.BusRecorder or instrument.InstrumentedBus (possibly
+            several, nested) ultimately talks to.
+        State kept about devices is keyed by it, so it is shared by every
+            handle on the same bus.
+    """
+    while getattr(bus, "bus", None) is not None:
+        bus = bus.bus
+    return bus
+
+
+@instrumented("TCA_select")
+def TCA_select(bus, addr, channel, verify=False):
     """
         This function will write to the control register of the
                 TCA module to select the channel that will be
@@ -14,6 +43,12 @@ def TCA_select(bus, addr, channel):
                 addr contains address of the TCA module
                 channel specifies the desired channel on the TCA that will be used.
 
+        The channel last written to each mux is remembered, so selecting
+                the channel that is already enabled costs no bus traffic.
+                The control register is only read back when verify is set
+                or after a transaction with that mux has failed.
+                Transactions saved this way are counted in mux_stats.
+
         Usage - Enable a channel
             TCA_select(bus, self.mux_addr, channel_to_enable)
                 Channel to enable begins at 0 (enables first channel)
@@ -29,54 +64,258 @@ def TCA_select(bus, addr, channel):
         print("The TCA address(" + str(addr) + ") is invalid. Aborting")
         return False
     if channel == "off":
-        bus.write_byte(addr, 0)
+        control = 0
     elif channel < 0 or channel > 3:
         print("The requested channel does not exist.")
         return False
     else:
-        bus.write_byte(addr, 1 << channel)
+        control = 1 << channel
 
-    status = bus.read_byte(addr)
-    return status
+    key = (bus_key(bus), addr)
+    with atomic(bus):
+        verify = verify or key in _mux_suspect
+        if _mux_state.get(key) == control and not verify:
+            mux_stats["avoided"] += 2
+            return control
 
+        try:
+            bus.write_byte(addr, control)
+            mux_stats["writes"] += 1
+            if verify:
+                status = bus.read_byte(addr)
+                mux_stats["reads"] += 1
+            else:
+                status = control
+                mux_stats["avoided"] += 1
+        except IOError:
+            invalidate_mux(bus, addr)
+            raise
+        _mux_state[key] = status
+        if status == control:
+            _mux_suspect.discard(key)
+        else:
+            _mux_suspect.add(key)
+        return status
 
-def get_ADC_value(bus, addr, channel):
+
+def mux_all_off(bus, addrs=()):
+    """ Switches off every mux in addrs and every mux with a cached
+            channel on bus, ignoring failures, and forgets their cached
+            channels so that the next TCA_select writes and verifies.
+        Used to recover when a mux could not be switched off normally.
+        Returns the addresses that could not be written.
+    """
+    key = bus_key(bus)
+    addrs = sorted(set(addrs) | set(mux for owner, mux in _mux_state
+                                    if owner is key))
+    failed = []
+    with atomic(bus):
+        for addr in addrs:
+            try:
+                bus.write_byte(addr, 0)
+            except IOError:
+                failed.append(addr)
+            invalidate_mux(bus, addr)
+    return failed
+
+
+def invalidate_mux(bus, addr=None):
+    """ Forgets the cached channel of a mux (or of every mux on the bus
+            if no address is given). The next TCA_select call will write
+            the control register and read it back.
+    """
+    bus = bus_key(bus)
+    for key in list(_mux_state):
+        if key[0] is bus and addr in (None, key[1]):
+            del _mux_state[key]
+            _mux_suspect.add(key)
+    if addr is not None:
+        _mux_suspect.add((bus, addr))
+
+
+@instrumented("get_ADC_value")
+def get_ADC_value(bus, addr, channel, mux=None):
     """
     This method selects a channel and initiates conversion
     The ADC operates at 240 SPS (12 bits) with 1x gain
         One shot conversions are used, meaning a wait period is needed
-        in order to acquire new data. This is done via a constant poll
-        of the ready bit.
+        in order to acquire new data. This is done by sleeping for the
+        conversion time before polling the ready bit.
     Upon completion, a voltage value is returned to the caller.
 
+    The conversion settings are those of the shared MCP342x driver
+        for the address, so other resolutions, gains or continuous
+        mode can be used by configuring MCP342x.get(bus, addr).
+    An ADC behind a multiplexer is given as mux=(mux address, channel),
+        see MCP342x.read.
+
     Usage - ADC_start(bus, SensorCluster.ADC_addr, channel_to_read)
 
     IMPORTANT NOTE:
         The ADC uses a 2.048V voltage reference
 
     """
-    if channel == 1:
-        INIT = 0b10000000
-    elif channel == 2:
-        INIT = 0b10100000
-    elif channel == 3:
-        INIT = 0b11000000
-    elif channel == 4:
-        INIT = 0b11100000
-    bus.write_byte(addr, INIT)
-    data = bus.read_i2c_block_data(addr, 0, 3)
-    status = (data[2] & 0b10000000) >> 7
-    while(status == 1):
-        data = bus.read_i2c_block_data(addr, 0, 3)
-        status = (data[2] & 0b10000000) >> 7
-    sign = data[0] & 0b00001000
-    val = ((data[0] & 0b0000111) << 8) | (data[1])
-    if (sign == 1):
-        val = (val ^ 0x3ff) + 1  # compute 2s complement for 12 bit val
-    # Convert val to a ratiomerical ADC reading
-    return float(val) * 2.048 / float(2047)
+    return MCP342x.get(bus, addr).read(channel, mux)
+
+
+class MCP342x(object):
+    """ Driver for the MCP3422/3/4 delta-sigma ADC.
+
+        resolution - 12, 14, 16 or 18 bits (240, 60, 15 or 3.75 SPS)
+        gain - PGA gain of 1, 2, 4 or 8
+        continuous - convert continuously instead of one-shot
+
+        A read sleeps for the conversion time before polling the ready
+            bit instead of spinning on the bus. In continuous mode the
+            channel is only configured when it changes, after which each
+            read returns the next new conversion.
+
+        ADCs behind a multiplexer share one driver per address, so
+            continuous mode is only meaningful for ADCs on the main bus.
+
+        The bus is released while a conversion runs. Reads through one
+            driver are serialized so that they cannot restart each
+            other's conversions.
+
+        One driver exists per bus and address:
+            adc = MCP342x.get(bus, 0x6c)
+            adc.configure(resolution=16)
+            volts = adc.read(1)
+    """
+    sample_rates = {12: 240.0, 14: 60.0, 16: 15.0, 18: 3.75}
+    rate_bits = {12: 0b00, 14: 0b01, 16: 0b10, 18: 0b11}
+    gain_bits = {1: 0b00, 2: 0b01, 4: 0b10, 8: 0b11}
+    vref = 2.048
+    poll_interval = .0005  # seconds between ready polls once due
+    timeout = 5  # conversion times to wait before giving up
+    _instances = {}
+
+    @classmethod
+    def get(cls, bus, addr):
+        """ Returns the driver for the ADC at addr on bus.
+        """
+        key = (bus, addr)
+        if key not in cls._instances:
+            cls._instances[key] = cls(bus, addr)
+        return cls._instances[key]
+
+    def __init__(self, bus, addr, resolution=12, gain=1, continuous=False):
+        self.bus = bus
+        self.addr = addr
+        self._channel = None  # channel the device is converting
+        self._due = 0  # time the next conversion result is expected
+        self._lock = threading.RLock()  # held for a whole read
+        self.configure(resolution, gain, continuous)
+
+    def configure(self, resolution=None, gain=None, continuous=None):
+        """ Changes the conversion settings. Omitted settings are kept.
+        """
+        if resolution is not None:
+            if resolution not in MCP342x.sample_rates:
+                raise InvalidIOUsage(
+                    "Unsupported ADC resolution: " + str(resolution))
+            self.resolution = resolution
+        if gain is not None:
+            if gain not in MCP342x.gain_bits:
+                raise InvalidIOUsage("Unsupported ADC gain: " + str(gain))
+            self.gain = gain
+        if continuous is not None:
+            self.continuous = continuous
+        self._channel = None  # settings take effect on the next write
+
+    def conversion_time(self):
+        return 1.0 / MCP342x.sample_rates[self.resolution]
+
+    def config_byte(self, channel):
+        if channel < 1 or channel > 4:
+            raise InvalidIOUsage("ADC channels are numbered 1 to 4")
+        return (0b10000000 | (channel - 1) << 5 |
+                (0b10000 if self.continuous else 0) |
+                MCP342x.rate_bits[self.resolution] << 2 |
+                MCP342x.gain_bits[self.gain])
+
+    def start(self, channel):
+        """ Starts a conversion (or continuous conversions) on channel.
+        """
+        self.bus.write_byte(self.addr, self.config_byte(channel))
+        self._channel = channel
 
+    def poll(self):
+        """ Reads the output register once.
+            Returns the voltage, or None if no new conversion is ready.
+        """
+        width = 3 if self.resolution == 18 else 2
+        data = self.bus.read_i2c_block_data(self.addr, 0, width + 1)
+        if data[width] & 0b10000000:
+            return None
+        return self.decode(data[:width])
 
+    def decode(self, data):
+        """ Converts the output bytes to a voltage at the ADC input.
+        """
+        return adc_frames(data, self.resolution, self.gain, MCP342x.vref)
+
+    def collect(self):
+        """ Waits for the conversion in progress and returns its voltage.
+            Polls at poll_interval, so call it once the conversion time
+                has elapsed to avoid polling traffic.
+        """
+        deadline = time() + self.timeout * self.conversion_time()
+        while True:
+            value = self.poll()
+            if value is not None:
+                return value
+            count_event("adc_not_ready")
+            if time() > deadline:
+                raise ADCTimeout("ADC " + hex(self.addr) +
+                                 " did not complete a conversion")
+            bus_sleep(self.bus, MCP342x.poll_interval)
+
+    def read(self, channel, mux=None):
+        """ Converts channel and returns the voltage.
+            The bus is only held to start the conversion and to collect
+                it. For an ADC behind a multiplexer, mux is the
+                (mux address, mux channel) to select for each of the two;
+                the mux is switched off again before the bus is released.
+        """
+        with self._lock:
+            with atomic(self.bus):
+                if mux is not None:
+                    TCA_select(self.bus, mux[0], mux[1])
+                try:
+                    if not (self.continuous and self._channel == channel):
+                        self.start(channel)
+                        self._due = time() + self.conversion_time()
+                finally:
+                    if mux is not None:
+                        TCA_select(self.bus, mux[0], "off")
+            bus_sleep(self.bus, self._due - time())
+            with atomic(self.bus):
+                if mux is not None:
+                    TCA_select(self.bus, mux[0], mux[1])
+                try:
+                    value = self.collect()
+                finally:
+                    if mux is not None:
+                        TCA_select(self.bus, mux[0], "off")
+            # In continuous mode the next result is one conversion away
+            self._due = time() + self.conversion_time()
+            return value
+
+    def read_channels(self, channels, mux=None):
+        """ Reads several channels back to back and returns their voltages.
+        """
+        with self._lock:
+            return [self.read(channel, mux) for channel in channels]
+
+    def read_samples(self, channel, count, mux=None):
+        """ Returns count successive conversions of channel.
+        """
+        with self._lock:
+            return [self.read(channel, mux) for sample in range(count)]
+
+
+@instrumented("IO_expander_output")
 def IO_expander_output(bus, addr, bank, mask):
     """
     Method for controlling the GPIO expander via I2C
@@ -87,44 +326,173 @@ def IO_expander_output(bus, addr, bank, mask):
         in sequential mode. If this mode is not used,
         the register addresses will need to be changed.
 
+    Register contents are tracked by the IOExpander driver, so
+        only a change of mask results in bus traffic.
+
     Usage:
     GPIO_out(bus, GPIO_addr, 0, 0b00011111)
         This call would turn on A0 through A4. 
 
     """
-    IODIR_map = [0x00, 0x01]
-    output_map = [0x14, 0x15]
+    return IOExpander.get(bus, addr).output(bank, mask)
 
-    if (bank != 0) and (bank != 1):
-        print()
-        raise InvalidIOUsage("An invalid IO bank has been selected")
+@instrumented("get_IO_reg")
+def get_IO_reg(bus, addr, bank):
+    """
+    Method retrieves the register corresponding to respective bank (0 or 1)
+        The value is served from the IOExpander shadow registers.
+    """
+    return IOExpander.get(bus, addr).read(bank)
 
 
-    IO_direction = IODIR_map[bank]
-    output_reg = output_map[bank]
+class _ExpanderShadow(object):
+    # Shadow registers of one expander, shared by its drivers
+    __slots__ = ("iodir", "gpio", "olat", "synced")
 
-    current_status = bus.read_byte_data(addr, output_reg)
-    if current_status == mask:
-        # This means nothing needs to happen
-        print("Current control status matches requested controls. " +
-              "No action is required.")
-        return True
+    def __init__(self):
+        self.iodir = [None, None]
+        self.gpio = [None, None]
+        self.olat = [None, None]
+        self.synced = None  # time of the last resync
 
-    bus.write_byte_data(addr, IO_direction, 0)
-    bus.write_byte_data(addr, output_reg, mask)
 
-def get_IO_reg(bus, addr, bank):
-    """
-    Method retrieves the register corresponding to respective bank (0 or 1)
+class IOExpander(object):
+    """ Driver for the MCP23017 IO expander.
+
+        Shadow copies of the IODIR, GPIO and OLAT registers are kept
+            for both banks. Direction is configured once, reads are
+            served from the shadow copy and an output write is only
+            sent when the requested mask differs from the latch.
+
+        The shadow copy is loaded from the hardware on first use,
+            after a failed transaction and, if resync_interval is set,
+            whenever it is older than resync_interval seconds.
+        It is kept per physical bus (see bus_key), so drivers reached
+            through wrappers of the same bus (a broker, a recorder or an
+            instrumented bus) share it and never write from stale data.
+            Two separate SMBus handles on one bus are not recognized as
+            the same bus; open each bus once.
+
+        One driver exists per bus handle and address:
+            expander = IOExpander.get(bus, 0x20)
+            expander.output(0, 0b00011100)
     """
-    output_map = [0x14, 0x15]
-    if (bank != 0) and (bank != 1):
-        print()
-        raise InvalidIOUsage("An invalid IO bank has been selected")
+    IODIR = [0x00, 0x01]
+    GPIO = [0x12, 0x13]
+    OLAT = [0x14, 0x15]
+    resync_interval = None  # seconds, None disables periodic resyncs
+    _instances = {}
+    _shadows = {}  # {(bus_key(bus), addr): _ExpanderShadow}
+
+    @classmethod
+    def get(cls, bus, addr):
+        """ Returns the driver for the expander at addr on bus.
+        """
+        key = (bus, addr)
+        if key not in cls._instances:
+            cls._instances[key] = cls(bus, addr)
+        return cls._instances[key]
+
+    def __init__(self, bus, addr, direction=(0x00, 0x00)):
+        self.bus = bus
+        self.addr = addr
+        self.direction = list(direction)  # requested IODIR, 0 = output
+        key = (bus_key(bus), addr)
+        if key not in IOExpander._shadows:
+            IOExpander._shadows[key] = _ExpanderShadow()
+        self.shadow = IOExpander._shadows[key]
+
+    def resync(self):
+        """ Reloads the shadow registers of both banks from the expander.
+            Sequential mode allows this in two block reads.
+        """
+        try:
+            with atomic(self.bus):
+                self.shadow.iodir = self.bus.read_i2c_block_data(
+                    self.addr, IOExpander.IODIR[0], 2)
+                data = self.bus.read_i2c_block_data(
+                    self.addr, IOExpander.GPIO[0], 4)
+        except IOError:
+            self.invalidate()
+            raise
+        self.shadow.gpio = data[0:2]
+        self.shadow.olat = data[2:4]
+        self.shadow.synced = time()
+
+    def invalidate(self):
+        """ Discards the shadow copy so the next access resyncs.
+        """
+        self.shadow.synced = None
+
+    def _check_bank(self, bank):
+        if (bank != 0) and (bank != 1):
+            raise InvalidIOUsage("An invalid IO bank has been selected")
+
+    def _refresh(self):
+        interval = self.resync_interval
+        if self.shadow.synced is None or (
+                interval is not None and time() - self.shadow.synced > interval):
+            self.resync()
+
+    def read(self, bank):
+        """ Returns the output latch of bank (0 or 1).
+        """
+        self._check_bank(bank)
+        self._refresh()
+        return self.shadow.olat[bank]
+
+    def output(self, bank, mask):
+        """ Drives mask onto the pins of bank (0 or 1).
+            Returns True if the latch already held mask.
+        """
+        self._check_bank(bank)
+        with atomic(self.bus):
+            self._refresh()
+            try:
+                if self.shadow.iodir[bank] != self.direction[bank]:
+                    self.bus.write_byte_data(self.addr, IOExpander.IODIR[bank],
+                                             self.direction[bank])
+                    self.shadow.iodir[bank] = self.direction[bank]
+                if self.shadow.olat[bank] == mask:
+                    # This means nothing needs to happen
+                    return True
+                self.bus.write_byte_data(self.addr, IOExpander.OLAT[bank], mask)
+            except IOError:
+                self.invalidate()
+                raise
+            self.shadow.olat[bank] = mask
+            self.shadow.gpio[bank] = ((self.shadow.gpio[bank] & self.shadow.iodir[bank]) |
+                               (mask & ~self.shadow.iodir[bank] & 0xff))
+
+    def output_banks(self, masks, owned=(0xff, 0xff)):
+        """ Drives masks[0] onto bank A and masks[1] onto bank B
+                using one sequential block write starting at GPIOA.
+            Only the bits set in owned are taken from masks; the others
+                keep their current latch value.
+            Returns True if both latches already held the result.
+        """
+        with atomic(self.bus):
+            self._refresh()
+            latch = [(self.shadow.olat[bank] & ~owned[bank] & 0xff) |
+                     (masks[bank] & owned[bank]) for bank in (0, 1)]
+            try:
+                if self.shadow.iodir != self.direction:
+                    self.bus.write_i2c_block_data(
+                        self.addr, IOExpander.IODIR[0], self.direction)
+                    self.shadow.iodir = list(self.direction)
+                if self.shadow.olat == latch:
+                    return True
+                # Writes to GPIOA/GPIOB land in the output latches
+                self.bus.write_i2c_block_data(
+                    self.addr, IOExpander.GPIO[0], latch)
+            except IOError:
+                self.invalidate()
+                raise
+            self.shadow.olat = latch
+            self.shadow.gpio = [(self.shadow.gpio[bank] & self.shadow.iodir[bank]) |
+                         (latch[bank] & ~self.shadow.iodir[bank] & 0xff)
+                         for bank in (0, 1)]
 
-    output_reg = output_map[bank]
-    current_status = bus.read_byte_data(addr, output_reg)
-    return current_status
 
 def import_i2c_addr(bus, opt="sensors"):
     """ import_i2c_addresses will return a list of the
@@ -135,30 +503,70 @@ def import_i2c_addr(bus, opt="sensors"):
         Modules are between int(112) and int(119)
 
         By default, the method will return a list
-            of sensor addresses.
+            of sensor addresses, probing only that range.
+            Any other opt probes all 128 addresses.
+            (topology.I2CTopology caches the result of a scan.)
     """
 
+    if opt == "sensors":
+        addresses = range(112, 120)
+    else:
+        addresses = range(128)
+
     i2c_list = []
-    for device in range(128):
+    for device in addresses:
         try:
             bus.read_byte(device)
             i2c_list.append((device))
         except IOError:
             pass
 
-    if opt == "sensors":
-        sensor_list = []
-        for module in range(112,120):
-            try:
-                indx = i2c_list.index(module)
-                sensor_list.append(module)
-            except ValueError:
-                pass
-        return sensor_list
+    return i2c_list
 
-    else:
-        return i2c_list
+
+class _Unlocked(object):
+    # Stands in for a broker hold when the bus is a plain SMBus
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_unlocked = _Unlocked()
+
+
+def atomic(bus, priority=PRIORITY_NORMAL):
+    """ Groups the bus transactions made inside a with block into one
+            atomic unit when bus is a broker.BusBroker.
+            For a plain SMBus nothing is locked.
+
+        Usage:
+            with atomic(bus, PRIORITY_SENSOR):
+                TCA_select(bus, mux_addr, channel)
+                data = bus.read_i2c_block_data(addr, 0, 4)
+                TCA_select(bus, mux_addr, "off")
+    """
+    if hasattr(bus, "atomic"):
+        return bus.atomic(priority)
+    return _unlocked
+
+
+def bus_sleep(bus, seconds):
+    """ Waits seconds (if positive) for a conversion or settling time.
+        A bus object may take over the wait by providing sleep(seconds);
+            recorder.ReplayBus uses this to replay a log without waiting.
+            Otherwise time.sleep is used.
+    """
+    if seconds > 0:
+        getattr(bus, "sleep", sleep)(seconds)
 
 
 class InvalidIOUsage(Exception):
+    pass
+
+
+class ADCTimeout(IOError):
+    """ The ADC did not report a completed conversion in time.
+    """
     pass
\ No newline at end of file
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+
+# Contains the optional instrumentation of the sensor and bus hot paths.
+# The mux, ADC and expander helpers and the SensorCluster update methods
+#   are wrapped with instrumented(). While instrumentation is disabled
+#   (the default) a wrapped call costs a single flag check. Once enabled,
+#   each call records its count, errors and latency per operation and
+#   per cluster ID.
+# InstrumentedBus wraps the bus itself to add the SMBus transactions
+#   and the bytes they carry, attributed to the cluster being updated.
+# Basic usage (wrap the bus once and give the same instance to both
+#   cluster classes):
+#   instrument.enable()
+#   bus = instrument.InstrumentedBus(smbus.SMBus(1))
+#   SensorCluster.bus = ControlCluster.bus = bus
+#   SensorCluster.update_all_sensors()
+#   instrument.snapshot()["ops"]["TCA_select"]
+#   instrument.start_dump(60, open("stats.log", "a"))  # JSON line a minute
+import json
+import sys
+import threading
+from functools import wraps
+from time import time
+
+HISTOGRAM_BUCKETS = 32  # log2 microsecond buckets, the last is open ended
+
+_enabled = False
+_lock = threading.Lock()
+_stats = {}  # {(operation, cluster ID): OpStats}
+_local = threading.local()
+_dump = None
+
+
+class OpStats(object):
+    """ Counters for one operation (for one cluster).
+        histogram[n] counts calls that took less than 2**n microseconds
+            (and at least 2**(n-1)).
+    """
+    __slots__ = ("count", "errors", "bytes", "total", "max", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, elapsed, error=False, nbytes=0):
+        self.count += 1
+        self.errors += error
+        self.bytes += nbytes
+        if elapsed is not None:
+            self.total += elapsed
+            if elapsed > self.max:
+                self.max = elapsed
+            bucket = int(elapsed * 1e6).bit_length()
+            self.histogram[min(bucket, HISTOGRAM_BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for n, calls in enumerate(other.histogram):
+            self.histogram[n] += calls
+
+    def summary(self):
+        return {"count": self.count,
+                "errors": self.errors,
+                "bytes": self.bytes,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                # upper bound in microseconds: calls
+                "histogram": dict((2**n, calls) for n, calls
+                                  in enumerate(self.histogram) if calls)}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def current_cluster():
+    """ ID of the cluster the calling thread is updating, if any.
+    """
+    return getattr(_local, "cluster", None)
+
+
+def record(operation, elapsed=None, error=False, nbytes=0, cluster=None):
+    """ Adds one call of operation to the statistics.
+        elapsed=None records a counted event without a latency.
+    """
+    if cluster is None:
+        cluster = getattr(_local, "cluster", None)
+    key = (operation, cluster)
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = OpStats()
+        stats.add(elapsed, error, nbytes)
+
+
+def count_event(operation):
+    """ Counts an event such as a retry, if instrumentation is enabled.
+    """
+    if _enabled:
+        record(operation)
+
+
+def instrumented(operation, owner=False):
+    """ Decorator that records each call of a function as operation.
+        With owner=True the first argument's ID (a SensorCluster) is
+            taken as the cluster for this call and everything it calls.
+    """
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            previous = getattr(_local, "cluster", None)
+            cluster = previous
+            if owner and args:
+                cluster = getattr(args[0], "ID", None)
+                if cluster is None:
+                    cluster = previous
+                _local.cluster = cluster
+            error = False
+            start = time()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                record(operation, time() - start, error, cluster=cluster)
+                _local.cluster = previous
+        return wrapper
+    return decorate
+
+
+def snapshot(reset_after=False):
+    """ Returns the statistics as
+            {"ops": {operation: summary},
+             "clusters": {ID: {operation: summary}},
+             "time": snapshot time}
+            where "ops" totals every cluster. See OpStats.summary.
+    """
+    with _lock:
+        items = list(_stats.items())
+        if reset_after:
+            _stats.clear()
+    totals = {}
+    clusters = {}
+    for (operation, cluster), stats in items:
+        if operation not in totals:
+            totals[operation] = OpStats()
+        totals[operation].merge(stats)
+        if cluster is not None:
+            clusters.setdefault(cluster, {})[operation] = stats.summary()
+    return {"ops": dict((operation, stats.summary())
+                        for operation, stats in totals.items()),
+            "clusters": clusters,
+            "time": time()}
+
+
+def start_dump(interval, stream=None, reset_after=False):
+    """ Writes a JSON snapshot line to stream (stdout by default) every
+            interval seconds on a background thread.
+    """
+    global _dump
+    stop_dump()
+    stop = threading.Event()
+
+    def dump_loop():
+        while not stop.wait(interval):
+            out = stream or sys.stdout
+            out.write(json.dumps(snapshot(reset_after), sort_keys=True))
+            out.write("\n")
+            out.flush()
+
+    thread = threading.Thread(target=dump_loop)
+    thread.daemon = True
+    thread.start()
+    _dump = (thread, stop)
+    return thread
+
+
+def stop_dump():
+    global _dump
+    if _dump is not None:
+        thread, stop = _dump
+        stop.set()
+        thread.join()
+        _dump = None
+
+
+class InstrumentedBus(object):
+    """ Wraps a bus and records every SMBus transaction as
+            "bus.<method>" with the data bytes it carried (the command
+            or register byte included, device addresses excluded).
+        Other attributes are passed through to the wrapped bus.
+    """
+    def __init__(self, bus):
+        self.bus = bus
+
+    def _call(self, name, nbytes, *args):
+        method = getattr(self.bus, name)
+        if not _enabled:
+            return method(*args)
+        start = time()
+        error = False
+        try:
+            result = method(*args)
+        except Exception:
+            error = True
+            raise
+        finally:
+            record("bus." + name, time() - start, error, nbytes)
+        return result
+
+    def write_quick(self, addr):
+        return self._call("write_quick", 0, addr)
+
+    def read_byte(self, addr):
+        return self._call("read_byte", 1, addr)
+
+    def write_byte(self, addr, value):
+        return self._call("write_byte", 1, addr, value)
+
+    def read_byte_data(self, addr, cmd):
+        return self._call("read_byte_data", 2, addr, cmd)
+
+    def write_byte_data(self, addr, cmd, value):
+        return self._call("write_byte_data", 2, addr, cmd, value)
+
+    def read_word_data(self, addr, cmd):
+        return self._call("read_word_data", 3, addr, cmd)
+
+    def write_word_data(self, addr, cmd, value):
+        return self._call("write_word_data", 3, addr, cmd, value)
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        return self._call("read_i2c_block_data", length + 1,
+                          addr, cmd, length)
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        return self._call("write_i2c_block_data", len(vals) + 1,
+                          addr, cmd, vals)
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
@@ -0,0 +1,361 @@
+#!/usr/bin/python
+
+# Contains the program engine that drives ControlCluster outputs on a
+#   schedule: daily light windows, valve and pump pulse trains, and fan
+#   duty cycles.
+# Each program produces its on/off transitions in time order. The engine
+#   keeps the next transition of every program in a timer wheel, sleeps
+#   until the earliest one, and stages every transition due at that
+#   instant before a single ControlCluster.commit().
+# Basic usage:
+#   engine = ProgramEngine()
+#   engine.add(LightWindow(plant1Control, "06:00", "22:00"))
+#   engine.add(PulseTrain(plant1Control, on_for=2, every=900))
+#   engine.add(DutyCycle(plant1Control, duty=.25, period=600))
+#   engine.start()
+#   ...
+#   engine.stop()
+import threading
+from math import floor
+from time import localtime, mktime, time
+from control import ControlCluster
+
+DAY = 86400
+
+
+def _seconds(value):
+    # Seconds after midnight for "HH:MM[:SS]" or a number of seconds
+    if isinstance(value, str):
+        parts = [int(part) for part in value.split(":")]
+        if not 2 <= len(parts) <= 3:
+            raise ProgramError("Invalid time of day: " + value)
+        parts += [0] * (3 - len(parts))
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return value
+
+
+class TimerWheel(object):
+    """ Hashed timing wheel of timed items.
+
+        Time is divided into ticks of tick seconds and each item is
+            stored in the slot of its tick, modulo the number of slots.
+            Adding an item and expiring a tick cost O(1) per item,
+            however many items are pending; items more than one turn
+            of the wheel ahead are passed over until their turn comes.
+        Items due in the same tick expire together.
+    """
+    def __init__(self, tick=.01, slots=512):
+        self.tick = tick
+        self.slots = [[] for slot in range(slots)]
+        self.count = 0
+        self._cursor = int(time() / tick)  # first tick not yet expired
+
+    def add(self, when, item):
+        # Items in the past are due in the next tick to expire
+        ticks = max(int(when / self.tick), self._cursor)
+        self.slots[ticks % len(self.slots)].append((ticks, when, item))
+        self.count += 1
+
+    def expire(self, now):
+        """ Removes and returns [(when, item)] for every item due by now.
+        """
+        last = int(now / self.tick)
+        expired = []
+        # A full turn of the wheel visits every slot
+        end = min(last + 1, self._cursor + len(self.slots))
+        for ticks in range(self._cursor, end):
+            slot = self.slots[ticks % len(self.slots)]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                if entry[0] <= last:
+                    expired.append(entry[1:])
+                else:
+                    keep.append(entry)
+            self.slots[ticks % len(self.slots)] = keep
+        self._cursor = max(self._cursor, last + 1)
+        self.count -= len(expired)
+        return expired
+
+    def next_due(self):
+        """ Returns the time the next item falls due, or None.
+            Items are never reported earlier than the start of their tick.
+        """
+        if not self.count:
+            return None
+        size = len(self.slots)
+        for ticks in range(self._cursor, self._cursor + size):
+            due = [max(when, ticks * self.tick)
+                   for entry_ticks, when, item in self.slots[ticks % size]
+                   if entry_ticks == ticks]
+            if due:
+                return min(due)
+        # Everything is at least a turn of the wheel away
+        return min(max(when, ticks * self.tick)
+                   for slot in self.slots for ticks, when, item in slot)
+
+
+class Program(object):
+    """ Base class of the schedules run by ProgramEngine.
+
+        A program switches controls of one ControlCluster together.
+            transitions(after) yields (time, on) pairs in time order for
+            every change after the given time; span is how far back the
+            transitions must start to tell the state at a given time.
+    """
+    span = DAY
+
+    def __init__(self, cluster, controls):
+        if isinstance(controls, str):
+            controls = (controls,)
+        for control in controls:
+            if control not in ControlCluster.control_bits:
+                raise ProgramError("Unknown control: " + str(control))
+        self.cluster = cluster
+        self.controls = tuple(controls)
+        self.active = True
+
+    def transitions(self, after):
+        raise NotImplementedError
+
+    def state_at(self, when):
+        """ True if the program's controls are on at the given time.
+        """
+        state = False
+        for at, on in self.transitions(when - self.span):
+            if at > when:
+                break
+            state = on
+        return state
+
+
+class LightWindow(Program):
+    """ Switches control (the light by default) on at on_at and off at
+            off_at every day, in local time. Times are "HH:MM", "HH:MM:SS"
+            or seconds after midnight; a window may span midnight.
+    """
+    def __init__(self, cluster, on_at, off_at, control="light"):
+        Program.__init__(self, cluster, control)
+        self.on_at = _seconds(on_at)
+        self.off_at = _seconds(off_at)
+        if not 0 <= self.on_at < DAY or not 0 <= self.off_at < DAY:
+            raise ProgramError("Light window times must be within a day")
+
+    def transitions(self, after):
+        today = localtime(after)
+        day = 0
+        while True:
+            changes = []
+            for seconds, on in ((self.on_at, True), (self.off_at, False)):
+                # mktime normalizes the day and seconds and applies DST
+                at = mktime((today.tm_year, today.tm_mon, today.tm_mday + day,
+                             0, 0, int(seconds), 0, 0, -1))
+                changes.append((at + seconds % 1, on))
+            for at, on in sorted(changes):
+                if at > after:
+                    yield at, on
+            day += 1
+
+
+class PulseTrain(Program):
+    """ Switches controls (the valve and the pump by default) on for
+            on_for seconds every every seconds, from start (now by
+            default) for count pulses (forever by default).
+        Because the pump is shared, it stays on while any cluster's
+            pulse is in progress.
+    """
+    def __init__(self, cluster, on_for, every, controls=("valve", "pump"),
+                 start=None, count=None):
+        Program.__init__(self, cluster, controls)
+        if not 0 <= on_for <= every or every <= 0:
+            raise ProgramError("A pulse must fit within its period")
+        self.on_for = on_for
+        self.every = every
+        self.start = time() if start is None else start
+        self.count = count
+
+    def state_at(self, when):
+        if when < self.start:
+            return False
+        n = int(floor((when - self.start) / self.every))
+        if self.count is not None and n >= self.count:
+            return False
+        return when - self.start - n * self.every < self.on_for
+
+    def transitions(self, after):
+        if not self.on_for:
+            return
+        if self.on_for == self.every:
+            # Always on while the train lasts
+            if self.start > after:
+                yield self.start, True
+            if self.count is not None:
+                end = self.start + self.count * self.every
+                if end > after:
+                    yield end, False
+            return
+        n = max(int(floor((after - self.start) / self.every)), 0)
+        while self.count is None or n < self.count:
+            begin = self.start + n * self.every
+            if begin > after:
+                yield begin, True
+            if begin + self.on_for > after:
+                yield begin + self.on_for, False
+            n += 1
+
+
+class DutyCycle(PulseTrain):
+    """ Keeps control (the fan by default) on for a fraction duty of
+            every period seconds.
+    """
+    def __init__(self, cluster, duty, period=600, control="fan",
+                 start=None):
+        if not 0 <= duty <= 1:
+            raise ProgramError("Duty cycle must be between 0 and 1")
+        PulseTrain.__init__(self, cluster, duty * period, period,
+                            control, start)
+        self.duty = duty
+
+
+class ProgramEngine(object):
+    """ Runs programs against their ControlClusters.
+
+        The next transition of each program is kept in a TimerWheel. The
+            engine sleeps until the earliest transition (no polling), then
+            stages every transition due by then and writes them with one
+            ControlCluster.commit(), which only touches the expanders
+            that changed. Transitions within one tick (tick seconds) of
+            each other are therefore applied together.
+
+        A program added to the engine first sets its controls to the
+            state it would have now, e.g. lights on in the middle of
+            their window. A failed commit is retried after
+            retry_interval seconds; the staged outputs are kept.
+    """
+    retry_interval = .5
+
+    def __init__(self, tick=.01, slots=512):
+        self.wheel = TimerWheel(tick, slots)
+        self.programs = []
+        self.commits = 0
+        self.transitions = 0
+        self.errors = 0
+        self.max_lateness = 0.0
+        self._lock = threading.Lock()
+        self._stale = False  # staged changes waiting for a commit
+        self._retry_at = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, program, now=None):
+        """ Adds program, stages its current state and schedules its
+                next transition. Returns the program.
+        """
+        if now is None:
+            now = time()
+        with self._lock:
+            self._stage(program, program.state_at(now))
+            self._schedule(program, program.transitions(now))
+            self.programs.append(program)
+        self._wake.set()
+        return program
+
+    def remove(self, program):
+        """ Stops program; its controls keep their current state.
+        """
+        program.active = False
+        self.programs.remove(program)
+
+    def _schedule(self, program, transitions):
+        for at, on in transitions:
+            self.wheel.add(at, (program, transitions, on))
+            return
+
+    def _stage(self, program, on):
+        if on:
+            program.cluster.stage(on=program.controls)
+        else:
+            program.cluster.stage(off=program.controls)
+        self._stale = True
+
+    def run_pending(self, now=None):
+        """ Applies every transition due by now with a single commit.
+            Returns the number of transitions applied.
+        """
+        if now is None:
+            now = time()
+        applied = 0
+        with self._lock:
+            for at, (program, transitions, on) in sorted(
+                    self.wheel.expire(now), key=lambda entry: entry[0]):
+                if not program.active:
+                    continue
+                self.max_lateness = max(self.max_lateness, now - at)
+                self._stage(program, on)
+                self._schedule(program, transitions)
+                applied += 1
+            self.transitions += applied
+            commit = self._stale and (applied or self._retry_at is None or
+                                      now >= self._retry_at)
+            if commit:
+                self._stale = False
+        if commit:
+            try:
+                ControlCluster.throttle()
+                ControlCluster.commit()
+                self.commits += 1
+                self._retry_at = None
+            except IOError:
+                # The expanders stay marked for the next commit
+                self.errors += 1
+                self._stale = True
+                self._retry_at = time() + self.retry_interval
+        return applied
+
+    def next_wake(self):
+        """ Returns the time of the next transition or commit retry,
+                or None if there is nothing to do.
+        """
+        with self._lock:
+            due = self.wheel.next_due()
+        if self._stale:
+            retry = self._retry_at or time()
+            due = retry if due is None else min(due, retry)
+        return due
+
+    def run(self):
+        """ Applies transitions as they fall due until stop() is called.
+        """
+        self._stop.clear()
+        while not self._stop.is_set():
+            self._wake.clear()
+            due = self.next_wake()
+            if due is None:
+                self._wake.wait()
+                due = 0
+            elif due > time() and self._wake.wait(due - time()):
+                due = 0  # woken early by add() or stop()
+            if not self._stop.is_set():
+                # A timed out wait may return a moment short of due
+                self.run_pending(max(time(), due))
+
+    def start(self):
+        """ Runs the engine on a background thread.
+        """
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class ProgramError(Exception):
+    pass
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+
+# Contains a recorder for bus transactions and a bus that replays them.
+# BusRecorder wraps an SMBus (or anything used as SensorCluster.bus /
+#   ControlCluster.bus) and appends every transaction to a memory-mapped
+#   binary log. ReplayBus feeds a log back to the unmodified driver code,
+#   either as fast as possible or at the recorded pace.
+# Basic usage:
+#   bus = BusRecorder(smbus.SMBus(1), "/var/log/greenhouse/bus.log")
+#   SensorCluster.bus = ControlCluster.bus = bus
+#   ...
+#   bus.close()
+#
+#   SensorCluster.bus = ControlCluster.bus = ReplayBus("bus.log")
+#   SensorCluster(ID=1).update_instance_sensors()   # no waits, no hardware
+# Record on a fresh bus object (the mux and expander caches are kept per
+#   bus), and replay the same sequence of calls that was recorded.
+#
+# Log format (little endian):
+#   header: 8s magic, I version, I record size, Q record count, 8x
+#   record: d timestamp, B op, B address, B register, B payload length,
+#           B flags, 3x, 32s payload
+import mmap
+import struct
+import threading
+from collections import namedtuple
+from time import sleep, time
+from i2c_utility import bus_sleep
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"GHBUSLOG"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ8x")
+RECORD = struct.Struct("<dBBBBB3x32s")
+FLAG_ERROR = 0x01
+
+# Operation codes, in SMBus method order
+OPS = ("write_quick", "read_byte", "write_byte",
+       "read_byte_data", "write_byte_data",
+       "read_word_data", "write_word_data",
+       "read_i2c_block_data", "write_i2c_block_data")
+OP_CODES = dict((name, code) for code, name in enumerate(OPS))
+
+BusRecord = namedtuple("BusRecord",
+                       "timestamp op addr reg payload error")
+
+
+class BusLog(object):
+    """ Read-only view of a bus log.
+        Records are decoded on access, so opening a large log is cheap.
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        magic, version, size, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or size != RECORD.size:
+            raise ReplayError("Not a bus log: " + str(path))
+        if version != VERSION:
+            raise ReplayError("Unsupported bus log version " + str(version))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.count
+        if not 0 <= n < self.count:
+            raise IndexError("bus log index out of range")
+        timestamp, op, addr, reg, length, flags, payload = \
+            RECORD.unpack_from(self._map, HEADER.size + n * RECORD.size)
+        return BusRecord(timestamp, OPS[op], addr, reg,
+                         list(bytearray(payload[:length])),
+                         bool(flags & FLAG_ERROR))
+
+    def __iter__(self):
+        for n in range(self.count):
+            yield self[n]
+
+    def array(self):
+        """ Returns the records as a NumPy structured array (no copy).
+        """
+        if numpy is None:
+            raise ReplayError("NumPy is required for array access")
+        dtype = numpy.dtype([("timestamp", "<f8"), ("op", "u1"),
+                             ("addr", "u1"), ("reg", "u1"),
+                             ("length", "u1"), ("flags", "u1"),
+                             ("pad", "V3"), ("payload", "u1", (32,))])
+        return numpy.frombuffer(self._map, dtype=dtype, count=self.count,
+                                offset=HEADER.size)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class BusRecorder(object):
+    """ Wraps a bus and logs every transaction to path.
+
+        Each record holds the time the transaction completed, the
+            operation, device address, register (0 if none) and payload:
+            the bytes written, or the bytes returned by a read. Failed
+            transactions are logged with the error flag and re-raised.
+        The log grows by capacity records at a time.
+        Other attributes are taken from the wrapped bus, so wrapping a
+            BusBroker keeps its atomic blocks.
+    """
+    def __init__(self, bus, path, capacity=65536):
+        self.bus = bus
+        self.path = path
+        self.capacity = capacity
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, "w+b")
+        self._allocate(capacity)
+
+    def _allocate(self, records):
+        # Sizes the file for records entries and maps it
+        self._file.truncate(HEADER.size + records * RECORD.size)
+        self._file.flush()
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._limit = records
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size,
+                         self.count)
+
+    def _append(self, op, addr, reg, payload, error=False):
+        data = bytes(bytearray(payload))
+        with self._lock:
+            if self.count == self._limit:
+                self._map.close()
+                self._allocate(self._limit + self.capacity)
+            RECORD.pack_into(self._map,
+                             HEADER.size + self.count * RECORD.size,
+                             time(), OP_CODES[op], addr, reg, len(data),
+                             FLAG_ERROR if error else 0, data)
+            self.count += 1
+            HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size,
+                             self.count)
+
+    def _call(self, op, addr, reg, written, *args):
+        try:
+            result = getattr(self.bus, op)(*args)
+        except IOError:
+            self._append(op, addr, reg, written, error=True)
+            raise
+        return result
+
+    def write_quick(self, addr):
+        self._call("write_quick", addr, 0, [], addr)
+        self._append("write_quick", addr, 0, [])
+
+    def read_byte(self, addr):
+        value = self._call("read_byte", addr, 0, [], addr)
+        self._append("read_byte", addr, 0, [value])
+        return value
+
+    def write_byte(self, addr, value):
+        self._call("write_byte", addr, 0, [value], addr, value)
+        self._append("write_byte", addr, 0, [value])
+
+    def read_byte_data(self, addr, cmd):
+        value = self._call("read_byte_data", addr, cmd, [], addr, cmd)
+        self._append("read_byte_data", addr, cmd, [value])
+        return value
+
+    def write_byte_data(self, addr, cmd, value):
+        self._call("write_byte_data", addr, cmd, [value], addr, cmd, value)
+        self._append("write_byte_data", addr, cmd, [value])
+
+    def read_word_data(self, addr, cmd):
+        value = self._call("read_word_data", addr, cmd, [], addr, cmd)
+        self._append("read_word_data", addr, cmd,
+                     [value & 0xff, value >> 8 & 0xff])
+        return value
+
+    def write_word_data(self, addr, cmd, value):
+        word = [value & 0xff, value >> 8 & 0xff]
+        self._call("write_word_data", addr, cmd, word, addr, cmd, value)
+        self._append("write_word_data", addr, cmd, word)
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        data = self._call("read_i2c_block_data", addr, cmd, [],
+                          addr, cmd, length)
+        self._append("read_i2c_block_data", addr, cmd, data)
+        return data
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        self._call("write_i2c_block_data", addr, cmd, vals, addr, cmd, vals)
+        self._append("write_i2c_block_data", addr, cmd, vals)
+
+    def sleep(self, seconds):
+        bus_sleep(self.bus, seconds)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        """ Trims the log to the records written and closes the bus.
+        """
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.truncate(HEADER.size + self.count * RECORD.size)
+            self._file.close()
+        if hasattr(self.bus, "close"):
+            self.bus.close()
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+class ReplayBus(object):
+    """ Bus that answers from a recorded log.
+
+        Each call is matched to the next record: reads return the
+            recorded data, writes are accepted, and recorded failures
+            raise IOError again. With strict=True the operation, address,
+            register and written data must match the record, otherwise
+            ReplayMismatch is raised.
+
+        With realtime=False the waits made by the drivers are skipped
+            (see i2c_utility.bus_sleep), so a log replays as fast as the
+            driver code runs. With realtime=True each record is served no
+            earlier than its recorded offset from the first record.
+    """
+    def __init__(self, log, realtime=False, strict=True):
+        self.log = BusLog(log) if not isinstance(log, BusLog) else log
+        self.realtime = realtime
+        self.strict = strict
+        self.position = 0
+        self._start = None
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return len(self.log) - self.position
+
+    def _next(self, op, addr, reg, written=None):
+        with self._lock:
+            if self.position >= len(self.log):
+                raise ReplayExhausted("Bus log ended before " + op +
+                                      " at " + hex(addr))
+            record = self.log[self.position]
+            self.position += 1
+        if self.strict:
+            if (record.op, record.addr, record.reg) != (op, addr, reg):
+                raise ReplayMismatch(
+                    "Record " + str(self.position - 1) + " is " +
+                    record.op + " " + hex(record.addr) + "/" +
+                    hex(record.reg) + ", driver made " + op + " " +
+                    hex(addr) + "/" + hex(reg))
+            if written is not None and not record.error and \
+                    list(written) != record.payload:
+                raise ReplayMismatch(
+                    "Record " + str(self.position - 1) + " wrote " +
+                    str(record.payload) + ", driver wrote " + str(written))
+        if self.realtime:
+            if self._start is None:
+                self._start = time() - record.timestamp
+            sleep(max(self._start + record.timestamp - time(), 0))
+        if record.error:
+            raise IOError(121, "Remote I/O error (replayed)")
+        return record.payload
+
+    def write_quick(self, addr):
+        self._next("write_quick", addr, 0, [])
+
+    def read_byte(self, addr):
+        return self._next("read_byte", addr, 0)[0]
+
+    def write_byte(self, addr, value):
+        self._next("write_byte", addr, 0, [value])
+
+    def read_byte_data(self, addr, cmd):
+        return self._next("read_byte_data", addr, cmd)[0]
+
+    def write_byte_data(self, addr, cmd, value):
+        self._next("write_byte_data", addr, cmd, [value])
+
+    def read_word_data(self, addr, cmd):
+        low, high = self._next("read_word_data", addr, cmd)
+        return high << 8 | low
+
+    def write_word_data(self, addr, cmd, value):
+        self._next("write_word_data", addr, cmd,
+                   [value & 0xff, value >> 8 & 0xff])
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        return self._next("read_i2c_block_data", addr, cmd)
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        self._next("write_i2c_block_data", addr, cmd, vals)
+
+    def sleep(self, seconds):
+        # Recorded timestamps pace a realtime replay; otherwise skip waits
+        pass
+
+    def close(self):
+        self.log.close()
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplayMismatch(ReplayError):
+    pass
+
+
+class ReplayExhausted(ReplayError):
+    pass
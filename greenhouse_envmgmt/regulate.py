@@ -0,0 +1,337 @@
+#!/usr/bin/python
+
+# Contains the local control loop that links SensorCluster readings to
+#   ControlCluster outputs without a round trip to a remote service.
+# Rules map a reading of each plant to some of its controls, either with
+#   a hysteresis band or a PID loop. TankGuard cuts the pump (and valves)
+#   while the water tank is low. LocalController evaluates the rules on
+#   each fresh reading and writes every change of a step with one commit.
+# Basic usage:
+#   loop = LocalController(guard=TankGuard(minimum=.1))
+#   loop.add(Hysteresis("temperature", "fan", above=80, band=2))
+#   loop.add(Hysteresis("water", ("valve", "pump"), below=30, band=5))
+#   loop.add(PID("humidity", "fan", setpoint=60, kp=.05, ki=.001), IDs=[3])
+#   loop.start(period=10)   # sweep the sensors and step every 10 seconds
+import threading
+from time import time
+from control import ControlCluster
+from sense import SensorCluster, SensorError, I2CBusError
+
+# Readings a rule can use: {quantity: SensorCluster attribute}
+QUANTITIES = {"temperature": "temp", "humidity": "humidity",
+              "light": "lux", "water": "soil_moisture"}
+
+
+def _control_bits(controls):
+    # ControlCluster state bits for a control name or a list of names
+    if isinstance(controls, str):
+        controls = (controls,)
+    bits = 0
+    for control in controls:
+        if control not in ControlCluster.control_bits:
+            raise ControlLoopError("Unknown control: " + str(control))
+        bits |= ControlCluster.control_bits[control]
+    return bits
+
+
+class Rule(object):
+    """ Base class of the rules run by LocalController.
+
+        A rule reads one quantity (see QUANTITIES) of each plant and
+            drives some of its controls. update() is called with each new
+            reading and active() tells whether the controls should be on.
+            State is kept per plant ID, so one rule serves many plants.
+    """
+    def __init__(self, quantity, controls):
+        if quantity not in QUANTITIES:
+            raise ControlLoopError("Unknown quantity: " + str(quantity))
+        self.quantity = quantity
+        self.attribute = QUANTITIES[quantity]
+        self.bits = _control_bits(controls)
+
+    def update(self, ID, value, now):
+        raise NotImplementedError
+
+    def active(self, ID, now):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+
+class Hysteresis(Rule):
+    """ Switches the controls on when the reading rises above the
+            threshold given as above (or falls below the one given as
+            below) and off again once it is band back on the other side.
+
+        Usage:
+            Hysteresis("temperature", "fan", above=80, band=2)
+            Hysteresis("water", ("valve", "pump"), below=30, band=5)
+    """
+    def __init__(self, quantity, controls, above=None, below=None, band=1.0):
+        Rule.__init__(self, quantity, controls)
+        if (above is None) == (below is None):
+            raise ControlLoopError("Give exactly one of above and below")
+        self.above = above
+        self.below = below
+        self.band = band
+        self.on = {}  # {ID: controls on}
+
+    def update(self, ID, value, now):
+        on = self.on.get(ID, False)
+        if self.above is not None:
+            if value > self.above:
+                on = True
+            elif value < self.above - self.band:
+                on = False
+        else:
+            if value < self.below:
+                on = True
+            elif value > self.below + self.band:
+                on = False
+        self.on[ID] = on
+
+    def active(self, ID, now):
+        return self.on.get(ID, False)
+
+    def reset(self):
+        self.on = {}
+
+
+class _PIDState(object):
+    __slots__ = ("integral", "error", "time", "window", "output")
+
+    def __init__(self, error, now):
+        self.integral = 0.0
+        self.error = error
+        self.time = now
+        self.window = now  # start of the current output window
+        self.output = 0.0
+
+
+class PID(Rule):
+    """ PID loop driving on/off controls by time proportioning: the
+            output (0 to 1) is the fraction of each window seconds the
+            controls are on. window should span several readings.
+        With above=True the controls act against readings above the
+            setpoint (a fan cooling), otherwise against readings below
+            it (a heater or mister).
+        The integral stops growing while the output is saturated.
+    """
+    def __init__(self, quantity, controls, setpoint, kp, ki=0.0, kd=0.0,
+                 above=True, window=60.0):
+        Rule.__init__(self, quantity, controls)
+        self.setpoint = setpoint
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.above = above
+        self.window = window
+        self.states = {}  # {ID: _PIDState}
+
+    def update(self, ID, value, now):
+        error = value - self.setpoint
+        if not self.above:
+            error = -error
+        state = self.states.get(ID)
+        if state is None:
+            state = self.states[ID] = _PIDState(error, now)
+        elapsed = now - state.time
+        integral = state.integral
+        derivative = 0.0
+        if elapsed > 0:
+            integral += error * elapsed
+            derivative = (error - state.error) / elapsed
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        if 0.0 <= output <= 1.0:
+            state.integral = integral
+        state.output = min(max(output, 0.0), 1.0)
+        state.error = error
+        state.time = now
+
+    def active(self, ID, now):
+        state = self.states.get(ID)
+        if state is None:
+            return False
+        if now - state.window >= self.window:
+            state.window = now
+        return now - state.window < state.output * self.window
+
+    def output(self, ID):
+        state = self.states.get(ID)
+        return 0.0 if state is None else state.output
+
+    def reset(self):
+        self.states = {}
+
+
+class TankGuard(object):
+    """ Cuts the pump and valves while the tank holds less than minimum
+            (a fraction of the tank, see SensorCluster.get_water_level),
+            until it is band above it again.
+        The level comes from the tank monitor when one is running and is
+            otherwise measured at most every period seconds. A failed
+            measurement keeps the previous decision.
+    """
+    def __init__(self, minimum=.1, band=.05, period=60.0,
+                 controls=("pump", "valve")):
+        self.minimum = minimum
+        self.band = band
+        self.period = period
+        self.bits = _control_bits(controls)
+        self.level = None
+        self.low = False
+        self.errors = 0
+        self._checked = None
+
+    def check(self, now):
+        """ Returns True while the pump must stay off.
+        """
+        if SensorCluster.tank_monitor is not None or self._checked is None \
+                or now - self._checked >= self.period:
+            self._checked = now
+            try:
+                self.level = SensorCluster.get_water_level()
+            except (IOError, SensorError):
+                self.errors += 1
+                return self.low
+            if self.level < self.minimum:
+                self.low = True
+            elif self.level > self.minimum + self.band:
+                self.low = False
+        return self.low
+
+
+class LocalController(object):
+    """ Runs rules on the plants' readings and drives their controls.
+
+        Each SensorCluster is paired with the ControlCluster of the same
+            ID unless pairs ({SensorCluster: ControlCluster}) is given.
+            A rule added with IDs only applies to those plants.
+
+        step() feeds every reading newer than the previous step to the
+            rules, sets the controls the rules manage (a control is on if
+            any of its rules wants it on), applies the tank guard and
+            commits once if any output changed. Controls that no rule
+            manages are left alone, except that the guard cuts the pump
+            and valves whoever turned them on.
+    """
+    def __init__(self, guard=None, pairs=None):
+        self.guard = guard
+        self.pairs = pairs
+        self.rules = []  # [(rule, IDs or None)]
+        self.steps = 0
+        self.commits = 0
+        self.errors = 0
+        self.step_time = 0.0  # duration of the last step (seconds)
+        self._seen = {}  # {(rule, ID): time of the last reading used}
+        self._uncommitted = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, rule, IDs=None):
+        """ Adds rule for the plants in IDs (every plant by default).
+            Returns the rule.
+        """
+        self.rules.append((rule, None if IDs is None else set(IDs)))
+        return rule
+
+    def remove(self, rule):
+        self.rules = [entry for entry in self.rules if entry[0] is not rule]
+
+    def paired(self):
+        """ Returns [(SensorCluster, ControlCluster)] for every plant.
+        """
+        if self.pairs is not None:
+            return list(self.pairs.items())
+        controls = dict((ctrlobj.ID, ctrlobj) for ctrlobj in ControlCluster)
+        return [(sensorobj, controls[sensorobj.ID])
+                for sensorobj in SensorCluster if sensorobj.ID in controls]
+
+    def step(self, now=None):
+        """ Evaluates the rules once and commits the changed outputs.
+            Returns the number of control clusters that changed.
+        """
+        start = time()
+        if now is None:
+            now = start
+        cut = self.guard.check(now) if self.guard is not None else False
+        changed = 0
+        for sensorobj, ctrlobj in self.paired():
+            ID = sensorobj.ID
+            managed = 0
+            wanted = 0
+            for rule, IDs in self.rules:
+                if IDs is not None and ID not in IDs:
+                    continue
+                updated = sensorobj.updated[rule.quantity]
+                if updated is not None and \
+                        updated != self._seen.get((rule, ID)):
+                    self._seen[(rule, ID)] = updated
+                    rule.update(ID, getattr(sensorobj, rule.attribute),
+                                updated)
+                managed |= rule.bits
+                if rule.active(ID, now):
+                    wanted |= rule.bits
+            if cut:
+                managed |= self.guard.bits
+                wanted &= ~self.guard.bits
+            # Only the managed bits are written, under the control lock,
+            #   so concurrent changes to the other controls are kept
+            if ctrlobj.stage_bits(on=wanted, off=managed & ~wanted):
+                changed += 1
+        if changed or self._uncommitted:
+            try:
+                ControlCluster.throttle()
+                ControlCluster.commit()
+                self.commits += 1
+                self._uncommitted = False
+            except IOError:
+                # The expanders stay marked; commit again next step
+                self.errors += 1
+                self._uncommitted = True
+        self.steps += 1
+        self.step_time = time() - start
+        return changed
+
+    def run(self, period=10.0, opt="all", sweep=True):
+        """ Steps every period seconds until stop() is called.
+            With sweep=True the sensors are swept first (see
+                SensorCluster.update_all_sensors; opt as there). Use
+                sweep=False when something else, such as a
+                SensorScheduler, keeps the readings fresh.
+        """
+        self._stop.clear()
+        next_step = time()
+        while not self._stop.is_set():
+            if sweep:
+                try:
+                    SensorCluster.update_all_sensors(opt)
+                except (IOError, I2CBusError):
+                    self.errors += 1
+            self.step()
+            next_step += period
+            wait = next_step - time()
+            if wait < 0:
+                next_step = time()  # fell behind, do not burst
+            elif self._stop.wait(wait):
+                break
+
+    def start(self, period=10.0, opt="all", sweep=True):
+        """ Runs the loop on a background thread.
+        """
+        self._thread = threading.Thread(target=self.run,
+                                        args=(period, opt, sweep))
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class ControlLoopError(Exception):
+    pass
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+# Contains a deadline scheduler that refreshes each sensor at its own rate.
+# Lux, humidity/temperature, soil moisture and the tank level change at
+#   very different speeds, so each (cluster, sensor) pair is a job with
+#   its own period. Jobs that fall due together are packed onto the bus
+#   as one batch, with their conversions overlapped like
+#   SensorCluster.sweep_sensors.
+# Basic usage:
+#   schedule = SensorScheduler()
+#   for sensorobj in SensorCluster:
+#       schedule.add(sensorobj, "lux", period=10)
+#       schedule.add(sensorobj, "humidity_temp")
+#       schedule.add(sensorobj, "soil_moisture", period=600)
+#   schedule.add(SensorCluster, "water_level", period=30)
+#   schedule.start()
+#   ...
+#   print(schedule.report())
+import random
+import threading
+from heapq import heappush, heappop
+from itertools import count
+from time import time, sleep
+from sense import SensorCluster, SensorError, LuxRangeError, I2CBusError
+from i2c_utility import TCA_select, atomic, bus_sleep, PRIORITY_SENSOR
+
+
+class SensorJob(object):
+    """ One (cluster, sensor) refresh job and its deadline statistics.
+        cluster is a SensorCluster, or the SensorCluster class itself
+            for the water_level job.
+    """
+    def __init__(self, cluster, sensor, period, jitter):
+        self.cluster = cluster
+        self.sensor = sensor
+        self.period = period
+        self.jitter = jitter
+        self.deadline = None
+        self.runs = 0
+        self.missed = 0
+        self.errors = 0
+        self.max_lateness = 0.0
+        self.last_run = None
+        self.active = True
+
+    def next_deadline(self, after):
+        """ Sets the deadline one period (plus jitter) after the given time.
+        """
+        spread = random.uniform(-self.jitter, self.jitter) * self.period
+        self.deadline = after + self.period + spread
+        return self.deadline
+
+    def summary(self):
+        return {"ID": getattr(self.cluster, "ID", None),
+                "sensor": self.sensor,
+                "period": self.period,
+                "runs": self.runs,
+                "missed": self.missed,
+                "errors": self.errors,
+                "max_lateness": round(self.max_lateness, 4),
+                "last_run": self.last_run}
+
+
+class SensorScheduler(object):
+    """ Keeps a deadline ordered queue of sensor jobs.
+
+        Each job has a period and a jitter (as a fraction of its period)
+            that spreads jobs out so they do not all fall due at once.
+            A job that starts more than tolerance seconds after its
+            deadline is counted as missed. A job more than a full period
+            late is not run repeatedly to catch up.
+
+        Jobs due within pack_window seconds of each other are run as one
+            batch: lux and humidity conversions are started together,
+            a single wait covers the slowest one, then all are read.
+            The soil moisture jobs of a batch share one analog power
+            window (see SensorCluster.update_all_soil_moisture).
+
+        Sensors:
+            "lux", "humidity_temp", "soil_moisture", "water_level"
+    """
+    periods = {"lux": 30.0,
+               "humidity_temp": 30.0,
+               "soil_moisture": 600.0,
+               "water_level": 60.0}
+    # Sensors read in two phases so their conversions can overlap
+    conversions = {"lux": ("start_lux", "read_lux"),
+                   "humidity_temp": ("start_humidity_temp",
+                                     "read_humidity_temp")}
+    # Sensors read together within one analog power window
+    batched = {"soil_moisture": "update_all_soil_moisture"}
+    # Sensors read with a single call
+    methods = {"water_level": "get_water_level"}
+
+    def __init__(self, jitter=.05, tolerance=.5, pack_window=.5):
+        self.jitter = jitter
+        self.tolerance = tolerance
+        self.pack_window = pack_window
+        self.jobs = []
+        self._queue = []
+        self._order = count()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, cluster, sensor, period=None, jitter=None):
+        """ Schedules sensor on cluster. The first run is due at once.
+            Returns the SensorJob.
+        """
+        if sensor not in SensorScheduler.periods:
+            raise SchedulerError("Unknown sensor: " + str(sensor))
+        if period is None:
+            period = SensorScheduler.periods[sensor]
+        if jitter is None:
+            jitter = self.jitter
+        job = SensorJob(cluster, sensor, period, jitter)
+        job.deadline = time()
+        self.jobs.append(job)
+        heappush(self._queue, (job.deadline, next(self._order), job))
+        self._wake.set()
+        return job
+
+    def remove(self, job):
+        job.active = False
+        self.jobs.remove(job)
+
+    def next_deadline(self):
+        """ Returns the earliest pending deadline, or None.
+        """
+        while self._queue and not self._queue[0][2].active:
+            heappop(self._queue)
+        if self._queue:
+            return self._queue[0][0]
+        return None
+
+    def run_pending(self):
+        """ Runs every job that is due, packing jobs due within
+                pack_window into a single batch.
+            Returns the number of jobs run.
+        """
+        now = time()
+        batch = []
+        while self._queue and self._queue[0][0] <= now + self.pack_window:
+            deadline, order, job = heappop(self._queue)
+            if job.active:
+                batch.append(job)
+        if not batch:
+            return 0
+        self._run_batch(batch)
+        for job in batch:
+            if job.active:
+                base = job.deadline
+                if job.last_run - base > job.period:
+                    # Skip ahead rather than running back to back to catch up
+                    base = job.last_run
+                job.next_deadline(base)
+                heappush(self._queue, (job.deadline, next(self._order), job))
+        return len(batch)
+
+    def _started(self, job):
+        job.last_run = time()
+        lateness = job.last_run - job.deadline
+        job.max_lateness = max(job.max_lateness, lateness)
+        if lateness > self.tolerance:
+            job.missed += 1
+
+    def _finished(self, job, updated):
+        job.runs += 1
+        if job.cluster not in updated:
+            updated.append(job.cluster)
+
+    def _run_batch(self, batch):
+        # Start every conversion, wait once, then collect the results
+        updated = []  # clusters with a job that succeeded
+        pending = []
+        ready = time()
+        for job in batch:
+            if job.sensor not in SensorScheduler.conversions:
+                continue
+            start, read = SensorScheduler.conversions[job.sensor]
+            self._started(job)
+            try:
+                with atomic(job.cluster.bus, PRIORITY_SENSOR):
+                    try:
+                        delay = getattr(job.cluster, start)()
+                    finally:
+                        TCA_select(job.cluster.bus,
+                                   job.cluster.mux_addr, "off")
+                ready = max(ready, time() + delay)
+                pending.append((job, read))
+            except (IOError, SensorError, I2CBusError):
+                job.errors += 1
+        buses = set(id(job.cluster.bus) for job, read in pending)
+        if len(buses) == 1:
+            bus_sleep(pending[0][0].cluster.bus, ready - time())
+        elif buses and ready > time():
+            # The conversions span buses; a replayed bus cannot skip
+            #   a wait that the others need
+            sleep(ready - time())
+
+        rerange = []
+        for job, read in pending:
+            try:
+                with atomic(job.cluster.bus, PRIORITY_SENSOR):
+                    try:
+                        getattr(job.cluster, read)()
+                    finally:
+                        TCA_select(job.cluster.bus,
+                                   job.cluster.mux_addr, "off")
+                self._finished(job, updated)
+            except LuxRangeError:
+                rerange.append(job)
+            except (IOError, SensorError, I2CBusError):
+                job.errors += 1
+        if rerange:
+            # Auto-ranged lux reads that switched mode are repeated together
+            try:
+                SensorCluster.reread_lux([job.cluster for job in rerange])
+                for job in rerange:
+                    self._finished(job, updated)
+            except (IOError, SensorError, I2CBusError):
+                for job in rerange:
+                    job.errors += 1
+
+        for sensor, method in SensorScheduler.batched.items():
+            jobs = [job for job in batch if job.sensor == sensor]
+            if not jobs:
+                continue
+            for job in jobs:
+                self._started(job)
+            try:
+                failed = getattr(SensorCluster, method)(
+                    [job.cluster for job in jobs])
+            except (IOError, SensorError, I2CBusError):
+                # The analog power could not be switched
+                failed = dict((job.cluster, None) for job in jobs)
+            for job in jobs:
+                if job.cluster in failed:
+                    job.errors += 1
+                else:
+                    self._finished(job, updated)
+
+        for job in batch:
+            if job.sensor not in SensorScheduler.methods:
+                continue
+            self._started(job)
+            try:
+                getattr(job.cluster, SensorScheduler.methods[job.sensor])()
+                job.runs += 1
+            except (IOError, SensorError, I2CBusError):
+                job.errors += 1
+
+        # Each cluster is recorded once per batch, after all of its jobs
+        for cluster in updated:
+            cluster.timestamp = time()
+            cluster.record()
+
+    def run(self):
+        """ Runs jobs as they fall due until stop() is called.
+            Sleeps until the next deadline rather than polling.
+        """
+        self._stop.clear()
+        while not self._stop.is_set():
+            self.run_pending()
+            deadline = self.next_deadline()
+            self._wake.clear()
+            if deadline is None:
+                self._wake.wait()
+            else:
+                self._wake.wait(max(deadline - time(), 0))
+
+    def start(self):
+        """ Runs the scheduler on a background thread.
+        """
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def report(self):
+        """ Returns the run, error and missed deadline statistics of
+                every job.
+        """
+        return [job.summary() for job in self.jobs]
+
+    def missed_deadlines(self):
+        return sum(job.missed for job in self.jobs)
+
+
+class SchedulerError(Exception):
+    pass
@@ -8,12 +8,26 @@
 #   Updating individual sensor values can be done with
 # Note that SMBus must be imported and initiated
 #   in order to use these classes.
-import smbus
-from control import ControlCluster
-from i2c_utility import TCA_select, get_ADC_value, import_i2c_addr
+#   (simbus.SimBus can stand in for it when no I2C bus is available)
+try:
+    import smbus
+except ImportError:
+    smbus = None
+from i2c_utility import TCA_select, get_ADC_value
 from i2c_utility import IO_expander_output, get_IO_reg
-from time import sleep, time  # needed to force a delay in humidity module
-from math import e
+from i2c_utility import atomic, bus_sleep, PRIORITY_SENSOR, MCP342x
+from i2c_utility import mux_all_off
+from history import SensorHistory
+from topology import I2CTopology
+from instrument import instrumented
+from faults import CircuitBreaker, retry
+from filters import FilterChain, OutlierFilter, MedianFilter, EMAFilter
+from filters import FilteredStream
+from decode import lux_valid, lux_count, lux_value
+from decode import hih_status, hih_humidity, hih_celsius, fahrenheit
+from decode import tank_depth
+from time import time
+import threading
 
 
 class IterList(type):
@@ -23,9 +37,12 @@ class IterList(type):
         return iter(cls._list)
 
 
-class SensorCluster(object):
+# Applies IterList under both Python 2 and Python 3
+IterBase = IterList("IterBase", (object,), {})
+
+
+class SensorCluster(IterBase):
     'Base class for each individual plant containing sensor info'
-    __metaclass__ = IterList
     _list = []
     analog_power_pin = 0
     power_bank = 0  # bank and pin used to toggle analog sensor power
@@ -40,104 +57,273 @@ class SensorCluster(object):
     moisture_chan = 1
     tank_adc_adr = 0x6c
     tank_adc_chan = 0
+    # Tank level sensor divider and measured depth transfer
+    # These values should be updated based on the real system parameters
+    tank_vref = 4.95
+    tank_rref = 2668  # Reference resistor
+    tank_slope = -.0163  # cm per ohm
+    tank_offset = 28.127  # measured transfer adjusted offset
+    tank_height = 17.5  # in centimeters (height of container)
+    tank_monitor = None  # FilteredStream of the tank depth when running
+    # Auto-ranged lux reads (extend=None) switch to extended mode after a
+    #   standard reading with a channel 0 chord of at least lux_fast_chord,
+    #   and back to standard after an extended reading below lux_slow_chord.
+    lux_fast_chord = 6
+    lux_slow_chord = 3
+    lux_extend = 0  # mode of the next auto-ranged lux read
+    verify_mux = False  # read the mux back after each cluster is updated
+    analog_settle = .2  # seconds for analog sensors to settle after power on
+    history_capacity = 8640  # samples kept per cluster (a day at 10s)
+    # Failed device operations are retried with exponential backoff
+    retry_attempts = 3
+    retry_delay = .02  # first wait (seconds), doubled for each retry
+    retry_limit = .5  # longest wait
+    # Clusters failing breaker_threshold sweeps in a row are left out of
+    #   the sweep and probed every breaker_probe seconds
+    breaker_threshold = 3
+    breaker_probe = 300
     bus = None
 
-    def __init__(self, ID, mux_addr=None):
+    def __init__(self, ID, mux_addr=None, bus=None, slot=None):
 
         # Initializes cluster, enumeration, and sets up address info
-        sensor_addr = import_i2c_addr(SensorCluster.bus)
-        if (ID < 1 or ID > len(sensor_addr)):
+        # The cluster is bound to bus if one is given. Otherwise it uses
+        #   whatever SensorCluster.bus is at the time of each call.
+        # slot is the position of its sensor head on that bus and
+        #   defaults to ID; clusters on a second bus number from 1 again.
+        # Each bus is only scanned for its first cluster; see I2CTopology
+        if bus is not None:
+            self.bus = bus
+        slot = slot or ID
+        sensor_addr = I2CTopology.get(self.bus).mux_addresses()
+        if (slot < 1 or slot > len(sensor_addr)):
             raise I2CBusError("Plant ID out of range.")
-        self.mux_addr = mux_addr or (sensor_addr[ID-1])
+        self.mux_addr = mux_addr or (sensor_addr[slot-1])
         self.ID = ID  # Plant number specified by caller
         self.temp = 0
         self.humidity = 0
         self.lux = 0
         self.light_ratio = 0
+        self._lux_mode = (0, False)  # (extend, auto) of the last start_lux
         self.soil_moisture = 0
         self.acidity = 0
         self.timestamp = time()  # record time at instantiation
         self._list.append(self)
         self.update_count = 0
-        
-
-    def update_lux(self, extend=0):
-        """ Communicates with the TSL2550D light sensor and returns a 
-            lux value. 
-
-        Note that this method contains approximately 1 second of total delay.
-            This delay is necessary in order to obtain full resolution
-            compensated lux values.
-
-        Alternatively, the device could be put in extended mode, 
-            which drops some resolution in favor of shorter delays.
-
+        self.history = SensorHistory(SensorCluster.history_capacity)
+        # Time each quantity was last read, keyed like sensor_values()
+        self.updated = {"light": None, "water": None,
+                        "humidity": None, "temperature": None}
+        self._flight = None  # refresh shared by concurrent sensor_values
+        self._flight_lock = threading.Lock()
+        self.breaker = CircuitBreaker(SensorCluster.breaker_threshold,
+                                      SensorCluster.breaker_probe)
+
+    def record(self):
+        """ Appends the current sensor values to the cluster history.
+        """
+        self.history.append(self.timestamp, temp=self.temp,
+                            humidity=self.humidity, lux=self.lux,
+                            soil_moisture=self.soil_moisture)
+
+    def _retry(self, operation, *args):
+        # Calls operation, retrying IOErrors with exponential backoff
+        return retry(lambda: operation(*args), self.bus,
+                     SensorCluster.retry_attempts, SensorCluster.retry_delay,
+                     SensorCluster.retry_limit)
+
+    def _device(self, method, *args):
+        # Calls a start/read phase method on its own, switching the mux
+        #   off afterwards even if it fails, with retries
+        def attempt():
+            with atomic(self.bus, PRIORITY_SENSOR):
+                try:
+                    return method(*args)
+                finally:
+                    self._mux_off()
+        return self._retry(attempt)
+
+    def _mux_off(self):
+        # Switches the mux off, retried on its own so that a failed
+        #   cleanup cannot leave the channel enabled. If the mux still
+        #   fails, every mux on the bus is switched off (best effort)
+        #   before the error is raised, so the next head cannot collide
+        #   with this one.
+        try:
+            return self._retry(TCA_select, self.bus, self.mux_addr, "off")
+        except IOError:
+            mux_all_off(self.bus, [sensorobj.mux_addr
+                                   for sensorobj in SensorCluster
+                                   if sensorobj.bus is self.bus])
+            raise
+
+    @instrumented("start_lux", owner=True)
+    def start_lux(self, extend=None):
+        """ Powers up the TSL2550D and selects its operating mode so
+                that both ADC channels begin integrating.
+            Returns the delay (in seconds) needed before both channels
+                hold valid data. Use read_lux once it has elapsed.
+
+            extend=None picks the mode from the previous reading
+                (see lux_extend); 0 and 1 force standard or extended mode.
+
+            The mux channel is left enabled; the caller is responsible
+                for turning the mux off.
         """
-        DEVICE_REG_OUT = 0x1d
         LUX_PWR_ON = 0x03
+        auto = extend is None
+        if auto:
+            extend = self.lux_extend
+        self._lux_mode = (extend, auto)
         if extend == 1:
             LUX_MODE = 0x1d
             delay = .08
-            scale = 5
         else:
             LUX_MODE = 0x18
             delay = .4
-            scale = 1
-        LUX_READ_CH0 = 0x43
-        LUX_READ_CH1 = 0x83
         # Select correct I2C mux channel on TCA module
 
-        TCA_select(SensorCluster.bus, self.mux_addr, SensorCluster.lux_chan)
+        TCA_select(self.bus, self.mux_addr, SensorCluster.lux_chan)
         # Make sure lux sensor is powered up.
-        SensorCluster.bus.write_byte(SensorCluster.lux_addr, LUX_PWR_ON)
-        lux_on = SensorCluster.bus.read_byte_data(SensorCluster.lux_addr, LUX_PWR_ON)
+        self.bus.write_byte(SensorCluster.lux_addr, LUX_PWR_ON)
+        lux_on = self.bus.read_byte_data(SensorCluster.lux_addr, LUX_PWR_ON)
         
         # Check for successful powerup
         if (lux_on == LUX_PWR_ON):
-            # Send command to initiate ADC on each channel
-            # Read each channel after the new data is ready
-            SensorCluster.bus.write_byte(SensorCluster.lux_addr, LUX_MODE)
-            SensorCluster.bus.write_byte(SensorCluster.lux_addr, LUX_READ_CH0)
-            sleep(delay)
-            adc_ch0 = SensorCluster.bus.read_byte(SensorCluster.lux_addr)
-            count0 = get_lux_count(adc_ch0) * scale  # 5x for extended mode
-            SensorCluster.bus.write_byte(SensorCluster.lux_addr, LUX_READ_CH1)
-            sleep(delay)
-            adc_ch1 = SensorCluster.bus.read_byte(SensorCluster.lux_addr)
-            count1 = get_lux_count(adc_ch1) * scale  # 5x for extended mode
-            ratio = count1 / (count0 - count1)
-            lux = (count0 - count1) * .39 * e**(-.181 * (ratio**2))
-            self.light_ratio = float(count1)/float(count0)
-            print("Light ratio Ch1/Ch0: ", self.light_ratio)
-            self.lux = round(lux, 3)
-            return TCA_select(SensorCluster.bus, self.mux_addr, "off")
+            # Channel 0 and channel 1 integrate one after the other
+            self.bus.write_byte(SensorCluster.lux_addr, LUX_MODE)
+            return 2 * delay
         else:
             raise SensorError("The lux sensor is powered down.")
 
-    def update_humidity_temp(self):
-        """ This method utilizes the HIH7xxx sensor to read
-            humidity and temperature in one call. 
+    @instrumented("read_lux", owner=True)
+    def read_lux(self, extend=None):
+        """ Reads both channels of the TSL2550D and computes the
+                compensated lux value.
+            start_lux must have been called at least its returned delay
+                beforehand. extend=None uses the mode start_lux picked.
+
+            After an auto-ranged start, a saturated standard reading or
+                invalid data switches lux_extend to the other mode and
+                raises LuxRangeError so the conversion can be repeated
+                (see reread_lux). Otherwise the reading picks the mode
+                of the next auto-ranged read.
+
+            The mux channel is left enabled; the caller is responsible
+                for turning the mux off.
+        """
+        LUX_SATURATED = 0x7f
+        auto = False
+        if extend is None:
+            extend, auto = self._lux_mode
+        if extend == 1:
+            scale = 5
+        else:
+            scale = 1
+        LUX_READ_CH0 = 0x43
+        LUX_READ_CH1 = 0x83
+
+        TCA_select(self.bus, self.mux_addr, SensorCluster.lux_chan)
+        self.bus.write_byte(SensorCluster.lux_addr, LUX_READ_CH0)
+        adc_ch0 = self.bus.read_byte(SensorCluster.lux_addr)
+        self.bus.write_byte(SensorCluster.lux_addr, LUX_READ_CH1)
+        adc_ch1 = self.bus.read_byte(SensorCluster.lux_addr)
+        try:
+            count0 = get_lux_count(adc_ch0) * scale  # 5x for extended mode
+            count1 = get_lux_count(adc_ch1) * scale  # 5x for extended mode
+        except SensorError:
+            if not auto:
+                raise
+            self.lux_extend = 1 - extend
+            raise LuxRangeError("Invalid lux data, retry in other mode.")
+        if auto:
+            chord = (adc_ch0 >> 4) & 0b111
+            if extend == 0 and adc_ch0 & LUX_SATURATED == LUX_SATURATED:
+                self.lux_extend = 1
+                raise LuxRangeError("Lux sensor saturated in standard mode.")
+            if extend == 0 and chord >= SensorCluster.lux_fast_chord:
+                self.lux_extend = 1
+            elif extend == 1 and chord < SensorCluster.lux_slow_chord:
+                self.lux_extend = 0
+        if count0 == count1 and count0 and \
+                adc_ch0 & LUX_SATURATED == LUX_SATURATED:
+            raise SensorError("Lux sensor saturated.")
+        lux = lux_value(count0, count1)  # 0 lux in darkness
+        self.light_ratio = float(count1)/float(count0) if count0 else 0.0
+        print("Light ratio Ch1/Ch0: ", self.light_ratio)
+        self.lux = round(lux, 3)
+        self.updated["light"] = time()
+        return self.lux
+
+    @instrumented("update_lux", owner=True)
+    def update_lux(self, extend=None):
+        """ Communicates with the TSL2550D light sensor and returns a 
+            lux value. 
+
+        Note that this method contains approximately 1 second of total delay.
+            This delay is necessary in order to obtain full resolution
+            compensated lux values.
+
+        Alternatively, the device could be put in extended mode, 
+            which drops some resolution in favor of shorter delays.
+            By default the mode is picked from the previous reading:
+            extended in bright light and standard in low light.
+
         """
-        # Create mask for STATUS (first two bits of 64 bit wide result)
-        STATUS = 0b11 << 6
-
-        TCA_select(SensorCluster.bus, self.mux_addr, SensorCluster.humidity_chan)
-        SensorCluster.bus.write_quick(SensorCluster.humidity_addr)  # Begin conversion
-        sleep(.25)
-        # wait 100ms to make sure the conversion takes place.
-        data = SensorCluster.bus.read_i2c_block_data(SensorCluster.humidity_addr, 0, 4)
-        status = (data[0] & STATUS) >> 6
+        # The bus is released during the integration period
+        delay = self._device(self.start_lux, extend)
+        bus_sleep(self.bus, delay)
+        try:
+            self._device(self.read_lux, extend)
+        except LuxRangeError:
+            return SensorCluster.reread_lux([self])
+        return TCA_select(self.bus, self.mux_addr, "off")
+
+    @instrumented("start_humidity_temp", owner=True)
+    def start_humidity_temp(self):
+        """ Starts a measurement on the HIH7xxx sensor.
+            Returns the delay (in seconds) to wait before calling
+                read_humidity_temp.
+
+            The mux channel is left enabled; the caller is responsible
+                for turning the mux off.
+        """
+        TCA_select(self.bus, self.mux_addr, SensorCluster.humidity_chan)
+        self.bus.write_quick(SensorCluster.humidity_addr)  # Begin conversion
+        # wait 250ms to make sure the conversion takes place.
+        return .25
+
+    @instrumented("read_humidity_temp", owner=True)
+    def read_humidity_temp(self):
+        """ Fetches the measurement started by start_humidity_temp
+                and updates humidity and temperature.
+
+            The mux channel is left enabled; the caller is responsible
+                for turning the mux off.
+        """
+        TCA_select(self.bus, self.mux_addr, SensorCluster.humidity_chan)
+        data = self.bus.read_i2c_block_data(SensorCluster.humidity_addr, 0, 4)
+        # STATUS is the first two bits of the result
+        status = hih_status(data[0])
         
         if status == 0 or status == 1:  # will always pass for now.
-            humidity = round((((data[0] & 0x3f) << 8) |
-                              data[1]) * 100.0 / (2**14 - 2), 3)
-            self.humidity = humidity
-            self.temp = (round((((data[2] << 6) + ((data[3] & 0xfc) >> 2))
-                               * 165.0 / 16382.0 - 40.0), 3) * 9/5) + 32
-            return TCA_select(SensorCluster.bus, self.mux_addr, "off")
+            self.humidity = round(hih_humidity(data[0], data[1]), 3)
+            self.temp = fahrenheit(round(hih_celsius(data[2], data[3]), 3))
+            self.updated["humidity"] = self.updated["temperature"] = time()
         else:
             raise I2CBusError("Unable to retrieve humidity")
 
+    @instrumented("update_humidity_temp", owner=True)
+    def update_humidity_temp(self):
+        """ This method utilizes the HIH7xxx sensor to read
+            humidity and temperature in one call. 
+        """
+        delay = self._device(self.start_humidity_temp)
+        bus_sleep(self.bus, delay)
+        self._device(self.read_humidity_temp)
+        return TCA_select(self.bus, self.mux_addr, "off")
+
+    @instrumented("update_soil_moisture", owner=True)
     def update_soil_moisture(self):
         """ Method will select the ADC module,
                 turn on the analog sensor, wait for voltage settle, 
@@ -146,21 +332,74 @@ class SensorCluster(object):
                 scaling up the sensor output.
                 This may need to be adjusted if a different sensor is used
         """
-        SensorCluster.analog_sensor_power(SensorCluster.bus, "on")  # turn on sensor
-        sleep(.2)
-        TCA_select(SensorCluster.bus, self.mux_addr, SensorCluster.adc_chan)
+        SensorCluster.analog_sensor_power(self.bus, "on")  # turn on sensor
+        try:
+            bus_sleep(self.bus, SensorCluster.analog_settle)
+            return self._retry(self.read_soil_moisture)
+        finally:
+            SensorCluster.analog_sensor_power(self.bus, "off")  # turn off sensor
+
+    @instrumented("read_soil_moisture", owner=True)
+    def read_soil_moisture(self):
+        """ Digitizes the soil moisture sensor voltage.
+            The analog sensors must already be powered and settled;
+                see update_soil_moisture and update_all_soil_moisture.
+        """
+        # The bus is free for other transactions during the conversion
         moisture = get_ADC_value(
-            SensorCluster.bus, SensorCluster.adc_addr, SensorCluster.moisture_chan)
-        status = TCA_select(SensorCluster.bus, self.mux_addr, "off")  # Turn off mux.
-        SensorCluster.analog_sensor_power(SensorCluster.bus, "off")  # turn off sensor
+            self.bus, SensorCluster.adc_addr, SensorCluster.moisture_chan,
+            mux=(self.mux_addr, SensorCluster.adc_chan))
         if (moisture >= 0):
             soil_moisture = moisture/2.048 # Scale to a percentage value 
             self.soil_moisture = round(soil_moisture,3)
+            self.updated["water"] = time()
         else:
             raise SensorError(
                 "The soil moisture meter is not configured correctly.")
-        return status
 
+    def _start_conversions(self):
+        # Starts the lux and humidity conversions, switching the mux
+        #   straight from one channel to the next. If that fails, each
+        #   device is started again on its own.
+        # Returns the delay before the results can be read.
+        try:
+            with atomic(self.bus, PRIORITY_SENSOR):
+                try:
+                    return max(self.start_lux(), self.start_humidity_temp())
+                finally:
+                    self._mux_off()
+        except IOError:
+            return max(self._device(self.start_lux),
+                       self._device(self.start_humidity_temp))
+
+    def _read_conversions(self):
+        # Collects the conversions started by _start_conversions, falling
+        #   back to reading each device on its own like above.
+        # Returns True if the lux reading must be repeated in a new range.
+        rerange = False
+        try:
+            with atomic(self.bus, PRIORITY_SENSOR):
+                try:
+                    try:
+                        self.read_lux()
+                    except LuxRangeError:
+                        rerange = True
+                    self.read_humidity_temp()
+                finally:
+                    self._mux_off()
+        except IOError:
+            try:
+                self._device(self.read_lux)
+            except LuxRangeError:
+                rerange = True
+            self._device(self.read_humidity_temp)
+        if SensorCluster.verify_mux and \
+                TCA_select(self.bus, self.mux_addr, "off", verify=True) != 0:
+            raise I2CBusError(
+                "Bus multiplexer was unable to switch off to prevent conflicts")
+        return rerange
+
+    @instrumented("update_instance_sensors", owner=True)
     def update_instance_sensors(self, opt=None):
 
         """ Method runs through all sensor modules and updates 
@@ -168,40 +407,79 @@ class SensorCluster(object):
         After running through each sensor module,
         The sensor head (the I2C multiplexer), is disabled
         in order to avoid address conflicts.
+        Failed device operations are retried (see retry_attempts) and
+            the last error is raised, soil moisture errors included.
+            The outcome is reported to the cluster's breaker.
         Usage:
             plant_sensor_object.updateAllSensors(bus_object)
         """
-        self.update_count += 1
-        self.update_lux()
-        self.update_humidity_temp()
-        if opt == "all":
-            try:
-                self.update_soil_moisture()
-            except SensorError:
-                # This could be handled with a repeat request later.
-                pass
-        self.timestamp = time()
-        # disable sensor module
-
-        tca_status = TCA_select(SensorCluster.bus, self.mux_addr, "off")
-        if tca_status != 0:
-            raise I2CBusError(
-                "Bus multiplexer was unable to switch off to prevent conflicts")
+        # Both conversions run at once and the bus is released while
+        #   they are in progress; see _sweep.
+        failed = SensorCluster._sweep([self], opt)
+        if self in failed:
+            raise failed[self]
 
-    def sensor_values(self):
+    def sensor_values(self, max_age=None):
         """
         Returns the values of all sensors for this cluster
+            along with the time each value was read ("timestamps").
+
+        If max_age (seconds) is given and every value is at least that
+            fresh, the cached values are returned without touching the bus.
+        Callers that need a refresh while one is already running wait
+            for it and share its result instead of starting another.
+        """
+        if max_age is None or not self.fresh(max_age):
+            self.refresh()
+        return self.current_values()
+
+    def current_values(self):
+        """ Returns the last values read, like sensor_values, without
+                touching the bus.
         """
-        self.update_instance_sensors(opt="all")
         return {
             "light": self.lux,
             "water": self.soil_moisture,
             "humidity": self.humidity,
-            "temperature": self.temp
+            "temperature": self.temp,
+            "timestamps": dict(self.updated)
         }
 
+    def fresh(self, max_age):
+        """ True if every quantity was read within the last max_age seconds.
+        """
+        oldest = time() - max_age
+        for updated in self.updated.values():
+            if updated is None or updated < oldest:
+                return False
+        return True
+
+    def refresh(self):
+        """ Runs update_instance_sensors(opt="all"), or joins the
+                refresh already in progress for this cluster.
+            Errors raised by the refresh are raised in every caller.
+        """
+        with self._flight_lock:
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = _Flight()
+        if leader:
+            try:
+                self.update_instance_sensors(opt="all")
+            except Exception as error:
+                flight.error = error
+            with self._flight_lock:
+                self._flight = None
+            flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+
     @classmethod
-    def update_all_sensors(cls, opt=None):
+    @instrumented("update_all_sensors")
+    def update_all_sensors(cls, opt=None, pipelined=True):
         """ Method iterates over all SensorCluster objects and updates 
             each sensor value and saves the values to the plant record.
                 - Note that it must receive an open bus object.
@@ -212,9 +490,233 @@ class SensorCluster(object):
             Update all sensors including soil moisture.
             - update_all_sensors("all")
 
+            Visit each cluster in turn instead of using the pipelined sweep.
+            - update_all_sensors(pipelined=False)
+
+        Clusters on different buses are updated in parallel, one worker
+            thread per bus, so the cycle time depends on the number of
+            plants per bus. If a bus fails, the other buses still finish
+            before the first error is raised.
+
+        A cluster whose sensors fail does not stop the others. Returns
+            {cluster: error} for the clusters that failed; see
+            sweep_sensors for the clusters that are skipped.
+        """
+        groups = cls.bus_groups()
+        if len(groups) == 1:
+            return cls._update_group(groups[0][1], opt, pipelined)
+        errors = []
+        failed = {}
+
+        def worker(clusters):
+            try:
+                failed.update(cls._update_group(clusters, opt, pipelined))
+            except Exception as error:
+                errors.append(error)
+
+        workers = [threading.Thread(target=worker, args=(clusters,))
+                   for bus, clusters in groups]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return failed
+
+    @classmethod
+    def _update_group(cls, clusters, opt, pipelined):
+        # Updates clusters that share one bus
+        if pipelined:
+            return cls.sweep_sensors(opt, clusters)
+        failed = {}
+        for sensorobj in clusters:
+            if not sensorobj.breaker.allow():
+                continue
+            try:
+                sensorobj.update_instance_sensors(opt)
+            except (IOError, SensorError, I2CBusError) as error:
+                failed[sensorobj] = error
+        return failed
+
+    @classmethod
+    def bus_groups(cls, clusters=None):
+        """ Groups clusters (every cluster by default) by bus.
+            Returns [(bus, [clusters])] in order of first appearance.
+        """
+        groups = []
+        index = {}
+        for sensorobj in (cls if clusters is None else clusters):
+            key = id(sensorobj.bus)
+            if key not in index:
+                index[key] = len(groups)
+                groups.append((sensorobj.bus, []))
+            groups[index[key]][1].append(sensorobj)
+        return groups
+
+    @classmethod
+    def all_values(cls):
+        """ Returns the last values of every cluster, on every bus,
+                keyed by cluster ID. See current_values.
+        """
+        return dict((sensorobj.ID, sensorobj.current_values())
+                    for sensorobj in cls)
+
+    @classmethod
+    @instrumented("sweep_sensors")
+    def sweep_sensors(cls, opt=None, clusters=None):
+        """ Pipelined version of update_all_sensors.
+            Conversions are started on every cluster first, then a single
+                wait covers the longest conversion before all results are
+                collected. Cycle time therefore stays roughly constant
+                as clusters are added instead of growing with each plant.
+
+            Each mux is switched off before the next cluster is visited
+                since every sensor head uses the same device addresses.
+
+            With opt="all" the analog sensors are powered once for the
+                whole sweep and settle during the lux/humidity conversions.
+
+            clusters must share one bus. By default every cluster is
+                swept, through update_all_sensors if they span buses.
+
+            Failed device operations are retried with backoff, and a
+                cluster that still fails is left behind while the sweep
+                carries on. Clusters whose breaker is open (after
+                breaker_threshold failed sweeps in a row) are skipped
+                until a probe is due.
+            Returns {cluster: error} for the clusters that failed.
+        """
+        if clusters is None:
+            if len(cls.bus_groups()) > 1:
+                return cls.update_all_sensors(opt)
+            clusters = list(cls)
+        return cls._sweep([sensorobj for sensorobj in clusters
+                           if sensorobj.breaker.allow()], opt)
+
+    @classmethod
+    def _sweep(cls, clusters, opt):
+        # Sweeps clusters (on one bus) regardless of their breakers and
+        #   reports each outcome to them. Returns {cluster: error}.
+        failed = {}
+        if not clusters:
+            return failed
+        bus = clusters[0].bus
+        errors = (IOError, SensorError, I2CBusError)
+        powered = False
+        try:
+            ready = time()
+            if opt == "all":
+                powered = True
+                cls.analog_sensor_power(bus, "on")
+                ready = time() + cls.analog_settle
+            started = []
+            for sensorobj in clusters:
+                try:
+                    delay = sensorobj._start_conversions()
+                except errors as error:
+                    failed[sensorobj] = error
+                    continue
+                started.append(sensorobj)
+                ready = max(ready, time() + delay)
+            bus_sleep(bus, ready - time())
+
+            rerange = []
+            for sensorobj in started:
+                sensorobj.update_count += 1
+                try:
+                    if sensorobj._read_conversions():
+                        rerange.append(sensorobj)
+                except errors as error:
+                    failed[sensorobj] = error
+            cls.reread_lux(rerange, failed)
+            healthy = [sensorobj for sensorobj in started
+                       if sensorobj not in failed]
+            if powered and healthy:
+                powered = False  # switched off by update_all_soil_moisture
+                failed.update(cls.update_all_soil_moisture(healthy,
+                                                           powered=True))
+        finally:
+            if powered:
+                cls.analog_sensor_power(bus, "off")
+
+        for sensorobj in clusters:
+            if sensorobj in failed:
+                sensorobj.breaker.failure(failed[sensorobj])
+            else:
+                sensorobj.breaker.success()
+                sensorobj.timestamp = time()
+                sensorobj.record()
+        return failed
+
+    @classmethod
+    @instrumented("reread_lux")
+    def reread_lux(cls, clusters, failed=None):
+        """ Repeats the auto-ranged lux conversion of clusters whose
+                read_lux raised LuxRangeError, in the mode it switched to.
+            The conversions run together under a single wait.
+            Returns the mux status of the last cluster read.
+            If failed (a dict) is given, the error of a cluster that
+                fails again is stored in it as {cluster: error} rather
+                than raised.
         """
-        for sensorobj in cls:
-            sensorobj.update_instance_sensors(opt)
+        status = 0
+        ready = time()
+        pending = []
+        for sensorobj in clusters:
+            try:
+                delay = sensorobj._device(sensorobj.start_lux)
+            except (IOError, SensorError) as error:
+                if failed is None:
+                    raise
+                failed[sensorobj] = error
+                continue
+            pending.append(sensorobj)
+            ready = max(ready, time() + delay)
+        if not pending:
+            return status
+        bus_sleep(pending[0].bus, ready - time())
+        for sensorobj in pending:
+            try:
+                sensorobj._device(sensorobj.read_lux)
+                status = TCA_select(sensorobj.bus, sensorobj.mux_addr, "off")
+            except (IOError, SensorError) as error:
+                if failed is None:
+                    raise
+                failed[sensorobj] = error
+        return status
+
+    @classmethod
+    @instrumented("update_all_soil_moisture")
+    def update_all_soil_moisture(cls, clusters=None, powered=False):
+        """ Reads the soil moisture of every cluster (or of the given
+                clusters) within a single analog power window.
+            The moisture probes share one power pin, so the rail is
+                turned on once, allowed to settle once, every ADC is
+                read through its mux, and the rail is turned off again.
+            powered=True means the caller already turned the rail on and
+                waited for it to settle. It is still turned off afterwards.
+            Each reading is retried with backoff. Returns {cluster: error}
+                for the clusters whose reading failed.
+
+            Each bus has its own analog power pin; the buses are
+                handled one after another.
+        """
+        failed = {}
+        for bus, group in cls.bus_groups(clusters):
+            if not powered:
+                cls.analog_sensor_power(bus, "on")
+            try:
+                if not powered:
+                    bus_sleep(bus, cls.analog_settle)
+                for sensorobj in group:
+                    try:
+                        sensorobj._retry(sensorobj.read_soil_moisture)
+                    except (IOError, SensorError) as error:
+                        failed[sensorobj] = error
+            finally:
+                cls.analog_sensor_power(bus, "off")
+        return failed
 
     @classmethod
     def analog_sensor_power(cls, bus, operation):
@@ -231,19 +733,36 @@ class SensorCluster(object):
         """
         # Set appropriate analog sensor power bit in GPIO mask
         # using the ControlCluster bank_mask to avoid overwriting any data
-        reg_data = get_IO_reg(bus, 0x20, cls.power_bank)
-
-        if operation == "on":
-            reg_data = reg_data | 1 << cls.analog_power_pin
-        elif operation == "off":
-            reg_data = reg_data & (0b11111111 ^ (1 << cls.analog_power_pin))
-        else:
+        # The read-modify-write is atomic so a concurrent
+        #   ControlCluster.update cannot clobber it.
+        if operation not in ("on", "off"):
             raise SensorError(
                 "Invalid command used while enabling analog sensors")
-        # Send updated IO mask to output
-        IO_expander_output(bus, 0x20, cls.power_bank, reg_data)
+        # The whole read-modify-write is retried if it fails.
+        def switch():
+            with atomic(bus, PRIORITY_SENSOR):
+                reg_data = get_IO_reg(bus, 0x20, cls.power_bank)
+
+                if operation == "on":
+                    reg_data = reg_data | 1 << cls.analog_power_pin
+                else:
+                    reg_data = reg_data & (0b11111111 ^ (1 << cls.analog_power_pin))
+                # Send updated IO mask to output
+                IO_expander_output(bus, 0x20, cls.power_bank, reg_data)
+        retry(switch, bus, cls.retry_attempts, cls.retry_delay,
+              cls.retry_limit)
 
     @classmethod
+    def water_depth(cls, volts):
+        """ Converts the tank sensor divider voltage to a depth in cm.
+            Depths below 1cm are returned as is; get_water_level
+                clamps them.
+        """
+        return tank_depth(volts, cls.tank_vref, cls.tank_rref,
+                          cls.tank_slope, cls.tank_offset)
+
+    @classmethod
+    @instrumented("get_water_level")
     def get_water_level(cls):
         """ This method uses the ADC on the control module to measure
             the current water tank level and returns the water volume
@@ -255,47 +774,78 @@ class SensorCluster(object):
             Testing shows that the sensor response is not completely linear,
                 though it is quite close. To make the results more accurate,
                 a mapping method approximated by a linear fit to data is used.
+
+            While a tank monitor is running (see start_tank_monitor) its
+                filtered depth is used and no conversion is made.
         """
-        # ----------
-        # These values should be updated based on the real system parameters
-        vref = 4.95
-        tank_height = 17.5 # in centimeters (height of container)
-        rref = 2668  # Reference resistor
-        # ----------
-        val = 0
-        for i in range(5):
+        monitor = cls.tank_monitor
+        if monitor is not None and monitor.value is not None:
+            depth_cm = monitor.value
+        else:
             # Take five readings and do an average
-            # Fetch value from ADC (0x69 - ch1)
-            val = get_ADC_value(cls.bus, 0x6c, 1) + val
-        avg = val / 5
-        water_sensor_res = rref * avg/(vref - avg)
-        depth_cm = water_sensor_res * \
-                    (-.0163) + 28.127 # measured transfer adjusted offset
+            # Fetch value from ADC (0x6c - ch1), sleeping between conversions
+            adc = MCP342x.get(cls.bus, cls.tank_adc_adr)
+            avg = sum(adc.read_samples(1, 5)) / 5.0
+            depth_cm = cls.water_depth(avg)
         if depth_cm < 1.0: # Below 1cm, the values should not be trusted.
             depth_cm = 0
-        cls.water_remaining = depth_cm / tank_height
+        cls.water_remaining = depth_cm / cls.tank_height
         # Return the current depth in case the user is interested in
         #   that parameter alone. (IE for automatic shut-off)
-        return depth_cm/tank_height
+        return cls.water_remaining
+
+    @classmethod
+    def start_tank_monitor(cls, rate=5.0, window=5, alpha=.3,
+                           resolution=None):
+        """ Streams the tank level on a background thread.
+            The tank ADC is put in continuous mode and sampled rate
+                times a second. Each sample is converted to a depth and
+                passed through outlier rejection, a median of window
+                samples and an EMA with weight alpha.
+            resolution optionally changes the ADC resolution (and so its
+                conversion rate).
+            get_water_level then returns the filtered level without
+                touching the bus.
+            Returns the FilteredStream; its value is the depth in cm.
+        """
+        cls.stop_tank_monitor()
+        adc = MCP342x.get(cls.bus, cls.tank_adc_adr)
+        adc.configure(resolution=resolution, continuous=True)
+        chain = FilterChain(OutlierFilter(2 * window + 1, floor=.5),
+                            MedianFilter(window),
+                            EMAFilter(alpha))
+        cls.tank_monitor = FilteredStream(
+            lambda: cls.water_depth(adc.read(1)), chain, rate)
+        cls.tank_monitor.start()
+        return cls.tank_monitor
+
+    @classmethod
+    def stop_tank_monitor(cls):
+        """ Stops the tank monitor and returns the ADC to one-shot mode.
+        """
+        monitor = cls.tank_monitor
+        if monitor is None:
+            return
+        cls.tank_monitor = None
+        monitor.stop()
+        MCP342x.get(cls.bus, cls.tank_adc_adr).configure(continuous=False)
+
+
+class _Flight(object):
+    # A refresh in progress, shared by concurrent callers
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
 
 
 def get_lux_count(lux_byte):
     """ Method to convert data from the TSL2550D lux sensor
     into more easily usable ADC count values.
+    See decode.lux_count for decoding many bytes at once.
 
     """
-    LUX_VALID_MASK = 0b10000000
-    LUX_CHORD_MASK = 0b01110000
-    LUX_STEP_MASK = 0b00001111
-    valid = lux_byte & LUX_VALID_MASK
-    if valid != 0:
-        step_num = (lux_byte & LUX_STEP_MASK)
-        # Shift to normalize value
-        chord_num = (lux_byte & LUX_CHORD_MASK) >> 4
-        step_val = 2**chord_num
-        chord_val = int(16.5 * (step_val - 1))
-        count = chord_val + step_val * step_num
-        return count
+    if lux_valid(lux_byte):
+        return lux_count(lux_byte)
     else:
         raise SensorError("Invalid lux sensor data.")
 
@@ -310,6 +860,14 @@ class SensorError(Exception):
     pass
 
 
+class LuxRangeError(SensorError):
+    """ Non-fatal
+        An auto-ranged lux reading was saturated or invalid.
+        The sensor has switched mode; repeat the conversion.
+    """
+    pass
+
+
 class I2CBusError(Exception):
     """ Typically fatal 
         - Something on the bus has become unresponsive.
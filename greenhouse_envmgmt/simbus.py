@@ -0,0 +1,524 @@
+#!/usr/bin/python
+
+# Contains a simulated SMBus along with models of the devices found on
+#   the sensor head and the controls board.
+# The SimBus answers the same calls as smbus.SMBus, so SensorCluster and
+#   ControlCluster can be driven on a normal Linux box without a Pi.
+# Basic usage:
+#   bus = greenhouse_bus(plants=2)
+#   SensorCluster.bus = bus
+#   ControlCluster.bus = bus
+#   ... run a sensor cycle ...
+#   print(bus.transactions, bus.op_counts)
+# Conversion delays follow the datasheets in hardware/, so cycle times
+#   measured against the SimBus are representative of the real system.
+import errno
+import random
+from math import e
+from time import sleep, time
+
+
+def _nack(addr):
+    """ Builds the error raised by smbus when a device does not ACK.
+    """
+    return IOError(errno.EREMOTEIO,
+                   "Remote I/O error (address " + hex(addr) + ")")
+
+
+class SimBus(object):
+    """ Stand-in for smbus.SMBus.
+
+        Devices are attached either directly to the bus or behind
+            a channel of a simulated TCA9546A multiplexer. A call is
+            routed to whichever device currently answers the address.
+            No answer raises the same IOError as a NACK on real hardware
+            and more than one answer is treated as a bus collision.
+
+        Every transaction is counted (total, per operation and
+            per address) along with an estimate of the bytes on the wire.
+
+        Fault injection:
+            fault_rate - probability of any transaction failing
+            inject_fault(addr, count, op) - fail the next count
+                transactions to addr (optionally only for op)
+            device.present = False - simulate an unplugged device
+
+        Usage:
+            bus = SimBus(fault_rate=.01, seed=1)
+            mux = bus.attach(SimTCA9546A(0x70))
+            mux.attach(0, SimTSL2550())
+    """
+    # Bytes on the wire per call, including address bytes.
+    # Block transfers add their payload length to these figures.
+    frame_bytes = {"write_quick": 1,
+                   "read_byte": 2,
+                   "write_byte": 2,
+                   "read_byte_data": 4,
+                   "write_byte_data": 3,
+                   "read_word_data": 5,
+                   "write_word_data": 4,
+                   "read_i2c_block_data": 3,
+                   "write_i2c_block_data": 2}
+
+    def __init__(self, fault_rate=0.0, seed=None, bitrate=None):
+        self.devices = {}
+        self.fault_rate = fault_rate
+        self.bitrate = bitrate  # bits/s, None for instantaneous transfers
+        self._faults = []
+        self._random = random.Random(seed)
+        self.reset_counters()
+
+    def attach(self, device):
+        """ Attaches a device directly to the bus and returns it.
+        """
+        self.devices[device.addr] = device
+        return device
+
+    def device(self, addr, mux=None, channel=None):
+        """ Returns the device model at addr.
+            Devices behind a multiplexer are found by passing
+                the mux address and channel.
+        """
+        if mux is None:
+            return self.devices[addr]
+        return self.devices[mux].channels[channel][addr]
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.errors = 0
+        self.op_counts = {}
+        self.addr_counts = {}
+
+    def inject_fault(self, addr, count=1, op=None):
+        """ Forces the next count transactions to addr to fail.
+            If op is given, only that SMBus call will fail.
+        """
+        self._faults.append([addr, op, count])
+
+    def _injected(self, op, addr):
+        for fault in self._faults:
+            if fault[0] == addr and fault[1] in (None, op):
+                fault[2] -= 1
+                if fault[2] <= 0:
+                    self._faults.remove(fault)
+                return True
+        return False
+
+    def _resolve(self, addr):
+        found = []
+        device = self.devices.get(addr)
+        if device is not None and device.present:
+            found.append(device)
+        for mux in self.devices.values():
+            if isinstance(mux, SimTCA9546A) and mux.present:
+                found.extend(mux.downstream(addr))
+        return found
+
+    def _transfer(self, op, addr, payload, *args):
+        nbytes = SimBus.frame_bytes[op] + payload
+        self.transactions += 1
+        self.bytes += nbytes
+        self.op_counts[op] = self.op_counts.get(op, 0) + 1
+        self.addr_counts[addr] = self.addr_counts.get(addr, 0) + 1
+        if self.bitrate:
+            sleep(9.0 * nbytes / self.bitrate)  # 8 data bits + ACK
+
+        if self._injected(op, addr) or (
+                self.fault_rate and self._random.random() < self.fault_rate):
+            self.errors += 1
+            raise _nack(addr)
+        devices = self._resolve(addr)
+        if not devices:
+            self.errors += 1
+            raise _nack(addr)
+        if len(devices) > 1:
+            self.errors += 1
+            raise IOError(errno.EIO,
+                          "Bus collision on address " + hex(addr))
+        return getattr(devices[0], op)(*args)
+
+    # smbus.SMBus interface
+    def write_quick(self, addr):
+        return self._transfer("write_quick", addr, 0)
+
+    def read_byte(self, addr):
+        return self._transfer("read_byte", addr, 0)
+
+    def write_byte(self, addr, value):
+        return self._transfer("write_byte", addr, 0, value)
+
+    def read_byte_data(self, addr, cmd):
+        return self._transfer("read_byte_data", addr, 0, cmd)
+
+    def write_byte_data(self, addr, cmd, value):
+        return self._transfer("write_byte_data", addr, 0, cmd, value)
+
+    def read_word_data(self, addr, cmd):
+        return self._transfer("read_word_data", addr, 0, cmd)
+
+    def write_word_data(self, addr, cmd, value):
+        return self._transfer("write_word_data", addr, 0, cmd, value)
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        return self._transfer("read_i2c_block_data", addr, length,
+                              cmd, length)
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        return self._transfer("write_i2c_block_data", addr, len(vals),
+                              cmd, list(vals))
+
+    def close(self):
+        pass
+
+
+class SimDevice(object):
+    """ Base model for a simulated I2C target.
+        Any SMBus call the device does not implement is NACKed.
+    """
+    def __init__(self, addr):
+        self.addr = addr
+        self.present = True
+
+    def write_quick(self):
+        raise _nack(self.addr)
+
+    def read_byte(self):
+        raise _nack(self.addr)
+
+    def write_byte(self, value):
+        raise _nack(self.addr)
+
+    def read_byte_data(self, cmd):
+        raise _nack(self.addr)
+
+    def write_byte_data(self, cmd, value):
+        raise _nack(self.addr)
+
+    def read_word_data(self, cmd):
+        raise _nack(self.addr)
+
+    def write_word_data(self, cmd, value):
+        raise _nack(self.addr)
+
+    def read_i2c_block_data(self, cmd, length):
+        raise _nack(self.addr)
+
+    def write_i2c_block_data(self, cmd, vals):
+        raise _nack(self.addr)
+
+
+class SimTCA9546A(SimDevice):
+    """ TCA9546A 4 channel I2C multiplexer.
+        The low nibble of the control register enables channels 0-3.
+        Devices on every enabled channel are visible on the bus.
+    """
+    def __init__(self, addr=0x70):
+        SimDevice.__init__(self, addr)
+        self.control = 0
+        self.channels = [{}, {}, {}, {}]
+
+    def attach(self, channel, device):
+        """ Attaches a device behind the given channel and returns it.
+        """
+        self.channels[channel][device.addr] = device
+        return device
+
+    def downstream(self, addr):
+        found = []
+        for channel in range(4):
+            if self.control & (1 << channel):
+                device = self.channels[channel].get(addr)
+                if device is not None and device.present:
+                    found.append(device)
+        return found
+
+    def write_byte(self, value):
+        self.control = value & 0x0f
+
+    def read_byte(self):
+        return self.control
+
+
+class SimHIH7000(SimDevice):
+    """ HIH7xxx humidity and temperature sensor.
+        A quick write starts a measurement which completes after
+            conversion_time. Reading before then, or reading the same
+            measurement twice, returns the previous data flagged stale.
+
+        humidity is in %RH and temp in degrees C.
+    """
+    conversion_time = .03665  # typical measurement cycle
+
+    def __init__(self, addr=0x27, humidity=45.0, temp=22.0):
+        SimDevice.__init__(self, addr)
+        self.humidity = humidity
+        self.temp = temp
+        self._started = None
+        self._status = 1
+        self._data = [0, 0, 0, 0]
+
+    def _update(self):
+        if (self._started is not None and
+                time() - self._started >= self.conversion_time):
+            humidity = int(round(self.humidity / 100.0 * (2**14 - 2)))
+            temp = int(round((self.temp + 40.0) / 165.0 * (2**14 - 2)))
+            humidity = min(max(humidity, 0), 2**14 - 1)
+            temp = min(max(temp, 0), 2**14 - 1)
+            self._data = [humidity >> 8, humidity & 0xff,
+                          temp >> 6, (temp & 0x3f) << 2]
+            self._status = 0
+            self._started = None
+
+    def write_quick(self):
+        self._update()
+        self._started = time()
+
+    def read_i2c_block_data(self, cmd, length):
+        self._update()
+        data = list(self._data)
+        data[0] |= self._status << 6
+        self._status = 1  # data is stale once it has been fetched
+        return (data + [0xff] * length)[:length]
+
+    def read_byte(self):
+        return self.read_i2c_block_data(0, 1)[0]
+
+
+class SimTSL2550(SimDevice):
+    """ TSL2550D ambient light sensor.
+        Channel 0 and channel 1 integrate in turn, so after power up
+            or a mode change channel 0 becomes valid after one
+            integration period and channel 1 after two.
+            Standard mode integrates for 400ms, extended mode for 80ms
+            with counts reduced by a factor of 5.
+
+        count0 and count1 are the standard mode counts of each channel.
+    """
+    POWER_DOWN = 0x00
+    POWER_UP = 0x03
+    STANDARD = 0x18
+    EXTENDED = 0x1d
+    READ_CH0 = 0x43
+    READ_CH1 = 0x83
+    integration = {STANDARD: .4, EXTENDED: .08}
+
+    def __init__(self, addr=0x39, lux=300.0, ratio=.3):
+        SimDevice.__init__(self, addr)
+        self.powered = False
+        self.mode = SimTSL2550.STANDARD
+        self.channel = 0
+        self._cycle_start = None
+        self.set_lux(lux, ratio)
+
+    def set_lux(self, lux, ratio=.3):
+        """ Sets the channel counts that produce lux using the
+                same transfer function as SensorCluster.update_lux.
+            ratio is count1/(count0 - count1).
+        """
+        diff = lux / (.39 * e**(-.181 * ratio**2))
+        self.count1 = int(round(ratio * diff))
+        self.count0 = int(round(diff)) + self.count1
+
+    def _restart(self):
+        self._cycle_start = time()
+
+    def write_byte(self, value):
+        if value == SimTSL2550.POWER_DOWN:
+            self.powered = False
+        elif value == SimTSL2550.POWER_UP:
+            if not self.powered:
+                self.powered = True
+                self._restart()
+        elif value in SimTSL2550.integration:
+            if value != self.mode:
+                self.mode = value
+                self._restart()
+        elif value == SimTSL2550.READ_CH0:
+            self.channel = 0
+        elif value == SimTSL2550.READ_CH1:
+            self.channel = 1
+        else:
+            raise _nack(self.addr)
+
+    def read_byte_data(self, cmd):
+        self.write_byte(cmd)
+        if cmd == SimTSL2550.POWER_UP:
+            return SimTSL2550.POWER_UP
+        return self.read_byte()
+
+    def read_byte(self):
+        if not self.powered:
+            return 0
+        elapsed = time() - self._cycle_start
+        if elapsed < self.integration[self.mode] * (self.channel + 1):
+            return 0  # ADC valid bit clear
+        count = [self.count0, self.count1][self.channel]
+        if self.mode == SimTSL2550.EXTENDED:
+            count = count // 5
+        return 0x80 | encode_lux_count(count)
+
+
+def encode_lux_count(count):
+    """ Encodes an ADC count as the chord/step byte used by the TSL2550.
+        Counts above the top of the scale (4015) saturate.
+        This is the inverse of sense.get_lux_count without the valid bit.
+    """
+    count = max(int(count), 0)
+    chord = 7
+    while int(16.5 * (2**chord - 1)) > count:
+        chord -= 1
+    step = (count - int(16.5 * (2**chord - 1))) // 2**chord
+    return (chord << 4) | min(step, 15)
+
+
+class SimMCP342x(SimDevice):
+    """ MCP3422/3/4 delta-sigma ADC.
+        Writing the configuration register with the RDY bit set starts
+            a one-shot conversion. Continuous mode restarts on its own.
+            Conversion time is the inverse of the sample rate picked by
+            the resolution bits (240, 60, 15 or 3.75 SPS).
+
+        voltages maps channel (1-4) to the differential input in volts.
+
+        The command byte of a block read is not treated as a
+            configuration write.
+    """
+    sample_rates = [240.0, 60.0, 15.0, 3.75]
+    resolutions = [12, 14, 16, 18]
+    vref = 2.048
+
+    def __init__(self, addr=0x68, voltages=None):
+        SimDevice.__init__(self, addr)
+        self.voltages = voltages or {}
+        self.config = 0x10  # continuous, channel 1, 12 bits, 1x gain
+        self._started = time()
+        self._ready = False
+        self._code = 0
+
+    def _conversion_time(self):
+        return 1.0 / self.sample_rates[(self.config >> 2) & 0b11]
+
+    def _convert(self):
+        bits = self.resolutions[(self.config >> 2) & 0b11]
+        gain = 1 << (self.config & 0b11)
+        channel = ((self.config >> 5) & 0b11) + 1
+        volts = self.voltages.get(channel, 0.0) * gain
+        code = int(round(volts * 2**(bits - 1) / self.vref))
+        return min(max(code, -2**(bits - 1)), 2**(bits - 1) - 1)
+
+    def _update(self):
+        if self._started is None:
+            return
+        period = self._conversion_time()
+        elapsed = time() - self._started
+        if elapsed >= period:
+            self._code = self._convert()
+            self._ready = True
+            if self.config & 0x10:
+                self._started += period * int(elapsed / period)
+            else:
+                self._started = None
+
+    def write_byte(self, value):
+        self._update()
+        self.config = value & 0x7f
+        if self.config & 0x10 or value & 0x80:
+            self._started = time()
+            self._ready = False
+
+    def read_i2c_block_data(self, cmd, length):
+        self._update()
+        bits = self.resolutions[(self.config >> 2) & 0b11]
+        width = 3 if bits == 18 else 2
+        code = self._code & (2**(8 * width) - 1)  # sign extend
+        data = [(code >> (8 * i)) & 0xff for i in reversed(range(width))]
+        data.append(self.config | (0 if self._ready else 0x80))
+        self._ready = False
+        return (data + [data[-1]] * length)[:length]
+
+    def read_byte(self):
+        return self.read_i2c_block_data(0, 1)[0]
+
+
+class SimMCP23017(SimDevice):
+    """ MCP23017 16 bit IO expander in its power-on configuration
+            (IOCON.BANK = 0, sequential addressing enabled).
+        Writes to GPIO land in the output latch. Reads of GPIO return
+            the latch for output pins and inputs[bank] for input pins.
+    """
+    IODIR = [0x00, 0x01]
+    GPIO = [0x12, 0x13]
+    OLAT = [0x14, 0x15]
+
+    def __init__(self, addr=0x20):
+        SimDevice.__init__(self, addr)
+        self.registers = [0] * 0x16
+        self.registers[0x00] = 0xff
+        self.registers[0x01] = 0xff
+        self.inputs = [0, 0]
+        self._pointer = 0
+
+    def outputs(self, bank):
+        """ Returns the levels currently driven on the output pins of bank.
+        """
+        return (self.registers[self.OLAT[bank]] &
+                ~self.registers[self.IODIR[bank]] & 0xff)
+
+    def _read(self, reg):
+        if reg >= len(self.registers):
+            raise _nack(self.addr)
+        if reg in self.GPIO:
+            bank = self.GPIO.index(reg)
+            iodir = self.registers[self.IODIR[bank]]
+            return self.outputs(bank) | (self.inputs[bank] & iodir)
+        return self.registers[reg]
+
+    def _write(self, reg, value):
+        if reg >= len(self.registers):
+            raise _nack(self.addr)
+        if reg in self.GPIO:
+            reg = self.OLAT[self.GPIO.index(reg)]
+        self.registers[reg] = value & 0xff
+
+    def write_byte(self, value):
+        self._pointer = value
+
+    def read_byte(self):
+        value = self._read(self._pointer)
+        self._pointer += 1
+        return value
+
+    def read_byte_data(self, cmd):
+        return self._read(cmd)
+
+    def write_byte_data(self, cmd, value):
+        self._write(cmd, value)
+
+    def read_i2c_block_data(self, cmd, length):
+        return [self._read(cmd + i) for i in range(length)]
+
+    def write_i2c_block_data(self, cmd, vals):
+        for i, value in enumerate(vals):
+            self._write(cmd + i, value)
+
+
+def greenhouse_bus(plants=2, expanders=1, **kwargs):
+    """ Builds a SimBus populated like the greenhouse:
+            - controls board: MCP23017 at 0x20 and the tank ADC at 0x6c
+            - expanders - 1 more MCP23017s from 0x21 for extra plants
+            - one sensor head per plant, each behind a TCA9546A
+                starting at 0x70 with the TSL2550 on channel 0,
+                the HIH7xxx on channel 1 and the MCP342x on channel 2.
+        Remaining keyword arguments are passed to SimBus.
+    """
+    bus = SimBus(**kwargs)
+    for addr in range(0x20, 0x20 + expanders):
+        bus.attach(SimMCP23017(addr))
+    bus.attach(SimMCP342x(0x6c, voltages={1: 1.45}))
+    for plant in range(plants):
+        mux = bus.attach(SimTCA9546A(0x70 + plant))
+        mux.attach(0, SimTSL2550(0x39))
+        mux.attach(1, SimHIH7000(0x27))
+        mux.attach(2, SimMCP342x(0x68, voltages={1: 1.0}))
+    return bus
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# Contains the I2C topology service used to discover sensor heads.
+# The bus is scanned once and the result cached per bus, so creating
+#   SensorCluster objects no longer probes every address.
+#   Only the ranges that can hold greenhouse hardware are probed:
+#      0x70-0x77  TCA9546A multiplexers (one per sensor head)
+#      0x20-0x27  MCP23017 IO expanders
+#      0x68-0x6f  MCP342x ADCs on the controls board
+#   plus the expected sensor address on each channel of every mux found.
+# Basic usage:
+#   topology = I2CTopology.get(bus)
+#   topology.mux_addresses()         # scans on first use
+#   topology.rescan()                # explicit rescan
+#   topology.start_rescans(60)       # background rescan every minute
+# Probes are retried, so one failed transfer does not drop a device. A
+#   scan that saw bus errors is kept but not cached: the next lookup
+#   scans again.
+import threading
+from time import time
+from i2c_utility import TCA_select, atomic, PRIORITY_NORMAL
+from faults import retry
+
+
+class I2CTopology(object):
+    """ Cached map of the devices on one I2C bus.
+
+        After a scan:
+            muxes - sorted TCA9546A addresses
+            expanders - sorted MCP23017 addresses
+            adcs - sorted MCP342x addresses on the main bus
+            heads - {mux address: {channel: [device addresses]}}
+            scanned - time of the last scan without bus errors
+            errors - bus errors seen by the last scan
+            generation - incremented whenever a rescan finds a change
+
+        Each probe is an atomic bus unit, so background rescans can run
+            alongside sensor sweeps.
+    """
+    mux_range = range(0x70, 0x78)
+    expander_range = range(0x20, 0x28)
+    adc_range = range(0x68, 0x70)
+    # Devices expected behind each mux channel (TSL2550, HIH7xxx,
+    #   MCP342x and STLM75)
+    head_devices = {0: [0x39], 1: [0x27], 2: [0x68], 3: [0x48]}
+    # An absent device fails every attempt, so the retries are short
+    probe_attempts = 3
+    probe_delay = .001
+    _instances = {}
+
+    @classmethod
+    def get(cls, bus):
+        """ Returns the topology of bus, shared by every caller.
+        """
+        if bus not in cls._instances:
+            cls._instances[bus] = cls(bus)
+        return cls._instances[bus]
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.muxes = []
+        self.expanders = []
+        self.adcs = []
+        self.heads = {}
+        self.scanned = None
+        self.errors = 0
+        self.generation = 0
+        self._failures = 0
+        self._scan_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _retry(self, operation, *args):
+        # Counts the failed attempts of an operation that did succeed;
+        #   the callers decide what an operation that never did means.
+        failures = []
+
+        def attempt():
+            try:
+                return operation(*args)
+            except IOError:
+                failures.append(1)
+                raise
+        result = retry(attempt, self.bus, self.probe_attempts,
+                       self.probe_delay)
+        self._failures += len(failures)
+        return result
+
+    def _probe(self, addr):
+        def read():
+            with atomic(self.bus, PRIORITY_NORMAL):
+                self.bus.read_byte(addr)
+        try:
+            self._retry(read)
+            return True
+        except IOError:
+            return False  # no answer to any attempt: absent
+
+    def _mux_off(self, mux):
+        # Best effort; a failure only keeps the scan from being cached
+        try:
+            self._retry(TCA_select, self.bus, mux, "off")
+        except IOError:
+            self._failures += 1
+
+    def _probe_head(self, mux):
+        channels = {}
+        for channel, addrs in sorted(self.head_devices.items()):
+            with atomic(self.bus, PRIORITY_NORMAL):
+                try:
+                    self._retry(TCA_select, self.bus, mux, channel)
+                    found = [addr for addr in addrs if self._probe(addr)]
+                except IOError:
+                    self._failures += 1
+                    found = []
+                finally:
+                    self._mux_off(mux)
+            if found:
+                channels[channel] = found
+        return channels
+
+    def scan(self, downstream=True):
+        """ Probes the bus and replaces the cached map. A scan that saw
+                bus errors only replaces it until a clean scan is made.
+            Every mux found is switched off before the other ranges are
+                probed so that sensor heads cannot answer for them.
+            downstream=False skips probing behind the muxes.
+        """
+        with self._scan_lock:
+            self._failures = 0
+            muxes = [addr for addr in self.mux_range if self._probe(addr)]
+            for mux in muxes:
+                self._mux_off(mux)
+            expanders = [addr for addr in self.expander_range
+                         if self._probe(addr)]
+            adcs = [addr for addr in self.adc_range if self._probe(addr)]
+            heads = {}
+            if downstream:
+                for mux in muxes:
+                    heads[mux] = self._probe_head(mux)
+
+            layout = (muxes, expanders, adcs, heads)
+            self.errors = self._failures
+            if self.scanned is None or not self.errors:
+                # An errored rescan keeps the cached map
+                if self.scanned is not None and layout != (
+                        self.muxes, self.expanders, self.adcs, self.heads):
+                    self.generation += 1
+                self.muxes, self.expanders, self.adcs, self.heads = layout
+            if not self.errors:
+                self.scanned = time()
+        return self
+
+    def rescan(self):
+        return self.scan()
+
+    def _ensure_scanned(self):
+        if self.scanned is None:
+            self.scan()
+
+    def mux_addresses(self):
+        """ Returns the addresses of the connected sensor heads.
+        """
+        self._ensure_scanned()
+        return list(self.muxes)
+
+    def expander_addresses(self):
+        self._ensure_scanned()
+        return list(self.expanders)
+
+    def adc_addresses(self):
+        self._ensure_scanned()
+        return list(self.adcs)
+
+    def head(self, mux):
+        """ Returns {channel: [addresses]} for the sensor head at mux.
+        """
+        self._ensure_scanned()
+        return dict(self.heads.get(mux, {}))
+
+    def start_rescans(self, interval):
+        """ Rescans the bus every interval seconds on a background thread.
+        """
+        self.stop_rescans()
+        self._stop.clear()
+
+        def rescan_loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.scan()
+                except IOError:
+                    pass  # try again at the next interval
+
+        self._thread = threading.Thread(target=rescan_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop_rescans(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,548 @@
+#!/usr/bin/python
+
+def test(plants=2, runs=1, fault_rate=0.0, pipelined=True):
+    """ Method for testing the sensor and control modules
+            against the simulated bus. No hardware is required.
+    Options:
+        plants: Number of sensor heads attached to the simulated bus
+        runs: Number of full sensor cycles to time
+        fault_rate: Probability of any single bus transaction failing
+        pipelined: Use the pipelined sweep rather than visiting
+                each plant in turn
+    """
+
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "..", "greenhouse_envmgmt"))
+    from simbus import greenhouse_bus
+    from i2c_utility import mux_stats
+    from sense import SensorCluster
+    from control import ControlCluster
+    from time import sleep, time
+
+    bus = greenhouse_bus(plants=plants, expanders=2, fault_rate=fault_rate,
+                         seed=1)
+    SensorCluster.bus = bus
+    ControlCluster.bus = bus
+
+    sensors = [SensorCluster(ID=i + 1) for i in range(plants)]
+    controls = [ControlCluster(i + 1) for i in range(min(plants, 4))]
+    print("Created " + str(len(sensors)) + " sensor clusters and " +
+          str(len(controls)) + " control clusters")
+    print("Setup used " + str(bus.transactions) + " bus transactions")
+
+    for cycle in range(runs):
+        bus.reset_counters()
+        start = time()
+        try:
+            SensorCluster.update_all_sensors(opt="all", pipelined=pipelined)
+        except IOError:
+            print("Run: " + str(cycle) + " - There was a bus error.")
+        print("Run " + str(cycle) + ": " + str(round(time() - start, 3)) +
+              "s, " + str(bus.transactions) + " transactions, " +
+              str(bus.bytes) + " bytes")
+        print(bus.op_counts)
+        print("Mux transactions avoided: " + str(mux_stats["avoided"]))
+
+    for sensor in sensors:
+        print("Plant " + str(sensor.ID) + " sensor values")
+        print(sensor.sensor_values())
+
+    print("Testing auto-ranged lux reads")
+    light = bus.device(0x39, mux=0x70, channel=0)
+    for lux in (5000.0, 5000.0, 40.0, 40.0):
+        light.set_lux(lux)
+        start = time()
+        sensors[0].update_lux()
+        print("Set " + str(lux) + " lux, read " + str(sensors[0].lux) +
+              " in " + str(round(time() - start, 3)) + "s, next mode " +
+              ["standard", "extended"][sensors[0].lux_extend])
+    light.set_lux(300.0)
+    sensors[0].update_lux()
+
+    print("Testing a dark reading")
+    dark = bus.device(0x39, mux=sensors[-1].mux_addr, channel=0)
+    dark.set_lux(0.0)
+    failed = SensorCluster.update_all_sensors(opt="all")
+    print("Dark plant reads 0 lux: " + str(sensors[-1].lux == 0.0) +
+          ", no cluster failed: " + str(not failed) +
+          ", other plants read: " +
+          str(all(sensorobj.lux > 0 for sensorobj in sensors[:-1])))
+    dark.set_lux(300.0)
+
+    print("Testing retries and the circuit breaker")
+    bus.reset_counters()
+    bus.inject_fault(0x27, op="write_quick")
+    failed = SensorCluster.update_all_sensors(opt="all")
+    print("Transient humidity fault: " + str(len(failed)) + " failed, " +
+          str(bus.errors) + " bus errors")
+    head = bus.device(sensors[-1].mux_addr)
+    head.present = False
+    for cycle in range(SensorCluster.breaker_threshold):
+        bus.reset_counters()
+        start = time()
+        failed = SensorCluster.update_all_sensors(opt="all")
+        print("Unplugged head, sweep " + str(cycle) + ": " +
+              str(round(time() - start, 3)) + "s, failed " +
+              str([sensorobj.ID for sensorobj in failed]) + ", breaker " +
+              sensors[-1].breaker.state + ", analog power " +
+              str(bool(bus.device(0x20).outputs(0) & 1)))
+    failed = SensorCluster.update_all_sensors(opt="all")
+    print("Skipped while open: " + str(sensors[-1] not in failed))
+    head.present = True
+    sensors[-1].breaker.probe_interval = 0
+    SensorCluster.update_all_sensors(opt="all")
+    print("Breaker after the head returned: " + sensors[-1].breaker.state)
+
+    print("Testing tank level monitor")
+    bus.reset_counters()
+    print("Tank level (one-shot): " + str(SensorCluster.get_water_level()))
+    monitor = SensorCluster.start_tank_monitor(rate=50)
+    sleep(.5)
+    bus.reset_counters()
+    start = time()
+    for i in range(1000):
+        level = SensorCluster.get_water_level()
+    print("Tank level (monitor): " + str(level) + ", 1000 reads took " +
+          str(round(time() - start, 4)) + "s and " +
+          str(bus.transactions) + " bus transactions")
+    SensorCluster.stop_tank_monitor()
+    print("Monitor took " + str(monitor.samples) + " samples, " +
+          str(monitor.chain.stages[0].rejected) + " rejected")
+
+    print("Testing bus recording and replay")
+    import tempfile
+    from recorder import BusRecorder, ReplayBus
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    clusters = SensorCluster._list
+    recorder = BusRecorder(greenhouse_bus(plants=plants, seed=1), path)
+    SensorCluster.bus = recorder
+    SensorCluster._list = []
+    [SensorCluster(ID=i + 1) for i in range(plants)]
+    start = time()
+    SensorCluster.update_all_sensors(opt="all")
+    recorded = time() - start
+    expected = [sensor.sensor_values(max_age=60) for sensor in SensorCluster]
+    recorder.close()
+    SensorCluster.bus = ReplayBus(path)
+    SensorCluster._list = []
+    [SensorCluster(ID=i + 1) for i in range(plants)]
+    start = time()
+    SensorCluster.update_all_sensors(opt="all")
+    replayed = time() - start
+    values = [sensor.sensor_values(max_age=60) for sensor in SensorCluster]
+    matched = all(value["light"] == want["light"] and
+                  value["temperature"] == want["temperature"] and
+                  value["water"] == want["water"]
+                  for value, want in zip(values, expected))
+    print("Recorded " + str(len(SensorCluster.bus.log)) + " transactions in " +
+          str(round(recorded, 3)) + "s, replayed in " +
+          str(round(replayed, 3)) + "s, values match: " + str(matched))
+    SensorCluster.bus.close()
+    os.remove(path)
+    SensorCluster._list = clusters
+    SensorCluster.bus = bus
+
+    print("Testing two buses polled in parallel")
+    second = greenhouse_bus(plants=plants, seed=2)
+    clusters = list(SensorCluster._list)
+    extra = [SensorCluster(ID=plants + i + 1, bus=second, slot=i + 1)
+             for i in range(plants)]
+    bus.reset_counters()
+    start = time()
+    SensorCluster.update_all_sensors(opt="all")
+    values = SensorCluster.all_values()
+    print(str(2 * plants) + " plants on 2 buses: " +
+          str(round(time() - start, 3)) + "s, " + str(bus.transactions) +
+          " + " + str(second.transactions) + " transactions, " +
+          str(len(values)) + " clusters in the merged view")
+    SensorCluster._list[:] = clusters
+
+    print("Testing instrumentation")
+    import instrument
+    SensorCluster.bus = instrument.InstrumentedBus(bus)
+    instrument.enable()
+    SensorCluster.update_all_sensors(opt="all")
+    instrument.disable()
+    stats = instrument.snapshot(reset_after=True)
+    for operation in ("sweep_sensors", "TCA_select", "get_ADC_value",
+                      "read_lux", "bus.write_byte"):
+        summary = stats["ops"][operation]
+        print(operation + ": " + str(summary["count"]) + " calls, mean " +
+              str(round(summary["mean"] * 1000, 3)) + "ms, max " +
+              str(round(summary["max"] * 1000, 3)) + "ms")
+    for ID, ops in sorted(stats["clusters"].items()):
+        print("Plant " + str(ID) + ": " +
+              str(sum(op["bytes"] for op in ops.values())) + " bytes, " +
+              str(sum(op["errors"] for op in ops.values())) + " errors")
+    SensorCluster.bus = bus
+
+    print("Testing expander state shared by a wrapped and a raw bus")
+    expander = bus.device(0x20)
+    SensorCluster.bus = instrument.InstrumentedBus(bus)
+    controls[0].control(on="fan")
+    SensorCluster.update_all_sensors(opt="all")
+    print("Fan still on after a sweep on the wrapped bus: " +
+          str(bool(expander.outputs(0) & 0b100)))
+    controls[0].control(off="fan")
+    SensorCluster.bus = bus
+
+    print("Testing controls API")
+    bus.reset_counters()
+    controls[0].control(on=["light", "fan"])
+    print("Expander bank A outputs: " + bin(expander.outputs(0)))
+    controls[0].control(off="all")
+    print("Expander bank A outputs: " + bin(expander.outputs(0)))
+    print("Controls used " + str(bus.transactions) + " bus transactions")
+
+    print("Testing a second IO expander")
+    extra = ControlCluster(5)
+    bus.reset_counters()
+    extra.control(on=["light", "fan"])
+    print("Expander 0x21 bank A outputs: " + bin(bus.device(0x21).outputs(0)) +
+          ", " + str(bus.addr_counts) + " transactions by address")
+    extra.remove()
+    extra.update()
+    print("Expander 0x21 bank A outputs after removal: " +
+          bin(bus.device(0x21).outputs(0)))
+    from control import ClusterRemoved
+    reused = ControlCluster(6)
+    try:
+        extra.control(on="light")
+        print("Removed cluster still accepted changes")
+    except ClusterRemoved:
+        print("Removed cluster refused changes, slot reused safely: " +
+              str(reused.state == 0 and
+                  bus.device(0x21).outputs(0) == 0))
+    reused.remove()
+    reused.update()
+
+    print("Testing pump requests")
+    controls[0].control(on="pump")
+    controls[1].control(on="pump")
+    controls[0].control(off="pump")
+    print("Pump on while one cluster requests it: " +
+          str(bool(expander.outputs(0) & 0b10)))
+    controls[1].control(off="pump")
+    print("Pump on after both released it: " +
+          str(bool(expander.outputs(0) & 0b10)))
+
+    print("Testing control transactions")
+    bus.reset_counters()
+    start = time()
+    with ControlCluster.transaction() as scene:
+        for ctrlobj in controls:
+            scene.control(ctrlobj, on=["light", "fan"])
+    print("Expander outputs: " + bin(expander.outputs(0)) + ", " +
+          bin(expander.outputs(1)))
+    with ControlCluster.transaction() as scene:
+        for ctrlobj in controls:
+            scene.control(ctrlobj, off="all")
+    print("Scene changes took " + str(round(time() - start, 3)) + "s and " +
+          str(bus.transactions) + " bus transactions")
+
+    print("Testing bulk changes")
+    bus.reset_counters()
+    ControlCluster.bulk(on=["light", "fan"])
+    ControlCluster.bulk(off="fan")
+    ControlCluster.commit()
+    print("Lights on, fans off: " + bin(expander.outputs(0)) + ", " +
+          bin(expander.outputs(1)) + " in " + str(bus.transactions) +
+          " bus transactions")
+    ControlCluster.bulk(off="all")
+    ControlCluster.commit()
+
+    print("Testing control programs")
+    from programs import ProgramEngine, LightWindow, PulseTrain, DutyCycle
+    from time import localtime, mktime
+    bus.reset_counters()
+    engine = ProgramEngine()
+    now = time()
+    midnight = mktime(localtime(now)[:3] + (0, 0, 0, 0, 0, -1))
+    engine.add(LightWindow(controls[0], (now - midnight - 60) % 86400,
+                           (now - midnight + 3600) % 86400))
+    for ctrlobj in controls[:2]:
+        engine.add(PulseTrain(ctrlobj, on_for=.1, every=.25, start=now + .1,
+                              count=3))
+    engine.add(DutyCycle(controls[-1], duty=.5, period=.2, start=now + .1))
+    engine.start()
+    pump_on = 0
+    while time() < now + 1:
+        pump_on += expander.outputs(0) >> 1 & 1
+        sleep(.01)
+    engine.stop()
+    print("Light on: " + str(bool(expander.outputs(0) & 0b1000)) +
+          ", pump on for about " + str(pump_on * 10) + "ms of 300ms")
+    print(str(engine.transitions) + " transitions in " + str(engine.commits) +
+          " commits, " + str(bus.transactions) +
+          " bus transactions, worst lateness " +
+          str(round(engine.max_lateness * 1000, 1)) + "ms")
+    ControlCluster.bulk(off="all")
+    ControlCluster.commit()
+
+    print("Testing the local control loop")
+    from regulate import LocalController, Hysteresis, PID, TankGuard
+    loop = LocalController(guard=TankGuard(minimum=.6, band=.05))
+    loop.add(Hysteresis("temperature", "fan", above=70, band=2))
+    loop.add(Hysteresis("water", ("valve", "pump"), below=30, band=5))
+    loop.add(PID("humidity", "fan", setpoint=40, kp=.1, window=1), IDs=[2])
+    SensorCluster.update_all_sensors(opt="all")
+    bus.reset_counters()
+    loop.step()
+    print("Tank low: fans on " + str([ctrlobj.controls["fan"]
+                                      for ctrlobj in controls]) +
+          ", pump " + controls[0].controls["pump"] + ", " +
+          str(bus.transactions) + " bus transactions")
+    loop.guard = TankGuard(minimum=.5, band=.05)
+    loop.step()
+    print("Tank refilled: pump " + str(bool(expander.outputs(0) & 0b10)) +
+          ", valves " + str([ctrlobj.controls["valve"]
+                             for ctrlobj in controls]))
+    loop.guard = None
+    start = time()
+    for cycle in range(1000):
+        loop.step()
+    print("1000 steps without new readings took " +
+          str(round(time() - start, 3)) + "s, " + str(loop.commits) +
+          " commits in total")
+    loop.rules = []
+    ControlCluster.bulk(off="all")
+    ControlCluster.commit()
+
+    print("Testing bus broker with a sweep and controls in parallel")
+    from broker import BusBroker
+    from threading import Thread
+    broker = BusBroker(bus)
+    SensorCluster.bus = broker
+    ControlCluster.bus = broker
+    sweep = Thread(target=SensorCluster.update_all_sensors,
+                   kwargs={"opt": "all"})
+    sweep.start()
+    latency = []
+    while sweep.is_alive():
+        start = time()
+        controls[0].control(on="fan")
+        controls[0].control(off="fan")
+        latency.append(time() - start)
+    sweep.join()
+    print("Control round trips during sweep: " + str(len(latency)) +
+          ", worst " + str(round(max(latency), 4)) + "s")
+    SensorCluster.bus = bus
+    ControlCluster.bus = bus
+
+    print("Testing scheduler deadlines")
+    from scheduler import SensorScheduler
+    schedule = SensorScheduler(jitter=0, tolerance=.1)
+    job = schedule.add(SensorCluster, "water_level", period=.2)
+    first = job.deadline
+    schedule.run_pending()
+    print("On time: " + str(job.runs == 1 and job.missed == 0) +
+          ", next deadline one period later: " +
+          str(abs(job.deadline - first - .2) < 1e-6))
+    sleep(.5)
+    schedule.run_pending()
+    print("Late: " + str(job.runs == 2 and job.missed == 1 and
+                         schedule.missed_deadlines() == 1) +
+          ", skipped ahead instead of catching up: " +
+          str(abs(job.deadline - job.last_run - .2) < 1e-6) +
+          ", lateness " + str(round(job.max_lateness, 2)) + "s")
+
+    print("Testing history wraparound")
+    from history import SensorHistory
+    history = SensorHistory(capacity=5)
+    for t in range(8):
+        history.append(float(t), temp=t * 10.0)
+    samples = history.between()
+    print("Kept the newest 5 of 8 samples in order: " +
+          str(len(history) == 5 and
+              samples["timestamp"] == [3.0, 4.0, 5.0, 6.0, 7.0] and
+              samples["temp"] == [30.0, 40.0, 50.0, 60.0, 70.0]))
+    print("Range across the wrap: " +
+          str(history.between(4.5, 6.0)["timestamp"] == [5.0, 6.0]) +
+          ", latest: " + str(history.latest()["temp"] == 70.0) +
+          ", missing quantities are NaN: " +
+          str(history.latest()["lux"] != history.latest()["lux"]))
+
+    print("Testing concurrent sensor_values requests")
+    updates = sensors[0].update_count
+    readers = [Thread(target=sensors[0].sensor_values) for i in range(5)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    print("5 concurrent requests ran " +
+          str(sensors[0].update_count - updates) + " update (expected 1)")
+    bus.reset_counters()
+    values = sensors[0].sensor_values(max_age=60)
+    print("Fresh values served without the bus: " +
+          str(bus.transactions == 0 and "timestamps" in values))
+
+    print("Testing the topology scan")
+    from topology import I2CTopology
+    topology = I2CTopology(bus)
+    bus.reset_counters()
+    topology.scan()
+    muxes = [0x70 + i for i in range(plants)]
+    print("Found the sensor heads, expanders and tank ADC: " +
+          str(topology.mux_addresses() == muxes and
+              topology.expander_addresses() == [0x20, 0x21] and
+              topology.adc_addresses() == [0x6c]) + " in " +
+          str(bus.transactions) + " bus transactions")
+    print("Head devices: " + str(all(topology.head(mux) ==
+                                     {0: [0x39], 1: [0x27], 2: [0x68]}
+                                     for mux in muxes)))
+    head = bus.device(muxes[-1])
+    head.present = False
+    topology.rescan()
+    print("Unplugged head dropped: " +
+          str(topology.mux_addresses() == muxes[:-1] and
+              topology.generation == 1))
+    head.present = True
+    topology.rescan()
+    flaky = I2CTopology(bus)
+    bus.inject_fault(muxes[1], op="read_byte")
+    flaky.scan()
+    print("One failed probe: head found " +
+          str(flaky.muxes == muxes) + ", scan not cached " +
+          str(flaky.errors == 1 and flaky.scanned is None))
+    flaky.mux_addresses()
+    print("Next lookup rescanned: " + str(flaky.scanned is not None))
+
+    print("Testing MCP342x conversions")
+    from i2c_utility import MCP342x
+    bus.device(0x6c).voltages[2] = -.5
+    adc = MCP342x(bus, 0x6c)
+    for resolution in (12, 16, 18):
+        adc.configure(resolution=resolution)
+        lsb = MCP342x.vref / 2**(resolution - 1)
+        start = time()
+        volts = [adc.read(1), adc.read(2)]
+        elapsed = time() - start
+        print(str(resolution) + " bits: " + str(volts) + ", within 1 LSB: " +
+              str(abs(volts[0] - 1.45) <= lsb and abs(volts[1] + .5) <= lsb) +
+              ", waited for both conversions: " +
+              str(elapsed >= 2 * adc.conversion_time()))
+    del bus.device(0x6c).voltages[2]
+
+    print("Testing batched soil moisture reads")
+    bus.reset_counters()
+    sensors[0].update_soil_moisture()
+    single = bus.addr_counts.get(0x20, 0)
+    one = sensors[0].soil_moisture
+    bus.reset_counters()
+    start = time()
+    failed = SensorCluster.update_all_soil_moisture()
+    print(str(plants) + " plants in " + str(round(time() - start, 3)) +
+          "s, one power window: " +
+          str(bus.addr_counts.get(0x20, 0) == single) + ", values match: " +
+          str(not failed and all(sensorobj.soil_moisture == one
+                                 for sensorobj in sensors)) +
+          ", power off: " + str(not bus.device(0x20).outputs(0) & 1))
+    schedule = SensorScheduler()
+    jobs = [schedule.add(sensorobj, "soil_moisture") for sensorobj in sensors]
+    bus.reset_counters()
+    schedule.run_pending()
+    print("Scheduled batch used one power window: " +
+          str(bus.addr_counts.get(0x20, 0) == single and
+              all(job.runs == 1 for job in jobs)))
+    schedule = SensorScheduler()
+    jobs = [schedule.add(sensorobj, sensor) for sensorobj in sensors
+            for sensor in ("lux", "humidity_temp", "soil_moisture")]
+    rows = [len(sensorobj.history) for sensorobj in sensors]
+    start = time()
+    schedule.run_pending()
+    print("Lux, humidity and moisture jobs recorded one row per plant: " +
+          str(all(job.runs == 1 for job in jobs) and
+              [len(sensorobj.history) - count for sensorobj, count
+               in zip(sensors, rows)] == [1] * plants and
+              all(sensorobj.timestamp >= start for sensorobj in sensors)))
+
+    print("Testing array decoding against the scalar decoders")
+    import decode
+    if decode.numpy is None:
+        print("NumPy is not installed, skipped")
+    else:
+        import random
+        numpy = decode.numpy
+        rand = random.Random(1)
+        frames = [[rand.randrange(256) for i in range(4)] for n in range(1000)]
+        ch0 = [frame[0] | 0x80 for frame in frames]
+        ch1 = [min(frame[1], frame[0]) | 0x80 for frame in frames]
+        lux, valid = decode.lux_frames(numpy.array(ch0), numpy.array(ch1))
+        matched = bool(valid.all())
+        for n in range(len(frames)):
+            want = decode.lux_value(decode.lux_count(ch0[n]),
+                                    decode.lux_count(ch1[n]))
+            matched = matched and abs(lux[n] - want) <= 1e-9 * abs(want)
+        print("Lux: " + str(matched))
+        status, humidity, temp = decode.hih_frames(numpy.array(frames))
+        print("Humidity and temperature: " + str(all(
+            status[n] == decode.hih_status(frame[0]) and
+            abs(humidity[n] - decode.hih_humidity(frame[0], frame[1])) < 1e-9
+            and abs(temp[n] - decode.fahrenheit(
+                decode.hih_celsius(frame[2], frame[3]))) < 1e-9
+            for n, frame in enumerate(frames))))
+        for resolution, width in ((12, 2), (18, 3)):
+            volts = decode.adc_frames(numpy.array(frames)[:, :width],
+                                      resolution)
+            print(str(resolution) + " bit ADC: " + str(all(
+                abs(volts[n] - decode.adc_frames(frame[:width], resolution))
+                < 1e-12 for n, frame in enumerate(frames))))
+
+    print("Testing the asyncio versions")
+    if sys.version_info < (3, 5):
+        print("Needs Python 3.5 or later, skipped")
+    else:
+        import asyncio
+        import aio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        names = ("light", "water", "humidity", "temperature")
+        SensorCluster.update_all_sensors(opt="all")
+        expected = [[sensorobj.current_values()[name] for name in names]
+                    for sensorobj in sensors]
+        start = time()
+        failed = loop.run_until_complete(aio.update_all_sensors(opt="all"))
+        print(str(plants) + " plants in " + str(round(time() - start, 3)) +
+              "s, values match the blocking sweep: " +
+              str(not failed and expected ==
+                  [[sensorobj.current_values()[name] for name in names]
+                   for sensorobj in sensors]) +
+              ", power off: " + str(not expander.outputs(0) & 1))
+        bus.inject_fault(0x20, count=SensorCluster.retry_attempts)
+        try:
+            loop.run_until_complete(aio.update_soil_moisture(sensors[0]))
+            print("Power fault was not raised")
+        except IOError:
+            print("Rail released after a power fault: " +
+                  str(aio._analog[bus][0] == 0))
+        loop.run_until_complete(aio.update_soil_moisture(sensors[0]))
+        print("Next read powered the rail again: " +
+              str(sensors[0].soil_moisture == expected[0][1] and
+                  aio._analog[bus][0] == 0 and not expander.outputs(0) & 1))
+        updates = sensors[0].update_count
+        values = loop.run_until_complete(asyncio.gather(
+            *[aio.sensor_values(sensors[0]) for i in range(5)]))
+        print("5 concurrent requests ran " +
+              str(sensors[0].update_count - updates) +
+              " update (expected 1), timestamps returned: " +
+              str(all("timestamps" in value for value in values)))
+        loop.close()
+        for run in range(2):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(asyncio.gather(
+                *[aio.update_soil_moisture(sensorobj)
+                  for sensorobj in sensors]))
+            loop.close()
+        print("Concurrent reads in two event loops: " +
+              str([sensorobj.soil_moisture for sensorobj in sensors] ==
+                  [values[1] for values in expected] and
+                  not expander.outputs(0) & 1))
+        asyncio.set_event_loop(None)
+
+
+if __name__ == "__main__":
+    test()